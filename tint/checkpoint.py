@@ -0,0 +1,146 @@
+"""
+tint.checkpoint
+===============
+
+Tools for writing tracking state to disk and reading it back, so that long
+tracking jobs can be resumed.
+
+"""
+
+import gzip
+import os
+import pickle
+import tempfile
+
+from .helpers import ColumnBuffer
+
+CHECKPOINT_VERSION = 2
+
+
+def write_pickle(obj, path, compresslevel=4):
+    """ Writes obj to path as a gzip compressed pickle, and syncs it to
+    disk. """
+    with open(path, 'wb') as raw_file:
+        with gzip.GzipFile(fileobj=raw_file, mode='wb',
+                           compresslevel=compresslevel) as gz_file:
+            pickle.dump(obj, gz_file, protocol=pickle.HIGHEST_PROTOCOL)
+        raw_file.flush()
+        os.fsync(raw_file.fileno())
+
+
+def read_pickle(path):
+    """ Reads a gzip compressed pickle written by write_pickle. """
+    with gzip.open(path, 'rb') as gz_file:
+        return pickle.load(gz_file)
+
+
+def write_rows(buffer, name, path, compresslevel=4):
+    """ Writes the rows of buffer not yet written to the checkpoint at path
+    to a new segment file beside it, and returns a description of the
+    buffer from which read_rows rebuilds it. Segments holding rows since
+    discarded from buffer are dropped from the description. """
+    path = os.path.abspath(path)
+    if buffer.checkpoint_path != path:
+        buffer.saved = 0
+        buffer.segments = []
+        buffer.checkpoint_path = path
+    segments = []
+    for file_name, start, nrows in buffer.segments:
+        if start < buffer.saved:
+            segments.append(
+                (file_name, start, min(nrows, buffer.saved - start))
+            )
+    if buffer.size > buffer.saved:
+        rows = dict((col, buffer.columns[col][buffer.saved:buffer.size])
+                    for col in buffer.column_order)
+        fd, seg_path = tempfile.mkstemp(
+            dir=os.path.dirname(path),
+            prefix='{}.{}.'.format(os.path.basename(path), name),
+            suffix='.rows'
+        )
+        os.close(fd)
+        try:
+            write_pickle(rows, seg_path, compresslevel)
+        except BaseException:
+            os.remove(seg_path)
+            raise
+        segments.append((os.path.basename(seg_path), buffer.saved,
+                         buffer.size - buffer.saved))
+    buffer.segments = segments
+    buffer.saved = buffer.size
+    return {'index': buffer.index, 'segments': segments}
+
+
+def read_rows(description, path):
+    """ Rebuilds a buffer described by write_rows for the checkpoint at
+    path. """
+    path = os.path.abspath(path)
+    buffer = ColumnBuffer(index=description['index'])
+    for file_name, start, nrows in description['segments']:
+        rows = read_pickle(os.path.join(os.path.dirname(path), file_name))
+        buffer.append(dict((col, values[:nrows])
+                           for col, values in rows.items()))
+    buffer.saved = buffer.size
+    buffer.segments = list(description['segments'])
+    buffer.checkpoint_path = path
+    return buffer
+
+
+def remove_stale_rows(path, descriptions):
+    """ Removes segment files beside the checkpoint at path that are not
+    referenced by descriptions. """
+    path = os.path.abspath(path)
+    directory = os.path.dirname(path)
+    prefix = os.path.basename(path) + '.'
+    keep = set(file_name for description in descriptions
+               for file_name, start, nrows in description['segments'])
+    for file_name in os.listdir(directory):
+        if (file_name.startswith(prefix) and file_name.endswith('.rows')
+                and file_name not in keep):
+            os.remove(os.path.join(directory, file_name))
+
+
+def write_checkpoint(state, path, buffers=None, compresslevel=4):
+    """ Writes the dictionary state to path as a gzip compressed pickle.
+    The file is first written to a temporary file in the same directory and
+    then moved into place, so an interrupted write never replaces an
+    existing checkpoint with a partial one.
+
+    buffers is an optional dictionary of ColumnBuffer objects keyed by name,
+    which are written incrementally: only rows appended since the last
+    checkpoint to path are written, to a new segment file beside path, and
+    segments no longer needed are removed once the checkpoint is in
+    place. """
+    descriptions = {}
+    if buffers is not None:
+        for name, buffer in buffers.items():
+            descriptions[name] = write_rows(buffer, name, path,
+                                            compresslevel)
+    state = dict(state, version=CHECKPOINT_VERSION, buffers=descriptions)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(fd)
+    try:
+        write_pickle(state, tmp_path, compresslevel)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    remove_stale_rows(path, descriptions.values())
+
+
+def read_checkpoint(path):
+    """ Reads the dictionary of tracking state written by write_checkpoint.
+    Buffers written incrementally are rebuilt and returned in the
+    dictionary under buffers. """
+    state = read_pickle(path)
+    if state.get('version') != CHECKPOINT_VERSION:
+        raise ValueError(
+            'Unsupported checkpoint version {}.'.format(state.get('version'))
+        )
+    state['buffers'] = dict(
+        (name, read_rows(description, path))
+        for name, description in state['buffers'].items()
+    )
+    return state
@@ -0,0 +1,200 @@
+"""
+tint.chunking
+=============
+
+Tools for tracking a long sequence of grids in parallel time chunks, and
+stitching the chunk tracks back into one tracks dataframe.
+
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyart
+
+
+def get_segment_starts(times, max_interval):
+    """ Returns the indices at which tracking restarts because of a time
+    discontinuity. When the interval between scans i-1 and i exceeds
+    max_interval, get_tracks assigns new uids to the objects in scan i-1,
+    so scan i-1 begins a new segment. """
+    starts = [0]
+    for i in range(1, len(times)):
+        if (times[i] - times[i-1]).seconds > max_interval:
+            if i-1 > starts[-1]:
+                starts.append(i-1)
+    return starts
+
+
+def get_chunks(n_scans, chunk_size, overlap, times=None, max_interval=1700):
+    """ Splits n_scans scans into chunks. Returns a list of dictionaries
+    with keys lo, hi, own_lo and own_hi. Each chunk is tracked over the
+    scans lo to hi - 1, but only contributes its tracks for the scans
+    own_lo to own_hi - 1. Chunks start at time discontinuities where
+    times are given, and long segments are split into chunks of
+    chunk_size scans that are tracked overlap scans beyond each end. """
+    if times is None:
+        starts = [0]
+    else:
+        starts = get_segment_starts(times, max_interval)
+    ends = starts[1:] + [n_scans]
+
+    chunks = []
+    for seg_lo, seg_hi in zip(starts, ends):
+        # The final scan of a chunk is dropped by post_tracks, so each
+        # segment is tracked one scan past its end.
+        seg_stop = min(seg_hi + 1, n_scans)
+        for own_lo in range(seg_lo, seg_hi, chunk_size):
+            own_hi = min(own_lo + chunk_size, seg_hi)
+            chunks.append({'lo': max(own_lo - overlap, seg_lo),
+                           'hi': min(own_hi + overlap + 1, seg_stop),
+                           'own_lo': own_lo, 'own_hi': own_hi})
+    return chunks
+
+
+def track_chunk(tracks_obj, files, reader, rain):
+    """ Tracks the grids in files using tracks_obj and returns the tracks
+    dataframe and record. tracks_obj should not have been used to track
+    any grids yet. """
+    grids = (reader(file_name) for file_name in files)
+    tracks_obj.get_tracks(grids, rain=rain, save_rain=False)
+    return tracks_obj.tracks, tracks_obj.record
+
+
+def relabel_tracks(tracks, uid_map, scan_offset):
+    """ Returns a copy of tracks with uids (including those in the mergers
+    and parent columns) replaced using uid_map, and scan numbers shifted by
+    scan_offset. """
+    tracks = tracks.copy()
+    scan = tracks.index.get_level_values('scan') + scan_offset
+    uid = [uid_map[u] for u in tracks.index.get_level_values('uid')]
+    tracks.index = pd.MultiIndex.from_arrays(
+        [scan, tracks.index.get_level_values('time'),
+         tracks.index.get_level_values('level'), uid],
+        names=tracks.index.names
+    )
+    for col in ['mergers', 'parent']:
+        tracks[col] = [set(uid_map[u] for u in uids) for uids in tracks[col]]
+    return tracks
+
+
+def get_chunk_uids(tracks):
+    """ Returns the set of uids appearing in the index, mergers or parent
+    sets of tracks. """
+    uids = set(tracks.index.get_level_values('uid'))
+    for col in ['mergers', 'parent']:
+        for uid_set in tracks[col]:
+            uids = uids.union(uid_set)
+    return uids
+
+
+def match_overlap_uids(prev_tracks, tracks, own_lo, level, tol):
+    """ Maps uids in tracks to uids in prev_tracks by matching objects at
+    the same scan, in the scans before own_lo, whose positions (grid_x,
+    grid_y) are within tol meters. Both dataframes must already use global
+    scan numbers. Matches closest to own_lo take precedence, then the
+    closest in position. """
+    overlap = []
+    for df in [prev_tracks, tracks]:
+        df = df.xs(level, level='level')
+        df = pd.DataFrame({
+            'scan': df.index.get_level_values('scan'),
+            'uid': df.index.get_level_values('uid'),
+            'grid_x': df['grid_x'].values, 'grid_y': df['grid_y'].values
+        })
+        overlap.append(df[df['scan'] < own_lo])
+    matched = overlap[1].merge(overlap[0], on='scan',
+                               suffixes=('_new', '_old'))
+    matched['dist'] = np.hypot(matched['grid_x_new'] - matched['grid_x_old'],
+                               matched['grid_y_new'] - matched['grid_y_old'])
+    matched = matched[matched['dist'] <= tol]
+    matched = matched.sort_values(['scan', 'dist'], ascending=[False, True],
+                                  kind='mergesort')
+
+    uid_map = {}
+    used = set()
+    for new_uid, old_uid in zip(matched['uid_new'], matched['uid_old']):
+        if new_uid not in uid_map and old_uid not in used:
+            uid_map[new_uid] = old_uid
+            used.add(old_uid)
+    return uid_map
+
+
+def get_uid_order(tracks, uids):
+    """ Returns uids sorted by the first scan in which they appear in
+    tracks, then by order of appearance. Uids only found in mergers or
+    parent sets come last. """
+    first = {}
+    index = zip(tracks.index.get_level_values('scan'),
+                tracks.index.get_level_values('uid'))
+    for pos, (scan, uid) in enumerate(index):
+        if uid not in first or scan < first[uid][0]:
+            first[uid] = (scan, pos)
+    last = (np.inf, np.inf)
+    return sorted(uids, key=lambda uid: (first.get(uid, last), str(uid)))
+
+
+def stitch_tracks(chunks, results, level, tol):
+    """ Stitches chunk tracks into a single tracks dataframe with globally
+    consistent uids and scan numbers. Uids in each chunk are matched to
+    those of the previous chunk over the overlapping scans, for objects
+    within tol meters of each other; unmatched uids are assigned new global
+    uids in order of first appearance. """
+    pieces = []
+    prev_tracks = None
+    next_uid = 0
+    for chunk, tracks in zip(chunks, results):
+        if len(tracks) == 0:
+            continue
+        shifted = relabel_tracks(
+            tracks, dict((u, u) for u in get_chunk_uids(tracks)), chunk['lo']
+        )
+        if prev_tracks is None:
+            uid_map = {}
+        else:
+            uid_map = match_overlap_uids(prev_tracks, shifted,
+                                         chunk['own_lo'], level, tol)
+        new_uids = get_uid_order(tracks,
+                                 get_chunk_uids(tracks) - set(uid_map))
+        for uid in new_uids:
+            uid_map[uid] = str(next_uid)
+            next_uid += 1
+
+        prev_tracks = relabel_tracks(tracks, uid_map, chunk['lo'])
+        scan = prev_tracks.index.get_level_values('scan')
+        owned = (scan >= chunk['own_lo']) & (scan < chunk['own_hi'])
+        pieces.append(prev_tracks[owned])
+
+    if len(pieces) == 0:
+        return pd.DataFrame()
+    return pd.concat(pieces).sort_index()
+
+
+def get_chunked_tracks(tracks_obj, files, chunk_size, overlap, times=None,
+                       max_interval=1700, workers=None, reader=None,
+                       rain=True):
+    """ Tracks the grids in files in independent time chunks, in parallel
+    using a pool of worker processes, and stitches the results. Returns
+    the stitched tracks dataframe and the record of the final chunk. The
+    dataframe is empty if no objects are found in any chunk. """
+    if len(files) == 0:
+        raise ValueError('No grid files to track.')
+    if reader is None:
+        reader = pyart.io.read_grid
+    chunks = get_chunks(len(files), chunk_size, overlap, times, max_interval)
+    chunk_files = [files[chunk['lo']:chunk['hi']] for chunk in chunks]
+    n = len(chunks)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(
+            track_chunk, [tracks_obj] * n, chunk_files, [reader] * n,
+            [rain] * n
+        ))
+
+    # Objects in overlapping scans are segmented identically by each
+    # chunk, so their positions only differ by floating point error.
+    tol = np.min(results[-1][1].grid_size[1:]) / 2
+    tracks = stitch_tracks(chunks, [result[0] for result in results],
+                           tracks_obj.params['TRACK_INTERVAL'], tol)
+    return tracks, results[-1][1]
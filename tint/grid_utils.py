@@ -10,10 +10,8 @@ Tools for pulling data from pyart grids.
 import datetime
 
 import numpy as np
-import pandas as pd
 from scipy import ndimage
-import networkx 
-from networkx.algorithms.components.connected import connected_components
+from pyart.core.transforms import cartesian_to_geographic
 from numba import jit
 from numba import int32
 import copy
@@ -92,35 +90,172 @@ def get_filtered_frame_steiner(grid_obj, field, grid_size, min_size,
 
 def clear_small_echoes(label_image, min_size):
     """ Takes in binary image and clears objects less than min_size. """
-    flat_image = pd.Series(label_image.flatten())
-    flat_image = flat_image[flat_image > 0]
-    size_table = flat_image.value_counts(sort=False)
-    small_objects = size_table.keys()[size_table < min_size]
-
-    for obj in small_objects:
-        label_image[label_image == obj] = 0
+    size_table = np.bincount(label_image.ravel())
+    small_objects = size_table < min_size
+    small_objects[0] = False
+    label_image[small_objects[label_image]] = 0
     label_image = ndimage.label(label_image)
     return label_image[0]
     
 def clear_small_echoes_system(images_con, min_sizes):
     """ Takes in binary image and clears objects less than min_size. """
-    small_objects = set()
+    n_labels = images_con.max() + 1
+    small_objects = np.zeros(n_labels, dtype=bool)
     for i in range(len(min_sizes)):
-        flat_image = pd.Series(images_con[i].flatten())
-        flat_image = flat_image[flat_image > 0]
-        size_table = flat_image.value_counts(sort=False)
-        small_objects_i = set(size_table.keys()[size_table < min_sizes[i]])
-        small_objects = small_objects.union(small_objects_i)
-
-    for obj in small_objects:
-        images_con[images_con == obj] = 0
-    
-    relabeled_images_con = np.zeros(images_con.shape, dtype=int)
-    
-    for new_objs, old_objs in enumerate(set(images_con.flatten().tolist())):
-        relabeled_images_con[images_con == old_objs] = new_objs
-    
-    return relabeled_images_con
+        size_table = np.bincount(images_con[i].ravel(), minlength=n_labels)
+        small_objects |= (size_table > 0) & (size_table < min_sizes[i])
+    small_objects[0] = False
+    images_con[small_objects[images_con]] = 0
+
+    # Remaining labels are numbered in the iteration order of a set built
+    # from the image, as they always have been. Building the set from the
+    # labels in order of first appearance gives the same order.
+    labels, first = np.unique(images_con, return_index=True)
+    labels = labels[np.argsort(first)]
+    new_labels = np.zeros(n_labels, dtype=int)
+    for new_obj, old_obj in enumerate(set(labels.tolist())):
+        new_labels[old_obj] = new_obj
+
+    return new_labels[images_con]
+
+class ScanProducts(object):
+    """
+    ScanProducts objects hold fields derived from a single scan, so that
+    each is computed at most once per scan. Level indices and Steiner
+    classes are filled by extract_grid_data; the other fields are computed
+    from the scan data on first request. Only derived fields are held, so
+    that extraction workers do not send the grid data back with them.
+
+    Attributes
+    ----------
+    level_indices : list
+        z_min and z_max indices of each level interval. See
+        get_level_indices.
+    sclasses : list
+        Steiner classification of each level interval, or None for levels
+        not classified by extraction.
+    steiner : dict
+        Steiner classification of the unmodified data at single vertical
+        levels, keyed by level index.
+    max_proj : array
+        Column maximum of the scan data.
+    smooth_max_proj : dict
+        Gaussian smoothed max_proj, keyed by smoothing parameter.
+
+    """
+
+    def __init__(self, level_indices):
+        n_levels = len(level_indices)
+        self.level_indices = level_indices
+        self.sclasses = [None]*n_levels
+        self.steiner = {}
+        self.max_proj = None
+        self.smooth_max_proj = {}
+
+    def get_steiner(self, raw3D, z, x, y, dx, dy):
+        """ Returns the Steiner classification of raw3D at level index z. """
+        if z not in self.steiner:
+            self.steiner[z] = steiner_conv_strat(raw3D[z], x, y, dx, dy)
+        return self.steiner[z]
+
+    def get_max_proj(self, raw3D):
+        """ Returns the maximum of raw3D over the vertical axis. """
+        if self.max_proj is None:
+            self.max_proj = np.max(raw3D, axis=0)
+        return self.max_proj
+
+    def get_smooth_max_proj(self, raw3D, sigma):
+        """ Returns the maximum projection of raw3D with Gaussian smoothing
+        of standard deviation sigma. """
+        if sigma not in self.smooth_max_proj:
+            self.smooth_max_proj[sigma] = ndimage.gaussian_filter(
+                self.get_max_proj(raw3D), sigma
+            )
+        return self.smooth_max_proj[sigma]
+
+
+class GridGeometry(object):
+    """
+    GridGeometry objects hold quantities that depend only on the geometry
+    of a grid, so that they are computed once for a sequence of grids
+    sharing it. See get_grid_geometry.
+
+    Attributes
+    ----------
+    key : tuple
+        Origin, projection, coordinates and levels the geometry was built
+        from. See get_geometry_key.
+    projparams : dict
+        Projection parameters of the grid.
+    level_indices : list
+        z_min and z_max indices of each level interval. See
+        get_level_indices.
+    x : array
+        x coordinates of the grid in meters.
+    y : array
+        y coordinates of the grid in meters.
+    lon : array
+        Longitude of each grid point, computed on first request through
+        get_grid_lonlat.
+    lat : array
+        Latitude of each grid point, computed with lon.
+
+    """
+
+    def __init__(self, grid_obj, grid_size, params):
+        self.key = get_geometry_key(grid_obj, params)
+        self.projparams = grid_obj.get_projparams()
+        self.level_indices = [get_level_indices(grid_obj, grid_size, levels)
+                              for levels in params['LEVELS']]
+        self.x = grid_obj.x['data']
+        self.y = grid_obj.y['data']
+        self.lon = None
+        self.lat = None
+
+    def get_geographic(self, x, y):
+        """ Returns the longitude and latitude of arrays of points with
+        cartesian coordinates x and y, in one call. """
+        return cartesian_to_geographic(np.asarray(x), np.asarray(y),
+                                       self.projparams)
+
+    def get_grid_lonlat(self):
+        """ Returns the longitude and latitude of every grid point, as
+        arrays of shape (ny, nx). """
+        if self.lon is None:
+            x, y = np.meshgrid(self.x, self.y)
+            self.lon, self.lat = self.get_geographic(x, y)
+        return self.lon, self.lat
+
+
+def get_geometry_key(grid_obj, params):
+    """ Returns a tuple identifying the geometry of a grid: its origin,
+    projection, x, y and z coordinates, and the levels of params. """
+    projection = tuple(sorted(
+        (k, str(v)) for k, v in grid_obj.get_projparams().items()
+    ))
+    return (float(grid_obj.origin_latitude['data'][0]),
+            float(grid_obj.origin_longitude['data'][0]),
+            projection,
+            np.asarray(grid_obj.x['data']).tobytes(),
+            np.asarray(grid_obj.y['data']).tobytes(),
+            np.asarray(grid_obj.z['data']).tobytes(),
+            np.asarray(params['LEVELS']).tobytes())
+
+
+def get_grid_geometry(grid_obj, grid_size, params, cache=None):
+    """ Returns the GridGeometry of a grid, which is cache, a GridGeometry
+    object from an earlier grid, if the geometry is unchanged. """
+    if cache is not None and cache.key == get_geometry_key(grid_obj, params):
+        return cache
+    return GridGeometry(grid_obj, grid_size, params)
+
+
+def get_scan_products(grid_obj, grid_size, params, geometry=None):
+    """ Returns an empty ScanProducts object for a grid, holding the level
+    indices of each level interval in params['LEVELS']. Level indices are
+    taken from geometry, a GridGeometry object, if it is given. """
+    geometry = get_grid_geometry(grid_obj, grid_size, params, geometry)
+    return ScanProducts(list(geometry.level_indices))
 
 def get_level_indices(grid_obj, grid_size, levels):
     """ Returns indices corresponding to the inclusive range
@@ -132,6 +267,38 @@ def get_level_indices(grid_obj, grid_size, levels):
         z_max = None   
     return z_min, z_max
 
+def get_overlap_pairs(frames):
+    """ Returns two arrays giving the distinct pairs of object labels in
+    adjacent level intervals that share at least one pixel. """
+    n_labels = frames.max() + 1
+    codes = []
+    for i in range(frames.shape[0]-1):
+        both = (frames[i] > 0) & (frames[i+1] > 0)
+        codes.append(np.unique(frames[i][both]*n_labels + frames[i+1][both]))
+    if len(codes) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    codes = np.concatenate(codes)
+    return codes // n_labels, codes % n_labels
+
+def get_component_roots(pairs, n_labels):
+    """ Union-find over label pairs. Returns an array giving, for each
+    label, the smallest label in its connected component. """
+    roots = np.arange(n_labels)
+    left, right = pairs
+    while True:
+        # Compress paths so that every label points directly at its root
+        parents = roots[roots]
+        while not np.array_equal(parents, roots):
+            roots = parents
+            parents = roots[roots]
+        link = np.minimum(roots[left], roots[right])
+        if np.array_equal(link, roots[left]) and np.array_equal(link, 
+                                                               roots[right]):
+            return roots
+        # Attach the root of each pair to the smaller of the two roots
+        np.minimum.at(roots, roots[left], link)
+        np.minimum.at(roots, roots[right], link)
+
 def get_connected_components(frames):
     """ Take the frames at each level interval and calculate connected 
     components."""
@@ -140,74 +307,67 @@ def get_connected_components(frames):
     for i in range(1,frames.shape[0]):
             frames[i,frames[i]>0] += np.cumsum(f_maxes[:-1])[i-1]
 
-    # Create graph for cells that overlap at different vertical levels.
-    overlap_graph = networkx.Graph()
+    # Join objects that overlap vertically into components.
+    n_labels = frames.max() + 1
+    pairs = get_overlap_pairs(frames)
+    roots = get_component_roots(pairs, n_labels)
+
+    # Objects labelled total_objs or above only belong to a component if 
+    # they overlap another object.
     total_objs = frames[-1].max()
-    overlap_graph.add_nodes_from(set(range(1, total_objs)))
+    in_graph = np.arange(n_labels) < total_objs
+    in_graph[pairs[0]] = True
+    in_graph[pairs[1]] = True
+    in_graph[0] = False
+    roots[~in_graph] = 0
 
-    # Create edges between the objects that overlap vertically.
-    for i in range(frames.shape[0]-1):
-        # Determine the objects in frame i.
-        objects = set(frames[i][frames[i]>0])
-        # Determine the objects in frame i+1.
-        objects_next = set(frames[i+1][frames[i+1]>0])
-        for j in range(len(list(objects))):
-            overlap = np.logical_and(frames[i] == list(objects)[j], 
-                                     frames[i+1] > 0)
-            overlap_objs = set((frames[i+1][overlap]).flatten())
-            # If objects overlap, add edge between object j and first 
-            # object from overlap set
-            if bool(overlap_objs):
-                overlap_graph.add_edges_from(
-                    [(list(objects)[j], list(overlap_objs)[0])]
-                )
-                # Add edges between objects in overlap set
-                for k in range(0, len(list(overlap_objs))-1):
-                    overlap_graph.add_edges_from(
-                        [(list(overlap_objs)[k], list(overlap_objs)[k+1])]
-                    )  
-    
-    # Create new objects based on connected components 
-    new_objs = list(connected_components(overlap_graph))
-    frames_con = np.zeros(frames.shape, dtype=int)
-    for i in range(len(new_objs)):
-        frames_con[np.isin(frames, list(new_objs[i]))] = i + 1
-
-    # Require that objects be present in all vertical level intervals    
-    new_objs = list(set(frames_con[frames_con>0].flatten()))
-    object_counter = 1
-    for i in range(len(new_objs)):
-        if np.all(np.any(frames_con == new_objs[i], axis=(1,2))):
-            frames_con[frames_con == new_objs[i]] = object_counter
-            object_counter += 1
-        else:
-            frames_con[frames_con == new_objs[i]] = 0
+    # Require that objects be present in all vertical level intervals. 
+    # Components are numbered in order of their smallest label.
+    present = np.ones(n_labels, dtype=bool)
+    for i in range(frames.shape[0]):
+        present_i = np.zeros(n_labels, dtype=bool)
+        present_i[roots[frames[i]]] = True
+        present &= present_i
+    present[0] = False
+    new_labels = np.zeros(n_labels, dtype=int)
+    new_labels[present] = np.arange(1, present.sum() + 1)
+    frames_con = new_labels[roots][frames]
 
     return frames_con, frames
 
-def extract_grid_data(grid_obj, field, grid_size, params, rain):
-    """ Returns filtered grid frame and raw grid slice at global shift
-    altitude. """
-    
+def zero_fill_values(grid_obj, field, rain):
+    """ Sets fill values and nans in the tracked field, and the rain rate
+    field if rain is True, to zero in place. Returns the masked arrays. """
     masked = grid_obj.fields[field]['data']
     # Note this won't work if fill_value is nan!
     masked.data[(masked.data == masked.fill_value) 
                 | np.isnan(masked.data)] = 0
+    if not rain:
+        return masked, None
+    masked_rain = grid_obj.fields['radar_estimated_rain_rate']['data']
+    masked_rain.data[(masked_rain.data == masked_rain.fill_value) 
+                     | np.isnan(masked_rain.data)] = 0
+    return masked, masked_rain
+
+def extract_grid_data(grid_obj, field, grid_size, params, rain,
+                      geometry=None):
+    """ Returns filtered grid frame and raw grid slice at global shift
+    altitude, together with a ScanProducts object holding fields derived
+    along the way. geometry is an optional GridGeometry object of an
+    earlier grid; see get_grid_geometry. """
+    
+    masked, masked_rain = zero_fill_values(grid_obj, field, rain)
     gs_alt = params['GS_ALT']
     raw = masked.data[get_grid_alt(grid_size, gs_alt), :, :]
     
     if rain:
-        masked_rain = grid_obj.fields['radar_estimated_rain_rate']['data']
-        # Note this won't work if fill_value is nan!
-        masked_rain.data[(masked_rain.data == masked_rain.fill_value) 
-                    | np.isnan(masked_rain.data)] = 0
         raw_rain = masked_rain.data[0, :, :]
     else:
         raw_rain=np.nan
     
     n_levels = params['LEVELS'].shape[0]
     frames = np.zeros([n_levels, grid_obj.nx, grid_obj.ny], dtype=int)
-    sclasses = [None]*n_levels
+    products = get_scan_products(grid_obj, grid_size, params, geometry)
     
     min_sizes = params['MIN_SIZE'] / np.prod(grid_size[1:]/1000)
 
@@ -216,15 +376,13 @@ def extract_grid_data(grid_obj, field, grid_size, params, rain):
     # absolutely necessary
     for i in range(frames.shape[0]-1, -1, -1):
         
-        [z_min, z_max] = get_level_indices(
-            grid_obj, grid_size, params['LEVELS'][i,:]
-        )
+        [z_min, z_max] = products.level_indices[i]
         if np.any(masked.data[z_min:z_max] > 0):
             if params['FIELD_THRESH'][i] == 'convective':
                 frames[i], sclass = get_filtered_frame_steiner(
                     grid_obj, field, grid_size, min_sizes[i], z_min, z_max
                 )
-                sclasses[i] = sclass
+                products.sclasses[i] = sclass
             else: 
                 frames[i] = get_filtered_frame(
                     masked.data, min_sizes[i],
@@ -240,4 +398,4 @@ def extract_grid_data(grid_obj, field, grid_size, params, rain):
     # Clear small echos
     frames_con = clear_small_echoes_system(frames_con, min_sizes)
 
-    return raw, raw_rain, frames_con, frames, sclasses
+    return raw, raw_rain, frames_con, frames, products
@@ -4,6 +4,7 @@ tint.helpers
 
 """
 
+import numbers
 import string
 
 import numpy as np
@@ -50,6 +51,138 @@ class Counter(object):
         return pid + letter
 
 
+class ColumnBuffer(object):
+    """
+    ColumnBuffer objects accumulate rows of a table in one growable buffer
+    per column, so that appending rows does not copy the rows already held.
+    Numeric columns are stored in numpy arrays whose capacity doubles when
+    full, and all other columns are stored in lists. The dataframe is only
+    built when to_frame is called.
+
+    Attributes
+    ----------
+    index : list of str
+        Columns used as the index of the dataframe built by to_frame.
+    size : int
+        Number of rows held.
+    columns : dict
+        Buffer for each column, keyed by column name, in order of first
+        appearance. Arrays may be longer than size.
+    saved : int
+        Number of leading rows already written to checkpoint_path, and
+        unchanged since. See tint.checkpoint.
+    segments : list
+        Files holding those rows, as tuples of file name, first row, and
+        number of rows.
+    checkpoint_path : str
+        Checkpoint the rows were written for, or None.
+
+    """
+
+    def __init__(self, index=None):
+        self.index = index
+        self.size = 0
+        self.columns = {}
+        self.column_order = []
+        self.saved = 0
+        self.segments = []
+        self.checkpoint_path = None
+
+    def __len__(self):
+        return self.size
+
+    def append(self, rows):
+        """ Appends rows given as a dictionary of equal length lists or
+        arrays keyed by column name. Other values are repeated for every
+        row. Every column already held must be given. Columns first given
+        after rows have been appended are back-filled with nan, or None for
+        non-numeric columns. """
+        missing = [col for col in self.column_order if col not in rows]
+        if missing:
+            raise ValueError('Rows are missing columns: {}.'.format(
+                ', '.join(missing)
+            ))
+        n = None
+        for values in rows.values():
+            if isinstance(values, (list, tuple, np.ndarray)):
+                n = len(values)
+                break
+        if n is None:
+            n = 1
+        for col, values in rows.items():
+            if not isinstance(values, (list, tuple, np.ndarray)):
+                values = [values] * n
+            self._append_column(col, values, n)
+        self.size += n
+
+    def _append_column(self, col, values, n):
+        """ Appends n values to the buffer of column col, creating or
+        converting the buffer as needed. """
+        numeric = is_numeric(values)
+        if col not in self.columns:
+            self.column_order.append(col)
+            if numeric and self.size > 0:
+                dtype = np.result_type(np.asarray(values).dtype, np.float64)
+                self.columns[col] = np.full(self.size, np.nan, dtype=dtype)
+            elif numeric:
+                self.columns[col] = np.empty(0, dtype=np.asarray(values).dtype)
+            else:
+                self.columns[col] = [None] * self.size
+        buffer = self.columns[col]
+
+        if isinstance(buffer, list):
+            buffer.extend(values)
+            return
+        if not numeric:
+            self.columns[col] = buffer[:self.size].tolist() + list(values)
+            return
+
+        values = np.asarray(values)
+        dtype = np.result_type(buffer.dtype, values.dtype)
+        if self.size + n > len(buffer) or dtype != buffer.dtype:
+            capacity = max(2*len(buffer), self.size + n, 16)
+            grown = np.empty(capacity, dtype=dtype)
+            grown[:self.size] = buffer[:self.size]
+            buffer = grown
+            self.columns[col] = buffer
+        buffer[self.size:self.size + n] = values
+
+    def truncate(self, size):
+        """ Discards all rows after the first size rows. """
+        size = min(size, self.size)
+        for col, buffer in self.columns.items():
+            if isinstance(buffer, list):
+                del buffer[size:]
+        self.size = size
+        self.saved = min(self.saved, size)
+
+    def get_column(self, col):
+        """ Returns the values held for column col. """
+        return self.columns[col][:self.size]
+
+    def to_frame(self, start=0, sort=True):
+        """ Builds a dataframe of the rows from start onwards, indexed
+        by the index columns and optionally sorted by index. """
+        frame = pd.DataFrame(dict(
+            (col, self.columns[col][start:self.size])
+            for col in self.column_order
+        ), columns=self.column_order)
+        if self.index is not None and self.size > start:
+            frame.set_index(self.index, inplace=True)
+            if sort:
+                frame.sort_index(inplace=True)
+        return frame
+
+
+def is_numeric(values):
+    """ Returns True if values is a non-empty flat sequence of numbers. """
+    if isinstance(values, np.ndarray):
+        return values.ndim == 1 and values.dtype.kind in 'biuf'
+    return len(values) > 0 and all(
+        isinstance(val, (numbers.Number, np.bool_)) for val in values
+    )
+
+
 class Record(object):
     """
     Record objects keep track of information related to the shift correction
@@ -69,8 +202,19 @@ class Record(object):
         Length 3 array containing z, y, and x mesh size in meters.
     shifts : dataframe
         Records inputs of shift correction process. See matching.correct_shift.
-    new_shfits : dataframe
-        Row of new shifts to be added to shifts dataframe.
+        Built on access from shift_buffer.
+    shift_buffer : ColumnBuffer
+        Accumulates rows of the shifts dataframe.
+    new_shifts : list
+        Shifts recorded for the current scan, to be added to shift_buffer
+        once object uids are known.
+    motion : dataframe
+        Motion field of each scan tracked with the tiled flow mode, giving
+        u and v in meters per second for each tile, indexed by scan and
+        the row and column of the tile center. Built on access from
+        motion_buffer.
+    motion_buffer : ColumnBuffer
+        Accumulates rows of the motion dataframe.
     correction_tally : dict
         Tallies correction cases for performance analysis.
 
@@ -91,8 +235,9 @@ class Record(object):
         self.interval = None
         self.interval_ratio = None
         self.grid_size = get_grid_size(grid_obj)
-        self.shifts = pd.DataFrame()
-        self.new_shifts = pd.DataFrame()
+        self.shift_buffer = ColumnBuffer(index=['scan', 'uid'])
+        self.new_shifts = []
+        self.motion_buffer = ColumnBuffer(index=['scan', 'row', 'col'])
         self.correction_tally = {'case0': 0, 'case1': 0, 'case2': 0,
                                  'case3': 0, 'case4': 0, 'case5': 0}
 
@@ -109,26 +254,57 @@ class Record(object):
         if l_heads is None:
             l_heads = np.ma.array([-999, -999], mask=[True, True])
 
-        new_shift_record = pd.DataFrame()
-        new_shift_record['scan'] = [self.scan]
-        new_shift_record['uid'] = ['uid']
-        new_shift_record['corrected'] = [corr]
-        new_shift_record['global'] = [gl_shift]
-        new_shift_record['last_heads'] = [l_heads]
-        new_shift_record['phase'] = [local_shift]
-        new_shift_record['case'] = [case]
-
-        self.new_shifts = self.new_shifts.append(new_shift_record)
+        self.new_shifts.append((corr, gl_shift, l_heads, local_shift, case))
 
     def add_uids(self, current_objects):
         """ Because of the chronology of the get_tracks process, object uids
         cannot be added to the shift record at the time of correction, so they
         must be added later in the process. """
         if len(self.new_shifts) > 0:
-            self.new_shifts['uid'] = current_objects['uid']
-            self.new_shifts.set_index(['scan', 'uid'], inplace=True)
-            self.shifts = self.shifts.append(self.new_shifts)
-            self.new_shifts = pd.DataFrame()
+            columns = list(zip(*self.new_shifts))
+            self.shift_buffer.append({
+                'scan': self.scan,
+                'uid': list(current_objects['uid']),
+                'corrected': list(columns[0]),
+                'global': list(columns[1]),
+                'last_heads': list(columns[2]),
+                'phase': list(columns[3]),
+                'case': list(columns[4])
+            })
+            self.new_shifts = []
+
+    @property
+    def shifts(self):
+        """ Dataframe of all recorded shifts, indexed by scan and uid. """
+        return self.shift_buffer.to_frame(sort=False)
+
+    def record_motion(self, motion_field):
+        """ Records the motion field of the current scan, converting tile
+        flow vectors to velocities. See get_motion_field in
+        tint.phase_correlation. The motion field is not recorded if the
+        interval to the next scan is not positive, as velocities are then
+        undefined. """
+        seconds = self.interval.total_seconds()
+        if seconds <= 0:
+            return
+        size_r, size_c = motion_field['size']
+        rows = motion_field['row_starts'] + (size_r - 1) / 2
+        cols = motion_field['col_starts'] + (size_c - 1) / 2
+        rows, cols = np.meshgrid(rows, cols, indexing='ij')
+        velocity = motion_field['shifts'] * self.grid_size[1:] / seconds
+        self.motion_buffer.append({
+            'scan': self.scan,
+            'row': rows.ravel(),
+            'col': cols.ravel(),
+            'u': velocity[:, :, 1].ravel(),
+            'v': velocity[:, :, 0].ravel()
+        })
+
+    @property
+    def motion(self):
+        """ Dataframe of all recorded motion fields, indexed by scan and
+        tile center. """
+        return self.motion_buffer.to_frame(sort=False)
 
     def update_scan_and_time(self, grid_obj1, grid_obj2=None):
         """ Updates the scan number and associated time. This information is
@@ -9,9 +9,12 @@ Functions for object matching between adjacent radar scans.
 import numpy as np
 
 from scipy import optimize
+from scipy import ndimage
+from scipy.spatial import cKDTree
 
-from .phase_correlation import get_ambient_flow
-from .objects import get_obj_extent
+from .phase_correlation import get_ambient_flows, get_field_flow
+from .objects import get_obj_extents
+from .grid_utils import get_component_roots
 
 
 LARGE_NUM = 1000
@@ -27,24 +30,11 @@ def euclidean_dist(vec1, vec2):
 
 def get_sizeChange(size1, size2):
     """ Returns change in size of an echo as the ratio of the larger size to
-    the smaller, minus 1. """
-    if (size1 < 5) and (size2 < 5):
-        return 0
-    elif size1 >= size2:
-        return size1/size2 - 1
-    else:
-        return size2/size1 - 1
-
-
-def find_objects(search_box, image2):
-    """ Identifies objects found in the search region. """
-    if not search_box['valid']:
-        obj_found = np.array(-1)
-    else:
-        search_area = image2[search_box['x1']:search_box['x2'],
-                             search_box['y1']:search_box['y2']]
-        obj_found = np.unique(search_area)
-    return obj_found
+    the smaller, minus 1. Sizes may be arrays. """
+    size1 = np.asarray(size1)
+    size2 = np.asarray(size2)
+    change = np.maximum(size1, size2)/np.minimum(size1, size2) - 1
+    return np.where((size1 < 5) & (size2 < 5), 0, change)
 
 
 def shifts_disagree(shift1, shift2, record, params):
@@ -122,67 +112,99 @@ def correct_shift(local_shift, current_objects, obj_id1, global_shift, record,
     return corrected_shift
 
 
-def predict_search_extent(obj1_extent, shift, params, grid_size):
-    """ Predicts search extent/region for the object in image2 given
-    the image shift. """
-    shifted_center = obj1_extent['obj_center'] + shift
+def get_search_boxes(obj_centers, shifts, params, grid_size, img_dims):
+    """ Predicts the search box in image2 of every object given the object
+    centers and shifts, each an array with one row per object. Boxes are
+    clipped to the edges of the frame, and marked as invalid if too
+    small. Returns a dictionary of arrays. """
+    center_pred = obj_centers + shifts
     search_radius_r = params['SEARCH_MARGIN'] / grid_size[1]
     search_radius_c = params['SEARCH_MARGIN'] / grid_size[2]
-    x1 = shifted_center[0] - search_radius_r
-    x2 = shifted_center[0] + search_radius_r + 1
-    y1 = shifted_center[1] - search_radius_c
-    y2 = shifted_center[1] + search_radius_c + 1
-    x1 = np.int(x1)
-    x2 = np.int(x2)
-    y1 = np.int(y1)
-    y2 = np.int(y2)
+    x1 = (center_pred[:, 0] - search_radius_r).astype(int)
+    x2 = (center_pred[:, 0] + search_radius_r + 1).astype(int)
+    y1 = (center_pred[:, 1] - search_radius_c).astype(int)
+    y2 = (center_pred[:, 1] + search_radius_c + 1).astype(int)
+    x1 = np.maximum(x1, 0)
+    y1 = np.maximum(y1, 0)
+    x2 = np.minimum(x2, img_dims[0])
+    y2 = np.minimum(y2, img_dims[1])
+    valid = (x2 - x1 >= 5) & (y2 - y1 >= 5)
     return {'x1': x1, 'x2': x2, 'y1': y1, 'y2': y2,
-            'center_pred': shifted_center, 'valid': True}
-
-
-def check_search_box(search_box, img_dims):
-    """ Checks if search_box is within the boundaries of the frame. Clips to
-    edges of frame if out of bounds. Marks as invalid if too small. """
-    if search_box['x1'] < 0:
-        search_box['x1'] = 0
-    if search_box['y1'] < 0:
-        search_box['y1'] = 0
-    if search_box['x2'] > img_dims[0]:
-        search_box['x2'] = img_dims[0]
-    if search_box['y2'] > img_dims[1]:
-        search_box['y2'] = img_dims[1]
-    if ((search_box['x2'] - search_box['x1'] < 5) or
-            (search_box['y2'] - search_box['y1'] < 5)):
-        search_box['valid'] = False
-    return search_box
-
-
-def get_disparity(obj_found, image2, search_box, obj1_extent):
-    """ Computes disparities for objects in obj_found. """
-    dist_pred = np.empty(0)
-    change = np.empty(0)
-    for target_obj in obj_found:
-        target_extent = get_obj_extent(image2, target_obj)
-        euc_dist = euclidean_dist(target_extent['obj_center'],
-                                  search_box['center_pred'])
-        dist_pred = np.append(dist_pred, euc_dist)
-        size_changed = get_sizeChange(target_extent['obj_area'],
-                                      obj1_extent['obj_area'])
-        change = np.append(change, size_changed)
+            'center_pred': center_pred, 'valid': valid}
+
+
+def find_all_objects(search_boxes, image2):
+    """ Identifies the objects found in each search region. Returns a list
+    with an array of the labels of objects in image2 with pixels in each
+    search box, or -1 for invalid boxes. Candidates are the objects whose
+    bounding box centers are queried from a KD-tree within the half size of
+    the search box plus the largest bounding box half size, in the maximum
+    norm, so that only nearby objects are compared. Pixels are only checked
+    for candidates whose bounding box is partly outside the search box. """
+    slices = ndimage.find_objects(image2)
+    labels = np.array([i + 1 for i, obj_slice in enumerate(slices)
+                       if obj_slice is not None], dtype=int)
+    bounds = np.array([[slices[obj - 1][0].start, slices[obj - 1][0].stop,
+                        slices[obj - 1][1].start, slices[obj - 1][1].stop]
+                       for obj in labels], dtype=int).reshape(-1, 4).T
+    r1, r2, c1, c2 = bounds
+    x1, x2, y1, y2 = [search_boxes[key]
+                      for key in ['x1', 'x2', 'y1', 'y2']]
+
+    objs_found = [np.array(-1)] * len(x1)
+    valid = np.flatnonzero(search_boxes['valid'])
+    if len(labels) == 0:
+        for k in valid:
+            objs_found[k] = np.array([], dtype=int)
+        return objs_found
+
+    tree = cKDTree(np.stack([r1 + r2, c1 + c2], axis=1) / 2)
+    max_half = max(np.max(r2 - r1), np.max(c2 - c1)) / 2
+    box_centers = np.stack([x1 + x2, y1 + y2], axis=1)[valid] / 2
+    box_half = np.maximum(x2 - x1, y2 - y1)[valid] / 2
+    candidates = tree.query_ball_point(box_centers, box_half + max_half,
+                                       p=np.inf)
+    for k, cand in zip(valid, candidates):
+        cand = np.sort(np.array(cand, dtype=int))
+        overlap = ((r1[cand] < x2[k]) & (r2[cand] > x1[k])
+                   & (c1[cand] < y2[k]) & (c2[cand] > y1[k]))
+        found = []
+        for i in cand[overlap]:
+            obj = labels[i]
+            inside = (r1[i] >= x1[k] and r2[i] <= x2[k]
+                      and c1[i] >= y1[k] and c2[i] <= y2[k])
+            if not inside:
+                region = image2[max(x1[k], r1[i]):min(x2[k], r2[i]),
+                                max(y1[k], c1[i]):min(y2[k], c2[i])]
+                if not np.any(region == obj):
+                    continue
+            found.append(obj)
+        objs_found[k] = np.array(found, dtype=int)
+    return objs_found
+
+
+def get_disparity(obj_found, extents2, center_pred, obj1_extent):
+    """ Computes disparities for objects in obj_found, given extents2, the
+    extents of all objects in image2, and the predicted center of the
+    object. See get_obj_extents. """
+    target_centers = extents2['obj_center'][obj_found - 1]
+    dist_pred = np.sqrt(np.sum((target_centers - center_pred)**2, axis=1))
+    change = get_sizeChange(extents2['obj_area'][obj_found - 1],
+                            obj1_extent['obj_area'])
     # Note that merger of systems may create a sudden size change 
     # that exaggerates cost function.
     disparity = dist_pred + change
     return disparity
 
 
-def get_disparity_all(obj_found, image2, search_box, obj1_extent):
+def get_disparity_all(obj_found, extents2, center_pred, obj1_extent):
     """ Returns disparities of all objects found within the search box. """
-    if np.max(obj_found) <= 0:
+    if not np.any(obj_found > 0):
         disparity = np.array([LARGE_NUM])
     else:
         obj_found = obj_found[obj_found > 0]
-        disparity = get_disparity(obj_found, image2,
-                                  search_box, obj1_extent)
+        disparity = get_disparity(obj_found, extents2,
+                                  center_pred, obj1_extent)
     return disparity
 
 
@@ -190,7 +212,7 @@ def save_obj_match(obj_id1, obj_found, disparity, obj_match, params):
     """ Saves disparity values in obj_match matrix. If disparity is greater
     than MAX_DISPARITY, saves a large number. """
     disparity[disparity > params['MAX_DISPARITY']] = LARGE_NUM
-    if np.max(obj_found) > 0:
+    if np.any(obj_found > 0):
         obj_found = obj_found[obj_found > 0]
         obj_found = obj_found - 1
         obj_id1 = obj_id1 - 1
@@ -198,10 +220,27 @@ def save_obj_match(obj_id1, obj_found, disparity, obj_match, params):
     return obj_match
 
 
+def save_obj_edges(obj_id1, obj_found, disparity, edges, params):
+    """ Saves disparity values as edges of the sparse match graph, a
+    dictionary of lists of rows, columns and costs. Disparities greater than
+    MAX_DISPARITY are not saved, as they cost as much as no match. """
+    disparity[disparity > params['MAX_DISPARITY']] = LARGE_NUM
+    if np.any(obj_found > 0):
+        obj_found = obj_found[obj_found > 0]
+        feasible = disparity != LARGE_NUM
+        edges['rows'].extend([obj_id1 - 1] * np.sum(feasible))
+        edges['cols'].extend(obj_found[feasible] - 1)
+        edges['costs'].extend(disparity[feasible])
+    return edges
+
+
 def locate_all_objects(image1, image2, raw1, raw2, global_shift, current_objects, record,
-                       params):
+                       params, motion_field=None):
     """ Matches all the objects in image1 to objects in image2. This is the
-    main function called on a pair of images. """
+    main function called on a pair of images. Local shifts are taken from
+    motion_field if given, and otherwise from the flow around each
+    object. If MATCH_SOLVER is 'sparse', obj_match is returned as a
+    dictionary of edges rather than a dense matrix. See save_obj_edges. """
     nobj1 = np.max(image1)
     nobj2 = np.max(image2)
 
@@ -209,15 +248,30 @@ def locate_all_objects(image1, image2, raw1, raw2, global_shift, current_objects
         print('No echoes to track!')
         return
 
-    obj_match = np.full((nobj1, np.max((nobj1, nobj2))),
-                        LARGE_NUM, dtype='f')
+    shape = (nobj1, np.max((nobj1, nobj2)))
+    if params['MATCH_SOLVER'] == 'sparse':
+        obj_match = {'rows': [], 'cols': [], 'costs': [], 'shape': shape}
+    else:
+        obj_match = np.full(shape, LARGE_NUM, dtype='f')
     u_shift = []
     v_shift = []
 
+    # Extents of every object in each image are found once per pair.
+    extents1 = get_obj_extents(image1)
+    extents2 = get_obj_extents(image2)
+    obj1_extents = [dict((key, val[obj_id1-1])
+                         for key, val in extents1.items())
+                    for obj_id1 in np.arange(nobj1) + 1]
+    if motion_field is None:
+        shifts = get_ambient_flows(obj1_extents, raw1, raw2, params,
+                                   record.grid_size)
+    else:
+        shifts = [get_field_flow(motion_field, obj1_extent)
+                  for obj1_extent in obj1_extents]
+
+    corrected_shifts = np.zeros((nobj1, 2))
     for obj_id1 in np.arange(nobj1) + 1:
-        obj1_extent = get_obj_extent(image1, obj_id1)
-        shift = get_ambient_flow(obj1_extent, raw1,
-                                 raw2, params, record.grid_size)
+        shift = shifts[obj_id1-1]
          
         if shift is None:
             record.count_case(5)
@@ -232,15 +286,24 @@ def locate_all_objects(image1, image2, raw1, raw2, global_shift, current_objects
         [v, u] = shift_meters/record.interval.seconds
         u_shift.append(u)
         v_shift.append(v)
+        corrected_shifts[obj_id1-1] = shift
 
-        search_box = predict_search_extent(obj1_extent, shift,
-                                           params, record.grid_size)
-        search_box = check_search_box(search_box, image2.shape)
-        objs_found = find_objects(search_box, image2)
-        disparity = get_disparity_all(objs_found, image2,
-                                      search_box, obj1_extent)
-        obj_match = save_obj_match(obj_id1, objs_found, disparity, obj_match,
-                                   params)
+    # Search all predicted boxes at once.
+    search_boxes = get_search_boxes(extents1['obj_center'], corrected_shifts,
+                                    params, record.grid_size, image2.shape)
+    all_objs_found = find_all_objects(search_boxes, image2)
+
+    for obj_id1 in np.arange(nobj1) + 1:
+        objs_found = all_objs_found[obj_id1-1]
+        disparity = get_disparity_all(objs_found, extents2,
+                                      search_boxes['center_pred'][obj_id1-1],
+                                      obj1_extents[obj_id1-1])
+        if params['MATCH_SOLVER'] == 'sparse':
+            obj_match = save_obj_edges(obj_id1, objs_found, disparity,
+                                       obj_match, params)
+        else:
+            obj_match = save_obj_match(obj_id1, objs_found, disparity,
+                                       obj_match, params)
 
     return obj_match, u_shift, v_shift
 
@@ -273,9 +336,121 @@ def match_pairs(obj_match, params):
     return pairs, obj_merge
 
 
-def get_pairs(image1, image2, raw1, raw2, global_shift, current_objects, record, params):
+def match_pairs_sparse(edges, params):
+    """ Matches objects into pairs as match_pairs does, given the edges of
+    the match graph saved by save_obj_edges. The graph is split into
+    connected components, and each is solved separately with one dummy
+    column per row costing LARGE_NUM, standing in for the LARGE_NUM entries
+    of the dense matrix. The optimal assignments are the same as those of
+    match_pairs, though ties between equally good assignments may be
+    broken differently. """
+    nobj1, ncols = edges['shape']
+    rows = np.array(edges['rows'], dtype=int)
+    cols = np.array(edges['cols'], dtype=int)
+    costs = np.array(edges['costs'], dtype='f')
+    obj_merge = np.zeros(edges['shape'], dtype=bool)
+    pairs = np.full(nobj1, -1)
+
+    # Rows are nodes 0 to nobj1 - 1 and columns are the nodes after.
+    roots = get_component_roots((rows, cols + nobj1), nobj1 + ncols)
+    edge_roots = roots[rows]
+    order = np.argsort(edge_roots, kind='mergesort')
+    bounds = np.flatnonzero(np.diff(edge_roots[order])) + 1
+    for comp in np.split(order, bounds):
+        if len(comp) == 0:
+            continue
+        comp_rows, row_ind = np.unique(rows[comp], return_inverse=True)
+        comp_cols, col_ind = np.unique(cols[comp], return_inverse=True)
+        block = np.full((len(comp_rows), len(comp_cols) + len(comp_rows)),
+                        LARGE_NUM, dtype='f')
+        block[row_ind, col_ind] = costs[comp]
+        block_pairs = optimize.linear_sum_assignment(block)
+        for i, j in zip(*block_pairs):
+            if j < len(comp_cols) and block[i, j] <= params['MAX_DISPARITY']:
+                pairs[comp_rows[i]] = comp_cols[j]
+
+    # Unmatched objects merge with their closest object in the search box.
+    unmatched = pairs[rows] == -1
+    for row, col, cost in sorted(zip(rows[unmatched], cols[unmatched],
+                                     costs[unmatched]),
+                                 key=lambda edge: (edge[0], edge[2],
+                                                   edge[1])):
+        if not np.any(obj_merge[row]):
+            obj_merge[row, col] = True
+
+    pairs = pairs + 1  # ids in current_objects are 1-indexed
+    return pairs, obj_merge
+
+
+def shift_labels(image, shift):
+    """ Returns a copy of a labeled image moved by an integer shift in
+    pixels, with pixels moved in from outside the frame set to zero. """
+    shifted = np.zeros_like(image)
+    rows, cols = image.shape
+    dr = int(np.clip(shift[0], -rows, rows))
+    dc = int(np.clip(shift[1], -cols, cols))
+    shifted[max(dr, 0):rows + min(dr, 0), max(dc, 0):cols + min(dc, 0)] = (
+        image[max(-dr, 0):rows + min(-dr, 0), max(-dc, 0):cols + min(-dc, 0)]
+    )
+    return shifted
+
+
+def get_overlaps(image1, image2):
+    """ Returns the matrix of the number of pixels shared by each object
+    in image1 (rows) and each object in image2 (columns). """
+    nobj1 = np.max(image1)
+    nobj2 = np.max(image2)
+    both = (image1 > 0) & (image2 > 0)
+    codes = (image1[both] - 1) * nobj2 + image2[both] - 1
+    overlaps = np.bincount(codes, minlength=nobj1*nobj2)
+    return overlaps.reshape(nobj1, nobj2)
+
+
+def get_pairs_overlap(image1, image2, global_shift, record, params):
+    """ Matches objects by their overlap once image1 is moved by the
+    global shift, as a cheap alternative to locate_all_objects. The cost
+    of a pair is one minus the fraction of the smaller object covered by
+    the other, and pairs without overlap are not considered. Object shifts
+    are the movement of the median center of matched objects, or the
+    global shift for unmatched objects. Returns pairs, obj_merge, u_shift
+    and v_shift as get_pairs does. """
+    nobj1 = np.max(image1)
+    nobj2 = np.max(image2)
+    global_shift = np.round(clip_shift(global_shift, record, params))
+    overlaps = get_overlaps(shift_labels(image1, global_shift), image2)
+
+    extents1 = get_obj_extents(image1)
+    extents2 = get_obj_extents(image2)
+    smaller = np.minimum(extents1['obj_area'][:, np.newaxis],
+                         extents2['obj_area'][np.newaxis, :])
+    rows, cols = np.nonzero(overlaps)
+    costs = 1 - overlaps[rows, cols] / smaller[rows, cols]
+
+    shape = (nobj1, np.max((nobj1, nobj2)))
+    if params['MATCH_SOLVER'] == 'sparse':
+        obj_match = {'rows': list(rows), 'cols': list(cols),
+                     'costs': list(costs), 'shape': shape}
+        pairs, obj_merge = match_pairs_sparse(obj_match, params)
+    else:
+        obj_match = np.full(shape, LARGE_NUM, dtype='f')
+        obj_match[rows, cols] = costs
+        pairs, obj_merge = match_pairs(obj_match, params)
+
+    shifts = np.tile(global_shift, (nobj1, 1)).astype(float)
+    matched = pairs > 0
+    shifts[matched] = (extents2['obj_center'][pairs[matched] - 1]
+                       - extents1['obj_center'][matched])
+    [v_shift, u_shift] = (shifts * record.grid_size[1:]
+                          / record.interval.seconds).T
+    return pairs, obj_merge, list(u_shift), list(v_shift)
+
+
+def get_pairs(image1, image2, raw1, raw2, global_shift, current_objects, record, params,
+              motion_field=None):
     """ Given two images, this function identifies the matching objects and
-    pairs them appropriately. See disparity function. """
+    pairs them appropriately. See disparity function. See
+    locate_all_objects for motion_field. If MATCH_ENGINE is 'overlap',
+    objects are matched by get_pairs_overlap instead. """
     nobj1 = np.max(image1)
     nobj2 = np.max(image2)
 
@@ -288,10 +463,18 @@ def get_pairs(image1, image2, raw1, raw2, global_shift, current_objects, record,
                                   dtype=bool)
         return zero_pairs, zero_obj_merge, [np.nan] * nobj1, [np.nan] * nobj1
 
+    if params['MATCH_ENGINE'] == 'overlap':
+        return get_pairs_overlap(image1, image2, global_shift, record,
+                                 params)
+
     obj_match, u_shift, v_shift = locate_all_objects(image1, image2,
-        raw1, raw2, global_shift, current_objects, record, params
+        raw1, raw2, global_shift, current_objects, record, params,
+        motion_field
     )
     
-    pairs, obj_merge = match_pairs(obj_match, params)
+    if params['MATCH_SOLVER'] == 'sparse':
+        pairs, obj_merge = match_pairs_sparse(obj_match, params)
+    else:
+        pairs, obj_merge = match_pairs(obj_match, params)
 
     return pairs, obj_merge, u_shift, v_shift
@@ -7,17 +7,16 @@ Functions for managing and recording object properties.
 """
 import warnings
 import copy
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
-import pyart
 from scipy import ndimage
-from skimage.measure import regionprops
+from scipy.spatial import cKDTree
 from skimage.feature import peak_local_max
 from numba import jit
 
-from .grid_utils import get_filtered_frame, get_level_indices, get_grid_alt
-from .steiner import steiner_conv_strat
+from .grid_utils import get_filtered_frame, get_grid_geometry
 from scipy.ndimage import center_of_mass
 
 # For debugging
@@ -48,6 +47,175 @@ def get_obj_extent(labeled_image, obj_label):
                   'obj_area': obj_area, 'obj_index': obj_index}
     return obj_extent
 
+def get_obj_extents(labeled_image):
+    """ Takes in labeled image and finds the radius, area, and center of
+    each object, as given by get_obj_extent, for all labels up to the
+    largest. Returns a dictionary of arrays indexed by label minus one.
+    Labels without pixels have zero area and nan radius and center. """
+    nobj = np.max(labeled_image)
+    obj_area = np.bincount(labeled_image.ravel(), minlength=nobj+1)[1:]
+
+    obj_radius = np.full(nobj, np.nan)
+    for i, obj_slice in enumerate(ndimage.find_objects(labeled_image)):
+        if obj_slice is not None:
+            xlength = obj_slice[0].stop - obj_slice[0].start
+            ylength = obj_slice[1].stop - obj_slice[1].start
+            obj_radius[i] = np.max((xlength, ylength))/2
+
+    obj_center = np.round(get_label_medians(labeled_image, obj_area), 0)
+
+    return {'obj_center': obj_center, 'obj_radius': obj_radius,
+            'obj_area': obj_area}
+
+
+def get_label_medians(labeled_image, obj_area):
+    """ Returns the median pixel index of each label 1 to len(obj_area) of
+    labeled_image, where obj_area is the number of pixels of each label,
+    with nan for labels without pixels. """
+    # Medians are taken from the pixel coordinates of each object, sorted
+    # by label and then by coordinate.
+    ind = np.flatnonzero(labeled_image)
+    labels = labeled_image.ravel()[ind]
+    present = obj_area > 0
+    starts = np.cumsum(obj_area) - obj_area
+    lower = (starts + (obj_area - 1) // 2)[present]
+    upper = (starts + obj_area // 2)[present]
+    medians = np.full((len(obj_area), 2), np.nan)
+    for axis, coords in enumerate(np.unravel_index(ind, labeled_image.shape)):
+        coords = coords[np.lexsort((coords, labels))]
+        medians[present, axis] = (coords[lower] + coords[upper]) / 2
+    return medians
+
+
+def get_label_stats(labeled_image, nobj, col_max, col_count, col_top,
+                    border):
+    """ Returns a dictionary of arrays of the statistics of labels 1 to
+    nobj of labeled_image, all found in one pass over the labeled pixels.
+    col_max, col_count and col_top hold the maximum, the number of
+    filtered points and the index of the highest filtered point (-1 if
+    none) of the column at each pixel, and border marks the pixels on the
+    scan border. area, count and border are the totals over the pixels of
+    each label, field_max and top the maxima and center the median pixel
+    index. Labels without pixels have nan maxima and center. """
+    ind = np.flatnonzero(labeled_image)
+    labels = labeled_image.ravel()[ind]
+    ind = ind[np.argsort(labels, kind='mergesort')]
+    area = np.bincount(labels, minlength=nobj+1)[1:nobj+1]
+    present = area > 0
+    starts = (np.cumsum(area) - area)[present]
+
+    stats = {'area': area, 'center': get_label_medians(labeled_image, area),
+             'count': np.zeros(nobj, dtype=int),
+             'border': np.zeros(nobj, dtype=int),
+             'field_max': np.full(nobj, np.nan, dtype=col_max.dtype),
+             'top': np.full(nobj, np.nan)}
+    if len(ind) == 0:
+        return stats
+    stats['count'][present] = np.add.reduceat(col_count.ravel()[ind], starts)
+    stats['border'][present] = np.add.reduceat(border.ravel()[ind], starts)
+    stats['field_max'][present] = np.maximum.reduceat(col_max.ravel()[ind],
+                                                      starts)
+    top = np.maximum.reduceat(col_top.ravel()[ind], starts).astype(float)
+    top[top < 0] = np.nan
+    stats['top'][present] = top
+    return stats
+
+def get_ellipse_props(labeled_image, intensity, nobj):
+    """ Returns a dictionary of arrays of the centroid, intensity weighted
+    centroid and ellipse fit of labels 1 to nobj of labeled_image, as given
+    by the regionprops properties centroid, weighted_centroid,
+    major_axis_length, minor_axis_length, eccentricity and orientation.
+    All are derived from the raw and central moments of every label,
+    found together with bincount. Labels without pixels are nan. """
+    ind = np.flatnonzero(labeled_image)
+    labels = labeled_image.ravel()[ind]
+    coords = np.unravel_index(ind, labeled_image.shape)
+    weights = intensity.ravel()[ind].astype(np.float64)
+
+    def label_sum(values):
+        return np.bincount(labels, weights=values, minlength=nobj+1)[1:]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m00 = label_sum(None)
+        w00 = label_sum(weights)
+        centroid = np.stack([label_sum(c) / m00 for c in coords], axis=1)
+        weighted_centroid = np.stack(
+            [label_sum(weights * c) / w00 for c in coords], axis=1
+        )
+
+        # Central moments about the centroid, normalised by area, give the
+        # inertia tensor [[a, b], [b, c]] of regionprops.
+        dr = coords[0] - centroid[labels - 1, 0]
+        dc = coords[1] - centroid[labels - 1, 1]
+        a = label_sum(dc * dc) / m00
+        b = -label_sum(dr * dc) / m00
+        c = label_sum(dr * dr) / m00
+
+        root = np.sqrt(((a - c) / 2) ** 2 + b ** 2)
+        l1 = np.clip((a + c) / 2 + root, 0, None)
+        l2 = np.clip((a + c) / 2 - root, 0, None)
+        eccentricity = np.where(l1 == 0, 0, np.sqrt(1 - l2 / l1))
+        orientation = np.where(
+            a - c == 0,
+            np.where(b < 0, np.pi / 4, -np.pi / 4),
+            0.5 * np.arctan2(-2 * b, c - a)
+        )
+
+    absent = m00 == 0
+    eccentricity[absent] = np.nan
+    orientation[absent] = np.nan
+    return {'centroid': centroid, 'weighted_centroid': weighted_centroid,
+            'major_axis_length': 4 * np.sqrt(l1),
+            'minor_axis_length': 4 * np.sqrt(l2),
+            'eccentricity': eccentricity, 'orientation': orientation}
+
+
+def get_footprints(frames, nobj):
+    """ Returns a list of sorted flat pixel indices of the vertical
+    projection of each object 1 to nobj in frames. Objects are connected
+    across levels, so each pixel of the projection belongs to one object. """
+    proj = frames.max(axis=0).ravel()
+    ind = np.flatnonzero(proj)
+    labels = proj[ind]
+    order = np.argsort(labels, kind='mergesort')
+    bounds = np.searchsorted(labels[order], np.arange(1, nobj + 2))
+    ind = ind[order]
+    return [ind[bounds[i]:bounds[i+1]] for i in range(nobj)]
+
+
+def add_sparse(sparse, ind, values):
+    """ Adds values at the sorted flat pixel indices ind to the sparse field
+    sparse, an (indices, values) tuple, and returns the result. The values
+    of sparse keep their dtype. """
+    old_ind, old_values = sparse
+    new_ind = np.union1d(old_ind, ind)
+    new_values = np.zeros(len(new_ind), dtype=old_values.dtype)
+    new_values[np.searchsorted(new_ind, old_ind)] = old_values
+    new_values[np.searchsorted(new_ind, ind)] += values
+    return new_ind, new_values
+
+
+def get_sparse_max(sparse, shape):
+    """ Returns the maximum of a non-negative sparse field and the [row,
+    column] location of its first occurrence, treating pixels outside the
+    field as zero. """
+    ind, values = sparse
+    if len(values) == 0 or np.max(values) <= 0:
+        return values.dtype.type(0), [0, 0]
+    k = np.argmax(values)
+    return values[k], list(np.unravel_index(ind[k], shape))
+
+
+def sparse_to_dense(sparse_list, shape):
+    """ Stacks a list of sparse fields into a dense array with one field
+    of the given shape per element of sparse_list. """
+    dtype = np.result_type(*[values.dtype for ind, values in sparse_list])
+    dense = np.zeros((len(sparse_list), np.prod(shape)), dtype=dtype)
+    for i, (ind, values) in enumerate(sparse_list):
+        dense[i, ind] = values
+    return dense.reshape((len(sparse_list),) + tuple(shape))
+
+
 #@jit(nopython=True)
 def init_current_objects(raw1, raw2, raw_rain1, raw_rain2, 
                          first_frame, second_frame, 
@@ -68,19 +236,20 @@ def init_current_objects(raw1, raw2, raw_rain1, raw_rain2,
     new_mergers = [set() for i in range(len(uid))]
     parents = [set() for i in range(len(uid))]
             
+    # Rain fields are stored sparsely as (flat pixel indices, values)
+    # tuples over each object's footprint.
     if rain:
-        max_rr = [np.zeros(raw_rain1.shape, dtype=np.float32) 
-                  for i in range(len(uid))]
-        tot_rain = [np.zeros(raw_rain1.shape, dtype=np.float32) 
-                    for i in range(len(uid))]
-
-        for i in range(len(uid)):
-            cond = (np.any(frames1==id1[i], axis=0))
-            max_rr[i][cond] = raw_rain1[cond]
-            tot_rain[i][cond] = raw_rain1[cond]/3600*interval
+        max_rr = []
+        tot_rain = []
+        for ind in get_footprints(frames1, nobj):
+            rain_rate = raw_rain1.flat[ind]
+            max_rr.append((ind, rain_rate.astype(np.float32)))
+            tot_rain.append(
+                (ind, (rain_rate/3600*interval).astype(np.float32))
+            )
     else: 
-        max_rr = [np.nan for i in range(len(uid))]
-        tot_rain = [np.nan for i in range(len(uid))]
+        max_rr = [None for i in range(len(uid))]
+        tot_rain = [None for i in range(len(uid))]
     
     current_objects = {'id1': id1, 'uid': uid, 'id2': id2, 
                        'mergers': mergers, 'new_mergers':new_mergers,
@@ -95,67 +264,85 @@ def init_current_objects(raw1, raw2, raw_rain1, raw_rain2,
 def update_current_objects(raw1, raw2, raw_rain1, raw_rain2, 
                            frame0, frame1, frame2,
                            frames1, frames2, 
-                           acc_rain_list, acc_rain_uid_list,
-                           pairs, old_objects,
+                           rain_sink, pairs, old_objects,
                            counter, old_obj_merge, interval, rain, save_rain):
     """ Removes dead objects, updates living objects, and assigns new uids to
-    new-born objects. """
+    new-born objects. If save_rain is True, the accumulated rainfall of dead
+    objects is written to rain_sink. """
     nobj = np.max(frame1)
     id1 = np.arange(nobj) + 1
-    uid = np.array([], dtype='str')
-    obs_num = np.array([], dtype='i')
-    mergers = []
-    parent = []
+    uid = []
+    obs_num = np.zeros(nobj, dtype='i')
     max_rr = []
     tot_rain = []
     
+    if rain:
+        footprints = get_footprints(frames1, nobj)
+
+    # Index of the old object continued by each object in frame1, taking
+    # the first if more than one is.
+    old_ids = {}
+    for old_i, obj in enumerate(old_objects['id2']):
+        if obj > 0:
+            old_ids.setdefault(obj, old_i)
+    
     for obj in np.arange(nobj) + 1:
-        cond=(np.any(frames1==id1[obj-1], axis=0))
-        obj_max_rr = np.zeros(raw_rain1.shape, dtype=np.float32)
-        obj_max_rr[cond] = raw_rain1[cond]
-        max_rr.append(obj_max_rr)
-        if obj in old_objects['id2']:
-            obj_index = (old_objects['id2'] == obj)
-            ind = np.argwhere(obj_index)[0,0]
-            uid = np.append(uid, old_objects['uid'][ind])
-            obs_num = np.append(obs_num, old_objects['obs_num'][ind]+1)
-
-            obj_tot_rain = old_objects['tot_rain'][ind]
-            obj_tot_rain[cond] += raw_rain1[cond]/3600*interval
-            tot_rain.append(obj_tot_rain)
+        if rain:
+            pix = footprints[obj-1]
+            rain_rate = raw_rain1.flat[pix]
+            max_rr.append((pix, rain_rate.astype(np.float32)))
+        else:
+            max_rr.append(None)
+        if obj in old_ids:
+            ind = old_ids[obj]
+            uid.append(old_objects['uid'][ind])
+            obs_num[obj-1] = old_objects['obs_num'][ind]+1
+
+            if rain:
+                tot_rain.append(add_sparse(old_objects['tot_rain'][ind], 
+                                           pix, rain_rate/3600*interval))
+            else:
+                tot_rain.append(None)
         else:
-            uid = np.append(uid, counter.next_uid())
-            obs_num = np.append(obs_num, 0)
+            uid.extend(counter.next_uid())
             
-            obj_tot_rain = np.zeros(raw_rain1.shape)
-            obj_tot_rain[cond] = raw_rain1[cond]/3600*interval
-            tot_rain.append(obj_tot_rain)
+            if rain:
+                tot_rain.append(
+                    (pix, (rain_rate/3600*interval).astype(np.float64))
+                )
+            else:
+                tot_rain.append(None)
             
+    uid = np.array(uid, dtype='str')
     id2 = pairs
+    uid_index = {u: i for i, u in enumerate(uid)}
+    old_uid_index = {u: i for i, u in enumerate(old_objects['uid'])}
     
     new_mergers = [set() for i in range(len(uid))]
     mergers = [set() for i in range(len(uid))]
     parents = [set() for i in range(len(uid))]
-    
+
+    # Old objects merged into each old object, from the merge matrix.
+    merged = [[] for i in range(len(old_objects['uid']))]
+    for row, col in zip(*np.nonzero(old_obj_merge)):
+        if col < len(merged):
+            merged[col].append(old_objects['uid'][row])
+
+    split_pairs = None
     for i in range(len(uid)):
-        if uid[i] in old_objects['uid']:
+        if uid[i] in old_uid_index:
             # Check for merger
-            old_i = int(np.argwhere(old_objects['uid']==uid[i]))
-            new_mergers[i] = set(old_objects['uid'][old_obj_merge[:,old_i]])
+            old_i = old_uid_index[uid[i]]
+            new_mergers[i] = set(merged[old_i])
             mergers[i]=new_mergers[i].union(old_objects['mergers'][old_i])
             parents[i]=parents[i].union(old_objects['parents'][old_i])
         else:
-            # Check for splits
-            recurring = set(old_objects['uid']).intersection(set(uid))
-            for j in range(len(recurring)):
-                obj_index = (old_objects['uid'] == list(recurring)[j])
-                # Check for overlap
-                olap = np.any((frame0==old_objects['id1'][obj_index])
-                              *((frame1==id1[i])))
-                if olap:
-                    parents[i]=parents[i].union(
-                        {old_objects['uid'][obj_index][0]}
-                    )
+            # Check for splits: recurring old objects in frame0 that
+            # overlap the object in frame1.
+            if split_pairs is None:
+                split_pairs = get_split_pairs(frame0, frame1, old_objects,
+                                              uid_index)
+            parents[i]=parents[i].union(split_pairs.get(id1[i], set()))
                  
     if save_rain:
         if raw2 is None:
@@ -163,9 +350,11 @@ def update_current_objects(raw1, raw2, raw_rain1, raw_rain2,
         else:
             dead_uids = set(old_objects['uid'])-set(uid)
         for u in dead_uids:
-            u_ind = int(np.argwhere(old_objects['uid']==u))
-            acc_rain_list.append(old_objects['tot_rain'][u_ind])
-            acc_rain_uid_list.append(u)
+            if u in uid_index:
+                # Final scan; save accumulation including this scan
+                rain_sink.write(u, tot_rain[uid_index[u]])
+            else:
+                rain_sink.write(u, old_objects['tot_rain'][old_uid_index[u]])
             
     current_objects = {'id1': id1, 'uid': uid, 'id2': id2, 'obs_num': obs_num,
                        'mergers': mergers, 'new_mergers': new_mergers, 
@@ -174,7 +363,23 @@ def update_current_objects(raw1, raw2, raw_rain1, raw_rain2,
                        
     current_objects = attach_last_heads(raw1, raw2, frame1, 
                                         frame2, current_objects)
-    return current_objects, counter, acc_rain_list, acc_rain_uid_list
+    return current_objects, counter
+
+
+def get_split_pairs(frame0, frame1, old_objects, uid_index):
+    """ Returns a dictionary giving, for each object label in frame1, the
+    set of uids of the old objects in frame0 that overlap it and recur in
+    uid_index. Overlaps of all label pairs are counted with one bincount. """
+    old_uids = dict(zip(old_objects['id1'], old_objects['uid']))
+    n1 = np.max(frame1) + 1
+    both = (frame0 > 0) & (frame1 > 0)
+    codes = frame0[both].astype(int) * n1 + frame1[both]
+    split_pairs = {}
+    for code in np.flatnonzero(np.bincount(codes)):
+        label0, label1 = divmod(code, n1)
+        if old_uids.get(label0) in uid_index:
+            split_pairs.setdefault(label1, set()).add(old_uids[label0])
+    return split_pairs
 
 
 def attach_last_heads(raw1, raw2, frame1, frame2, current_objects):
@@ -199,10 +404,11 @@ def attach_last_heads(raw1, raw2, frame1, frame2, current_objects):
     return current_objects
 
 
-def check_isolation(raw, filtered, grid_size, params, level):
+def check_isolation(raw, filtered, grid_size, params, level, products):
     """ Returns list of booleans indicating object isolation. Isolated objects
     are not connected to any other objects by pixels greater than ISO_THRESH,
-    and have at most one peak. """
+    and have at most one peak. The smoothed maximum projection used in peak
+    detection is taken from products, a ScanProducts object. """
     nobj = np.max(filtered)
     min_size = params['MIN_SIZE'][level] / np.prod(grid_size[1:]/1000)
     iso_filtered = get_filtered_frame(
@@ -215,16 +421,15 @@ def check_isolation(raw, filtered, grid_size, params, level):
         obj_ind = np.where(iso_filtered == iso_id)
         objects = np.unique(filtered[obj_ind])
         objects = objects[objects != 0]
-        if len(objects) == 1 and single_max(obj_ind, raw, params):
+        if len(objects) == 1 and single_max(obj_ind, raw, params, products):
             iso[objects - 1] = True
         else:
             iso[objects - 1] = False
     return iso
     
-def single_max(obj_ind, raw, params):
+def single_max(obj_ind, raw, params, products):
     """ Returns True if object has at most one peak. """
-    max_proj = np.max(raw, axis=0)
-    smooth = ndimage.filters.gaussian_filter(max_proj, params['ISO_SMOOTH'])
+    smooth = products.get_smooth_max_proj(raw, params['ISO_SMOOTH'])
     padded = np.pad(smooth, 1, mode='constant')
     obj_ind = [axis + 1 for axis in obj_ind]  # adjust for padding
     maxima = 0
@@ -246,78 +451,77 @@ def get_border_indices(obj_ind, b_ind):
     return b_ind
     
 
-def identify_updrafts(raw3D, images, grid1, record, params, sclasses):
+def get_local_maxima(raw3D, z0, params):
+    """ Returns a list of the local maxima of raw3D above UPDRAFT_THRESH at
+    each vertical level from z0 upwards, as arrays of [z, row, column]
+    indices. Levels are searched in a pool of UPDRAFT_WORKERS threads. """
+    def level_maxima(k):
+        l_max = peak_local_max(
+            raw3D[k], threshold_abs = params['UPDRAFT_THRESH']
+        )
+        return np.insert(
+            l_max, 0, np.ones(len(l_max), dtype=int)*k, axis=1
+        )
+
+    levels = range(z0, raw3D.shape[0])
+    if params['UPDRAFT_WORKERS'] > 1:
+        with ThreadPoolExecutor(params['UPDRAFT_WORKERS']) as executor:
+            return list(executor.map(level_maxima, levels))
+    return [level_maxima(k) for k in levels]
+
+def identify_updrafts(raw3D, images, grid1, record, params, products):
     """ Determine "updrafts" by looking for local maxima at each 
     vertical level. """
     
     [dz, dx, dy] = record.grid_size
-    z0 = get_grid_alt(record.grid_size, params['LEVELS'][0,0])
+    z0 = products.level_indices[0][0]
     
     if params['FIELD_THRESH'][0] == 'convective':
-        sclass = sclasses[0]
+        sclass = products.sclasses[0]
     else:
-        sclass = steiner_conv_strat(
-            raw3D[z0], grid1.x['data'], grid1.y['data'], dx, dy
+        sclass = products.get_steiner(
+            raw3D, z0, grid1.x['data'], grid1.y['data'], dx, dy
         )
     
     # Get local maxima
-    local_max = []
-    
-    for k in range(z0, grid1.nz):
-        l_max = peak_local_max(
-            raw3D[k], threshold_abs = params['UPDRAFT_THRESH']
-        )
-        l_max = np.insert(
-            l_max, 0, np.ones(len(l_max), dtype=int)*k, axis=1
-        )
-        local_max.append(l_max)
-        
-    # Find pixels classified as convective by steiner
-    conv_ind = np.argwhere(sclass == 2)
-    conv_ind_set = set(
-        [tuple(conv_ind[i]) for i in range(len(conv_ind))]
-    )      
+    local_max = get_local_maxima(raw3D, z0, params)
        
     # Define updrafts starting from local maxima at lowest level
+    # classified as convective by steiner.
     # Append the starting level index - i.e. z0.
-    updrafts = [[local_max[0][j]] for j in range(len(local_max[0])) 
-                if tuple(local_max[0][j][1:]) in conv_ind_set]
+    convective = sclass[local_max[0][:, 1], local_max[0][:, 2]] == 2
+    updrafts = [[l_max] for l_max in local_max[0][convective]]
     
     # Find first level with no local_max
-    try:
-        max_height = [i for i in range(len(local_max))
-                      if local_max[i].tolist() == []][0]
-    except:
-        max_height = len(local_max)
+    empty = [i for i in range(len(local_max)) if len(local_max[i]) == 0]
+    max_height = empty[0] if empty else len(local_max)
         
-    # Create a set to store indices of still 
-    # existing updrafts as we check each vertical 
-    # level of data.
-    current_inds = set(range(len(updrafts)))
+    # Indices of still existing updrafts as we check each vertical 
+    # level of data, in ascending order.
+    current_inds = list(range(len(updrafts)))
 
     for k in range(1,max_height):
 
-        previous =  np.array([updrafts[i][k-1] for i in current_inds])
         current = local_max[k]
-        
-        if ((len(previous) == 0) or (len(current)==0)):
+        if ((len(current_inds) == 0) or (len(current)==0)):
             break        
-
-        # Calculate euclidean distance between indices
-        mc1, mp1 = np.meshgrid(current[:,1], previous[:,1])
-        mc2, mp2 = np.meshgrid(current[:,2], previous[:,2])
-        
-        match = np.sqrt((mp1-mc1)**2+(mp2-mc2)**2)
-       
-        next_inds = copy.copy(current_inds)
-        minimums = np.argmin(match, axis=1)
-        for l in range(match.shape[0]):
-            minimum = minimums[l]
-            if (match[l,minimum] < 2):
-                updrafts[list(current_inds)[l]].append(current[minimum])
-            else:
-                next_inds = next_inds - set([list(current_inds)[l]])
-        # If any indices remain in current - add them to next_inds
+        previous = np.array([updrafts[i][k-1] for i in current_inds])
+
+        # Continue each updraft with the nearest maximum less than 2 grid
+        # cells away, taking the lowest index of equally near maxima.
+        tree = cKDTree(current[:, 1:])
+        neighbours = tree.query_ball_point(previous[:, 1:], 2)
+        next_inds = []
+        for l in range(len(previous)):
+            candidates = np.sort(neighbours[l]).astype(int)
+            match = np.sqrt(
+                (previous[l, 1] - current[candidates, 1])**2
+                + (previous[l, 2] - current[candidates, 2])**2
+            )
+            if len(candidates) > 0 and np.min(match) < 2:
+                minimum = candidates[np.argmin(match)]
+                updrafts[current_inds[l]].append(current[minimum])
+                next_inds.append(current_inds[l])
         current_inds = next_inds
      
     updrafts = [updrafts[i] for i in range(len(updrafts)) 
@@ -325,11 +529,12 @@ def identify_updrafts(raw3D, images, grid1, record, params, sclasses):
     
     return updrafts
 
-def get_object_prop(images, cores, grid1, u_shift, v_shift, sclasses,
-                    field, record, params, current_objects):
+def get_object_prop(images, cores, grid1, u_shift, v_shift, products,
+                    field, record, params, current_objects, geometry=None):
     """ Returns dictionary of object properties for all objects found in
     each level of images, where images are the labelled (filtered) 
-    frames. """
+    frames. products is the ScanProducts object of the scan, and geometry
+    the GridGeometry object of grid1, which is built if not given. """
     id1 = []
     center = []
     com_x = []
@@ -337,9 +542,8 @@ def get_object_prop(images, cores, grid1, u_shift, v_shift, sclasses,
     grid_x = []
     grid_y = []
     proj_area = []
-    longitude = []
-    latitude = []
     field_max = []
+    com_xy = [] # Unrounded centers of mass for lat, lon conversion.
     max_height = []
     volume = []
     level = []
@@ -370,22 +574,50 @@ def get_object_prop(images, cores, grid1, u_shift, v_shift, sclasses,
     unit_area = (unit_dim[1]*unit_dim[2])/(1000**2)
     unit_vol = (unit_dim[0]*unit_dim[1]*unit_dim[2])/(1000**3)
 
+    if geometry is None:
+        geometry = get_grid_geometry(grid1, unit_dim, params)
+
     raw3D = grid1.fields[field]['data'].data # Complete dataset
     z_values = grid1.z['data']/1000
     
     all_updrafts = identify_updrafts(
-        raw3D, images, grid1, record, params, sclasses
+        raw3D, images, grid1, record, params, products
     )
+
+    # Reflectivity cells belong to the object containing their lowest point.
+    updrafts_obj = [[] for obj in range(nobj)]
+    for updraft in all_updrafts:
+        obj = images[0][updraft[0][1], updraft[0][2]]
+        if obj > 0:
+            updrafts_obj[obj-1].append(updraft)
+
+    border = np.zeros((rows, columns), dtype=int)
+    if params['BOUNDARY_GRID_CELLS']:
+        border[tuple(np.array(list(params['BOUNDARY_GRID_CELLS'])).T)] = 1
        
     for i in range(levels):
       
         # Get vertical indices of ith level
-        [z_min, z_max] = get_level_indices(
-            grid1, record.grid_size, params['LEVELS'][i,:]
-        )
+        [z_min, z_max] = products.level_indices[i]
         
         # Caclulate ellipse fit properties
-        ski_props = regionprops(images[i], raw3D[z_min], cache=True)
+        ellipse = get_ellipse_props(images[i], raw3D[z_min], nobj)
+
+        # Calculate column statistics of the filtered points of raw3D,
+        # and from them the statistics of every object at this level.
+        # Convective columns count as a single point at the top level.
+        raw3D_i = raw3D[z_min:z_max,:,:]
+        if params['FIELD_THRESH'][i] == 'convective':
+            convective = products.sclasses[i] == 2
+            col_count = convective.astype(int)
+            col_top = np.where(convective, raw3D_i.shape[0] - 1, -1)
+        else:
+            filtered = raw3D_i > params['FIELD_THRESH'][i]
+            col_count = np.sum(filtered, axis=0)
+            col_top = raw3D_i.shape[0] - 1 - np.argmax(filtered[::-1], axis=0)
+            col_top[col_count == 0] = -1
+        stats = get_label_stats(images[i], nobj, np.max(raw3D_i, axis=0),
+                                col_count, col_top, border)
 
         for obj in np.arange(nobj) + 1:
             # Append current object number
@@ -400,65 +632,54 @@ def get_object_prop(images, cores, grid1, u_shift, v_shift, sclasses,
             obj_tot_rain = current_objects['tot_rain'][obj-1]
             obj_max_rr = current_objects['max_rr'][obj-1]
             
-            tot_rain_loc_obj = list(np.unravel_index(np.argmax(obj_tot_rain), 
-                                    obj_tot_rain.shape))
+            if obj_tot_rain is None:
+                tot_rain_obj, tot_rain_loc_obj = np.nan, [np.nan, np.nan]
+                max_rr_obj, max_rr_loc_obj = np.nan, [np.nan, np.nan]
+            else:
+                tot_rain_obj, tot_rain_loc_obj = get_sparse_max(
+                    obj_tot_rain, (rows, columns)
+                )
+                max_rr_obj, max_rr_loc_obj = get_sparse_max(
+                    obj_max_rr, (rows, columns)
+                )
             tot_rain_loc.append(tot_rain_loc_obj)
-
-            max_rr_loc_obj = list(np.unravel_index(np.argmax(obj_max_rr), 
-                                  obj_max_rr.shape))
             max_rr_loc.append(max_rr_loc_obj)
             
-            max_rr.append(np.max(obj_max_rr))
-            tot_rain.append(np.max(obj_tot_rain))
+            max_rr.append(max_rr_obj)
+            tot_rain.append(tot_rain_obj)
                      
-            # Get objects in images[i], i.e. the frame at i-th level
-            obj_index = np.argwhere(images[i] == obj)
-   
             # 2D frame stats
             level.append(i)
           
             # Work out how many gridcells touch the border
-            obj_ind_list = obj_index.tolist()
-            obj_ind_set = set(
-                [tuple(obj_ind_list[i]) for i in range(len(obj_ind_list))]
-            )
-            b_intersect = obj_ind_set.intersection(
-                params['BOUNDARY_GRID_CELLS']
-            )
-            touch_border.append(len(b_intersect))
+            touch_border.append(stats['border'][obj-1])
             
             # Append median object index as measure of center
-            center.append(np.median(obj_index, axis=0))
+            center.append(stats['center'][obj-1])
                        
             # Append area of vertical projection.
-            proj_area.append(obj_index.shape[0] * unit_area)
+            proj_area.append(stats['area'][obj-1] * unit_area)
             
             # Append mean object index (centroid) in grid units
             # Note, y component is zeroth index of this_centroid, 
             # x component is first index of this_centroid, unit_dim 
             # is list [dz, dx, dy].
-            g_y = ski_props[obj-1].centroid[0] * unit_dim[2]
+            g_y = ellipse['centroid'][obj-1, 0] * unit_dim[2]
             g_y += grid1.y['data'][0]
-            g_x = ski_props[obj-1].centroid[1] * unit_dim[1]
+            g_x = ellipse['centroid'][obj-1, 1] * unit_dim[1]
             g_x += grid1.x['data'][0] 
             grid_x.append(np.round(g_x, 1))
             grid_y.append(np.round(g_y, 1))
             
             # Append object center of mass (reflectivity weighted
             # centroid) in grid units
-            g_y = ski_props[obj-1].weighted_centroid[0] * unit_dim[2]
+            g_y = ellipse['weighted_centroid'][obj-1, 0] * unit_dim[2]
             g_y += grid1.y['data'][0]
-            g_x = ski_props[obj-1].weighted_centroid[1] * unit_dim[1]
+            g_x = ellipse['weighted_centroid'][obj-1, 1] * unit_dim[1]
             g_x += grid1.x['data'][0]
             com_x.append(np.round(g_x, 1))
             com_y.append(np.round(g_y, 1))  
-            
-            # Append centroid in lat, lon units. 
-            projparams = grid1.get_projparams()
-            lon, lat = pyart.core.transforms.cartesian_to_geographic(
-                g_x, g_y, projparams)
-            longitude.append(np.round(lon[0], 5))
-            latitude.append(np.round(lat[0], 5))
+            com_xy.append((g_x, g_y))
             
             # Append ellipse properties
             # Note semi_major, semi_minor are stored in `index' 
@@ -467,59 +688,37 @@ def get_object_prop(images, cores, grid1, u_shift, v_shift, sclasses,
                      'eccentricity', 'orientation']
             lists = [semi_major, semi_minor, eccentricity, orientation]
             for j in range(0, len(attrs)):
-                try:
-                    lists[j].append(
-                        np.round(eval('ski_props[obj-1].' + attrs[j]), 3)
-                    )
-                except:
-                    lists[j].append(np.nan)
-            
-            # Calculate raw3D slices                            
-            raw3D_i = raw3D[z_min:z_max,:,:]
-            obj_slices = [raw3D_i[:, ind[0], ind[1]] for ind in obj_index]
+                lists[j].append(np.round(ellipse[attrs[j]][obj-1], 3))
             
-            if params['FIELD_THRESH'][i] == 'convective':
-                sclasses_i = sclasses[i]
-                sclasses_slices = [sclasses_i[ind[0], ind[1]] 
-                                   for ind in obj_index]
-                field_max.append(np.max(obj_slices))
-                filtered_slices = [sclasses_slice == 2
-                                   for sclasses_slice in sclasses_slices]
-            else:
-                field_max.append(np.max(obj_slices))
-                filtered_slices = [obj_slice > params['FIELD_THRESH'][i]
-                                   for obj_slice in obj_slices]
+            field_max.append(stats['field_max'][obj-1])
     
             # Append maximum height
-            heights = [np.arange(raw3D_i.shape[0])[ind] 
-                       for ind in filtered_slices]
-            max_height.append(np.max(np.concatenate(heights)) * unit_alt 
+            max_height.append(stats['top'][obj-1] * unit_alt 
                               + z_values[z_min])
             
             # Append volume
             # Note volume isn't necessarily consistent with proj_area.
             # proj_area is calculated from boolean vertical projection,
             # whereas volume doesn't perform vertical projection.
-            volume.append(np.sum(filtered_slices) * unit_vol)
+            volume.append(stats['count'][obj-1] * unit_vol)
             
             # Append reflectivity cells based on vertically 
             # overlapping reflectivity maxima. 
             if i==0:
-                all_updrafts_0 = [all_updrafts[i][0].tolist() 
-                                  for i in range(len(all_updrafts))]
-                updraft_obj_inds = [i for i in range(len(all_updrafts_0)) 
-                                    if all_updrafts_0[i][1:] 
-                                    in obj_index.tolist()]
-                updrafts_obj = [all_updrafts[i] for i in updraft_obj_inds]
-                updraft_list.append(updrafts_obj)
+                updraft_list.append(updrafts_obj[obj-1])
             else:
                 updraft_list.append([])
             
         # cell isolation
         #isolation += check_isolation(
         #    raw3D[z_min:z_max, :,:], images[i].squeeze(), 
-        #    record.grid_size, params, i
+        #    record.grid_size, params, i, products
         #).tolist()
+
+    # Append centroids in lat, lon units, converted together.
+    lon, lat = geometry.get_geographic(*np.transpose(com_xy))
+    longitude = list(np.round(lon, 5))
+    latitude = list(np.round(lat, 5))
  
     objprop = {
         'id1': id1,
@@ -557,8 +756,9 @@ def get_object_prop(images, cores, grid1, u_shift, v_shift, sclasses,
     return objprop
 
 
-def write_tracks(old_tracks, record, current_objects, obj_props):
-    """ Writes all cell information to tracks dataframe. """
+def write_tracks(track_buffer, record, current_objects, obj_props):
+    """ Appends all cell information for the current scan to track_buffer,
+    a ColumnBuffer from which the tracks dataframe is built. """
     print('Writing tracks for scan {}.'.format(str(record.scan)), 
           end='    \r', flush=True)
 
@@ -567,7 +767,7 @@ def write_tracks(old_tracks, record, current_objects, obj_props):
     scan_num = [record.scan] * nobj * nlvl
     uid = current_objects['uid'].tolist() * nlvl
     
-    new_tracks = pd.DataFrame({
+    track_buffer.append({
         'scan': scan_num,
         'uid': uid,
         'time': record.time,
@@ -598,11 +798,7 @@ def write_tracks(old_tracks, record, current_objects, obj_props):
         'max_rr': obj_props['max_rr'],
         'max_rr_loc': obj_props['max_rr_loc']
     })
-     
-    new_tracks.set_index(['scan', 'time', 'level', 'uid'], inplace=True)
-    new_tracks.sort_index(inplace=True)
-    tracks = old_tracks.append(new_tracks)
-    return tracks
+    return track_buffer
     
 def smooth(group_df, r=3, n=2):
         
@@ -5,13 +5,47 @@ Functions for performing phase correlation. Used to predict cell movement
 between scans.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from scipy import ndimage
+from scipy import fft
 
 
-def get_ambient_flow(obj_extent, raw1, raw2, params, grid_size):
-    """ Takes in object extent and two images and returns ambient flow. Margin
-    is the additional region around the object used to compute the flow
+class SpectrumCache(object):
+    """
+    SpectrumCache objects hold the real FFT of the last image transformed,
+    so that the image shared by consecutive pairs of scans is transformed
+    once. Images are matched by identity, so they must not be modified in
+    place once transformed. Transform plans are cached per shape by
+    scipy.fft itself.
+
+    Attributes
+    ----------
+    image : array
+        Last image transformed.
+    spectrum : array
+        Real FFT of image.
+
+    """
+
+    def __init__(self):
+        self.image = None
+        self.spectrum = None
+
+    def rfft2(self, im, workers=1):
+        """ Returns the real FFT of im, using workers threads if it has
+        to be computed. """
+        if im is not self.image:
+            self.spectrum = fft.rfft2(im, workers=workers)
+            self.image = im
+        return self.spectrum
+
+
+def get_flow_window(obj_extent, params, grid_size, dims):
+    """ Returns the first and last row and column indices of the region
+    around an object used to compute its ambient flow. Margin is the
+    additional region around the object used to compute the flow
     vectors. """
     margin_r = params['FLOW_MARGIN'] / grid_size[1]
     margin_c = params['FLOW_MARGIN'] / grid_size[2]
@@ -24,13 +58,21 @@ def get_ambient_flow(obj_extent, raw1, raw2, params, grid_size):
     col_lb = np.int(col_lb)
     col_ub = np.int(col_ub)
 
-    dims = raw1.shape
     #test
 
     row_lb = np.max([row_lb, 0])
     row_ub = np.min([row_ub, dims[0]])
     col_lb = np.max([col_lb, 0])
     col_ub = np.max([col_ub, dims[1]])
+    return row_lb, row_ub, col_lb, col_ub
+
+
+def get_ambient_flow(obj_extent, raw1, raw2, params, grid_size):
+    """ Takes in object extent and two images and returns ambient flow. See
+    get_flow_window for the region used. """
+    row_lb, row_ub, col_lb, col_ub = get_flow_window(
+        obj_extent, params, grid_size, raw1.shape
+    )
 
     flow_region1 = np.copy(raw1[row_lb:row_ub+1, col_lb:col_ub+1])
     flow_region2 = np.copy(raw2[row_lb:row_ub+1, col_lb:col_ub+1])
@@ -40,17 +82,115 @@ def get_ambient_flow(obj_extent, raw1, raw2, params, grid_size):
     return fft_flowvectors(flow_region1, flow_region2)
 
 
-def fft_flowvectors(im1, im2, global_shift=False):
-    """ Estimates flow vectors in two images using cross covariance. """
+def get_ambient_flows(obj_extents, raw1, raw2, params, grid_size):
+    """ Returns a list of the ambient flow of each object extent in
+    obj_extents, as given by get_ambient_flow. Flow regions of equal shape
+    are phase correlated together as one stack, using FFT_WORKERS threads
+    per transform. Stacks of different shape are phase correlated in a pool
+    of FLOW_WORKERS threads. """
+    windows = [get_flow_window(obj_extent, params, grid_size, raw1.shape)
+               for obj_extent in obj_extents]
+    regions1 = [raw1[row_lb:row_ub+1, col_lb:col_ub+1]
+                for row_lb, row_ub, col_lb, col_ub in windows]
+    regions2 = [raw2[row_lb:row_ub+1, col_lb:col_ub+1]
+                for row_lb, row_ub, col_lb, col_ub in windows]
+
+    # Regions without echoes in both images have no flow.
+    groups = {}
+    for k in range(len(windows)):
+        if np.max(regions1[k]) != 0 and np.max(regions2[k]) != 0:
+            groups.setdefault(regions1[k].shape, []).append(k)
+    groups = list(groups.values())
+
+    def group_flows(group):
+        stack1 = np.stack([regions1[k] for k in group])
+        stack2 = np.stack([regions2[k] for k in group])
+        return fft_flowvectors(stack1, stack2,
+                               workers=params['FFT_WORKERS'])
+
+    if params['FLOW_WORKERS'] > 1 and len(groups) > 1:
+        with ThreadPoolExecutor(params['FLOW_WORKERS']) as executor:
+            group_pshifts = list(executor.map(group_flows, groups))
+    else:
+        group_pshifts = [group_flows(group) for group in groups]
+
+    shifts = [None] * len(windows)
+    for group, pshifts in zip(groups, group_pshifts):
+        for k, pshift in zip(group, pshifts):
+            shifts[k] = pshift
+    return shifts
+
+
+def get_tile_starts(n, size):
+    """ Returns the start indices and size of tiles along an axis of length
+    n. Tiles overlap by half, and the last tile ends at the edge. """
+    size = min(size, n)
+    starts = list(range(0, n - size + 1, max(size // 2, 1)))
+    if starts[-1] != n - size:
+        starts.append(n - size)
+    return np.array(starts), size
+
+
+def get_motion_field(raw1, raw2, params, grid_size):
+    """ Returns a dictionary describing the motion field between two full
+    frames, given by phase correlation on tiles two FLOW_MARGIN wide.
+    shifts gives the flow vector of each tile, or nan for tiles without
+    echoes in both frames. """
+    size_r = int(2 * params['FLOW_MARGIN'] / grid_size[1])
+    size_c = int(2 * params['FLOW_MARGIN'] / grid_size[2])
+    row_starts, size_r = get_tile_starts(raw1.shape[0], size_r)
+    col_starts, size_c = get_tile_starts(raw1.shape[1], size_c)
+
+    tiles1 = np.stack([raw1[r:r+size_r, c:c+size_c]
+                       for r in row_starts for c in col_starts])
+    tiles2 = np.stack([raw2[r:r+size_r, c:c+size_c]
+                       for r in row_starts for c in col_starts])
+    valid = (tiles1.max(axis=(1, 2)) != 0) & (tiles2.max(axis=(1, 2)) != 0)
+    shifts = np.full((len(tiles1), 2), np.nan)
+    if np.any(valid):
+        shifts[valid] = fft_flowvectors(tiles1[valid], tiles2[valid],
+                                        workers=params['FFT_WORKERS'])
+
+    return {'row_starts': row_starts, 'col_starts': col_starts,
+            'size': (size_r, size_c),
+            'shifts': shifts.reshape(len(row_starts), len(col_starts), 2)}
+
+
+def get_field_flow(motion_field, obj_extent):
+    """ Returns the mean flow vector of the tiles of motion_field containing
+    the object center, or None if these tiles are all empty. """
+    row, col = obj_extent['obj_center']
+    size_r, size_c = motion_field['size']
+    row_starts = motion_field['row_starts']
+    col_starts = motion_field['col_starts']
+    in_rows = (row_starts <= row) & (row < row_starts + size_r)
+    in_cols = (col_starts <= col) & (col < col_starts + size_c)
+    shifts = motion_field['shifts'][in_rows][:, in_cols].reshape(-1, 2)
+    shifts = shifts[~np.isnan(shifts[:, 0])]
+    if len(shifts) == 0:
+        return None
+    return shifts.mean(axis=0)
+
+
+def fft_flowvectors(im1, im2, global_shift=False, cache=None, workers=1):
+    """ Estimates flow vectors in two images using cross covariance. See
+    fft_crosscov for cache and workers. im1 and im2 may also be stacks of
+    images over their last two axes, giving a stack of flow vectors. """
     if (not global_shift) and (np.max(im1) == 0 or np.max(im2) == 0):
         return None
 
-    crosscov = fft_crosscov(im1, im2)
-    sigma = (1/8) * min(crosscov.shape)
+    crosscov = fft_crosscov(im1, im2, cache, workers)
+    dims = np.array(im1.shape[-2:])
+    sigma = (1/8) * min(dims)
+    # Zero sigma leaves the stack axes unsmoothed.
+    sigma = [0] * (im1.ndim - 2) + [sigma, sigma]
     cov_smooth = ndimage.filters.gaussian_filter(crosscov, sigma)
-    dims = np.array(im1.shape)
 
-    pshift = np.argwhere(cov_smooth == np.max(cov_smooth))[0]
+    # The first maximum of each image, in row major order.
+    cov_smooth = cov_smooth.reshape(cov_smooth.shape[:-2] + (-1,))
+    pshift = np.stack(
+        np.unravel_index(np.argmax(cov_smooth, axis=-1), dims), axis=-1
+    )
     
     rs = np.ceil(dims[0]/2).astype('int')
     cs = np.ceil(dims[1]/2).astype('int')
@@ -60,32 +200,38 @@ def fft_flowvectors(im1, im2, global_shift=False):
     return pshift
 
 
-def fft_crosscov(im1, im2):
-    """ Computes cross correlation matrix using FFT method. """
-    fft1_conj = np.conj(np.fft.fft2(im1))
-    fft2 = np.fft.fft2(im2)
-    normalize = abs(fft2*fft1_conj)
+def fft_crosscov(im1, im2, cache=None, workers=1):
+    """ Computes cross correlation matrix using FFT method. As the images
+    are real, only half of each spectrum is computed. Spectra are taken
+    from cache, a SpectrumCache object, where possible, and transforms use
+    workers threads. """
+    if cache is None:
+        cache = SpectrumCache()
+    fft1_conj = np.conj(cache.rfft2(im1, workers))
+    fft2 = cache.rfft2(im2, workers)
+    cross_power_spectrum = fft2*fft1_conj
+    normalize = abs(cross_power_spectrum)
     normalize[normalize == 0] = 1  # prevent divide by zero error
-    cross_power_spectrum = (fft2*fft1_conj)/normalize
-    crosscov = np.fft.ifft2(cross_power_spectrum)
-    crosscov = np.real(crosscov)
+    cross_power_spectrum /= normalize
+    crosscov = fft.irfft2(cross_power_spectrum, s=im1.shape[-2:],
+                          workers=workers)
     return fft_shift(crosscov)
 
 
 def fft_shift(fft_mat):
     """ Rearranges the cross correlation matrix so that 'zero' frequency or DC
     component is in the middle of the matrix. Taken from stackoverflow Que.
-    30630632. """
+    30630632. Stacks of matrices are rearranged over their last two axes. """
     if type(fft_mat) is np.ndarray:
-        rs = np.ceil(fft_mat.shape[0]/2).astype('int')
-        cs = np.ceil(fft_mat.shape[1]/2).astype('int')
-        quad1 = fft_mat[:rs, :cs]
-        quad2 = fft_mat[:rs, cs:]
-        quad3 = fft_mat[rs:, cs:]
-        quad4 = fft_mat[rs:, :cs]
-        centered_t = np.concatenate((quad4, quad1), axis=0)
-        centered_b = np.concatenate((quad3, quad2), axis=0)
-        centered = np.concatenate((centered_b, centered_t), axis=1)
+        rs = np.ceil(fft_mat.shape[-2]/2).astype('int')
+        cs = np.ceil(fft_mat.shape[-1]/2).astype('int')
+        quad1 = fft_mat[..., :rs, :cs]
+        quad2 = fft_mat[..., :rs, cs:]
+        quad3 = fft_mat[..., rs:, cs:]
+        quad4 = fft_mat[..., rs:, :cs]
+        centered_t = np.concatenate((quad4, quad1), axis=-2)
+        centered_b = np.concatenate((quad3, quad2), axis=-2)
+        centered = np.concatenate((centered_b, centered_t), axis=-1)
         # Thus centered is formed by shifting the entries of fft_mat
         # up/left by [rs, cs] indices, or equivalently down/right by
         # (fft_mat.shape - [rs, cs]) indices, with edges wrapping. 
@@ -95,11 +241,74 @@ def fft_shift(fft_mat):
         return
 
 
-def get_global_shift(im1, im2, params):
+def downsample(im, factor):
+    """ Returns the mean of im over blocks of factor by factor pixels.
+    Trailing rows and columns that do not fill a block are dropped. """
+    rows = im.shape[0] // factor
+    cols = im.shape[1] // factor
+    blocks = im[:rows*factor, :cols*factor].reshape(rows, factor,
+                                                    cols, factor)
+    return blocks.mean(axis=(1, 3))
+
+
+def get_window_start(center, size, shift, n):
+    """ Returns the start index of a window of the given size along an axis
+    of length n, as close as possible to being centered on center, such
+    that the window displaced by shift is also within the axis. """
+    lower = max(0, -shift)
+    upper = min(n, n - shift) - size
+    return int(np.clip(center - size // 2, lower, upper))
+
+
+def get_pyramid_shift(im1, im2, params, estimate=None):
+    """ Returns the global shift vector estimated on im1 and im2 downsampled
+    by a factor of 2**GS_PYRAMID, or given by estimate, and then refined
+    by phase correlation in a window of GS_WINDOW pixels at full
+    resolution. The window is centered where im1 has the most echo, so
+    the refinement corrects errors of up to about half the window. """
+    factor = 2 ** params['GS_PYRAMID']
+    workers = params['FFT_WORKERS']
+    coarse1 = downsample(im1, factor)
+    if estimate is None:
+        coarse2 = downsample(im2, factor)
+        estimate = factor * fft_flowvectors(coarse1, coarse2,
+                                            global_shift=True,
+                                            workers=workers)
+    estimate = np.clip(estimate, -np.array(im1.shape) + 1,
+                       np.array(im1.shape) - 1).astype(int)
+
+    # Center the window on the coarse pixel with the most echo nearby.
+    echo = ndimage.uniform_filter(coarse1,
+                                  max(params['GS_WINDOW'] // factor, 1),
+                                  mode='constant')
+    center = (np.array(np.unravel_index(np.argmax(echo), echo.shape))
+              * factor + factor // 2)
+
+    # Shrink the window where the displaced window would leave the frame.
+    dims = np.array(im1.shape)
+    size = np.minimum(params['GS_WINDOW'], dims - np.abs(estimate))
+    r0, c0 = [get_window_start(center[i], size[i], estimate[i], dims[i])
+              for i in range(2)]
+    window1 = im1[r0:r0+size[0], c0:c0+size[1]]
+    window2 = im2[r0+estimate[0]:r0+estimate[0]+size[0],
+                  c0+estimate[1]:c0+estimate[1]+size[1]]
+    residual = fft_flowvectors(window1, window2, global_shift=True,
+                               workers=workers)
+    return estimate + residual
+
+
+def get_global_shift(im1, im2, params, cache=None, estimate=None):
     """ Returns standardazied global shift vector. im1 and im2 are full frames
-    of raw DBZ values. """
+    of raw DBZ values. If cache is a SpectrumCache object holding the
+    spectrum of im1, as when im1 was im2 of the previous call, im1 is not
+    transformed again. If GS_PYRAMID is positive, the shift is found by
+    get_pyramid_shift, starting from estimate if given. """
     if im2 is None:
         return None
 
-    shift = fft_flowvectors(im1, im2, global_shift=True)
+    if params['GS_PYRAMID'] > 0:
+        return get_pyramid_shift(im1, im2, params, estimate)
+
+    shift = fft_flowvectors(im1, im2, global_shift=True, cache=cache,
+                            workers=params['FFT_WORKERS'])
     return shift
@@ -0,0 +1,144 @@
+"""
+tint.pipeline
+=============
+
+Tools for reading and extracting grids ahead of the tracking loop.
+
+"""
+
+import collections
+import threading
+import queue
+from concurrent.futures import ProcessPoolExecutor
+
+from .grid_utils import extract_grid_data
+from .grid_utils import get_grid_geometry
+
+
+class _End(object):
+    """ Marks the end of a prefetched sequence. """
+
+
+class _Failure(object):
+    """ Carries an exception raised in the prefetch thread. """
+
+    def __init__(self, error):
+        self.error = error
+
+
+def extract_grids(grids, field, grid_size, params, rain, reader=None,
+                  geometry=None):
+    """ Yields each grid object together with the output of
+    extract_grid_data for that grid. If reader is given, grids are file
+    paths read with reader. The grid geometry is reused while it is
+    unchanged, starting from geometry if given. """
+    for item in grids:
+        grid_obj = item if reader is None else reader(item)
+        geometry = get_grid_geometry(grid_obj, grid_size, params, geometry)
+        yield grid_obj, extract_grid_data(
+            grid_obj, field, grid_size, params, rain, geometry
+        )
+
+
+def read_and_extract(item, reader, field, grid_size, params, rain,
+                     geometry):
+    """ Reads a grid from the file path item with reader, or takes item as
+    the grid if reader is None, and returns the grid together with the
+    output of extract_grid_data. Only the fields used in tracking are kept
+    on the returned grid, so that little more than the extracted arrays is
+    sent back from worker processes. """
+    grid_obj = item if reader is None else reader(item)
+    geometry = get_grid_geometry(grid_obj, grid_size, params, geometry)
+    extracted = extract_grid_data(grid_obj, field, grid_size, params, rain,
+                                  geometry)
+    keep = [field]
+    if rain:
+        keep.append('radar_estimated_rain_rate')
+    grid_obj.fields = dict((name, grid_obj.fields[name]) for name in keep)
+    return grid_obj, extracted
+
+
+def extract_grids_parallel(grids, field, grid_size, params, rain, workers,
+                           reader=None, geometry=None):
+    """ Yields each grid object together with the output of
+    extract_grid_data for that grid, with reading and extraction fanned
+    out to a pool of worker processes. If reader is given, grids are file
+    paths read in the workers; otherwise whole grid objects are sent to
+    the workers. geometry is an optional GridGeometry object of the grids,
+    reused by the workers while it matches. Results are yielded in scan
+    order. At most 2*workers grids are held in flight at once. """
+    in_flight = collections.deque()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for item in grids:
+            in_flight.append(executor.submit(
+                read_and_extract, item, reader, field, grid_size, params,
+                rain, geometry
+            ))
+            if len(in_flight) >= 2*workers:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def prefetch(items, depth):
+    """ Iterates over items in a background thread, keeping up to depth
+    items ready ahead of the consumer. Exceptions raised while producing
+    an item are re-raised in the consuming thread. """
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put(item):
+                    return
+            put(_End())
+        except Exception as error:
+            put(_Failure(error))
+
+    worker = threading.Thread(target=produce, name='tint-prefetch')
+    worker.daemon = True
+    worker.start()
+
+    try:
+        while True:
+            item = buffer.get()
+            if isinstance(item, _End):
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        worker.join()
+
+
+def get_scan_iterator(grids, field, grid_size, params, rain,
+                      prefetch_depth=0, workers=None, reader=None,
+                      geometry=None):
+    """ Returns an iterator over (grid_obj, extracted) pairs. If reader is
+    given, grids are file paths read with reader. If workers is given,
+    reading and extraction run in a pool of that many processes. If
+    prefetch_depth is positive, grids are read and extracted in a
+    background thread up to prefetch_depth scans ahead of the tracking
+    loop. geometry is an optional GridGeometry object of the grids. """
+    if workers is None or workers < 2:
+        scans = extract_grids(grids, field, grid_size, params, rain, reader,
+                              geometry)
+    else:
+        scans = extract_grids_parallel(
+            grids, field, grid_size, params, rain, workers, reader, geometry
+        )
+    if prefetch_depth > 0:
+        scans = prefetch(scans, prefetch_depth)
+    return scans
@@ -0,0 +1,187 @@
+"""
+tint.rain_io
+============
+
+Sinks for writing the accumulated rainfall of each object to disk as soon
+as the object dies.
+
+"""
+
+import threading
+import queue
+
+import numpy as np
+
+from .objects import sparse_to_dense
+
+try:
+    import netCDF4
+    _NETCDF4_AVAILABLE = True
+except ImportError:
+    _NETCDF4_AVAILABLE = False
+
+try:
+    import zarr
+    _ZARR_AVAILABLE = True
+except ImportError:
+    _ZARR_AVAILABLE = False
+
+
+ACC_RAIN_ATTRS = {
+    'long_name': 'Accumulated Rainfall',
+    'units': 'mm',
+    'standard_name': 'Accumulated Rainfall',
+    'description': ('Derived from rainfall rate algorithm based on '
+                    + 'Thompson et al. 2016, integrated in time.')
+}
+
+
+class NetCDFRainSink(object):
+    """
+    Appends the accumulated rainfall of each object to a NetCDF file as
+    one compressed (y, x) record along an unlimited uid dimension.
+
+    Attributes
+    ----------
+    path : str
+        Path of the NetCDF file.
+    shape : tuple
+        Shape (ny, nx) of each rainfall field.
+    dataset : Dataset
+        Open netCDF4 dataset.
+
+    """
+
+    def __init__(self, path, x, y, complevel=4):
+        if not _NETCDF4_AVAILABLE:
+            raise ImportError('netCDF4 is required to write NetCDF files.')
+        self.path = path
+        self.shape = (len(y), len(x))
+        self.dataset = netCDF4.Dataset(path, 'w')
+        self.dataset.createDimension('uid', None)
+        self.dataset.createDimension('y', len(y))
+        self.dataset.createDimension('x', len(x))
+        self.dataset.createVariable('y', 'f8', ('y',))[:] = y
+        self.dataset.createVariable('x', 'f8', ('x',))[:] = x
+        self.uid = self.dataset.createVariable('uid', str, ('uid',))
+        self.acc_rain = self.dataset.createVariable(
+            'acc_rain', 'f8', ('uid', 'y', 'x'), zlib=True,
+            complevel=complevel, chunksizes=(1,) + self.shape
+        )
+        self.acc_rain.setncatts(ACC_RAIN_ATTRS)
+
+    def write(self, uid, acc_rain):
+        """ Appends a sparse rainfall field for the object uid. """
+        i = len(self.dataset.dimensions['uid'])
+        self.uid[i] = uid
+        self.acc_rain[i] = sparse_to_dense([acc_rain], self.shape)[0]
+
+    def close(self):
+        self.dataset.close()
+
+
+class ZarrRainSink(object):
+    """
+    Appends the accumulated rainfall of each object to a Zarr group as one
+    (y, x) chunk along the uid dimension. The group can be opened with
+    xarray.open_zarr.
+
+    Attributes
+    ----------
+    path : str
+        Path of the Zarr group.
+    shape : tuple
+        Shape (ny, nx) of each rainfall field.
+    group : Group
+        Open Zarr group.
+
+    """
+
+    def __init__(self, path, x, y):
+        if not _ZARR_AVAILABLE:
+            raise ImportError('zarr is required to write Zarr stores.')
+        self.path = path
+        self.shape = (len(y), len(x))
+        self.group = zarr.open_group(path, mode='w')
+        for name, coord in [('y', y), ('x', x)]:
+            array = self.group.array(name, np.asarray(coord, dtype='f8'),
+                                     fill_value=None)
+            array.attrs['_ARRAY_DIMENSIONS'] = [name]
+        self.uid = self.group.zeros('uid', shape=(0,), chunks=(4096,),
+                                    dtype=str)
+        self.uid.attrs['_ARRAY_DIMENSIONS'] = ['uid']
+        self.acc_rain = self.group.create_dataset(
+            'acc_rain', shape=(0,) + self.shape, chunks=(1,) + self.shape,
+            dtype='f8', fill_value=None
+        )
+        self.acc_rain.attrs.update(ACC_RAIN_ATTRS)
+        self.acc_rain.attrs['_ARRAY_DIMENSIONS'] = ['uid', 'y', 'x']
+
+    def write(self, uid, acc_rain):
+        """ Appends a sparse rainfall field for the object uid. """
+        self.uid.append(np.array([uid], dtype=object))
+        self.acc_rain.append(sparse_to_dense([acc_rain], self.shape))
+
+    def close(self):
+        zarr.consolidate_metadata(self.group.store)
+
+
+class BackgroundRainSink(object):
+    """
+    Passes writes to another sink on a background thread, so that tracking
+    does not wait on compression and disk writes. Errors raised by the
+    wrapped sink are re-raised by close.
+
+    Attributes
+    ----------
+    sink : NetCDFRainSink or ZarrRainSink
+        Sink that performs the writes.
+
+    """
+
+    def __init__(self, sink, max_queue=64):
+        self.sink = sink
+        self.error = None
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run,
+                                        name='tint-rain-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    self.sink.write(*item)
+                except Exception as error:
+                    self.error = error
+
+    def write(self, uid, acc_rain):
+        """ Queues a sparse rainfall field for the object uid. """
+        self._queue.put((uid, acc_rain))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self.sink.close()
+        if self.error is not None:
+            raise self.error
+
+
+def open_rain_sink(path, grid_obj, background=True):
+    """ Returns a sink writing accumulated rainfall on the grid of grid_obj
+    to path. Paths ending in .zarr are written with Zarr, and all others
+    with NetCDF. If background is True, writes happen on a background
+    thread. """
+    x = np.asarray(grid_obj.x['data'])
+    y = np.asarray(grid_obj.y['data'])
+    if path.rstrip('/').endswith('.zarr'):
+        sink = ZarrRainSink(path, x, y)
+    else:
+        sink = NetCDFRainSink(path, x, y)
+    if background:
+        sink = BackgroundRainSink(sink)
+    return sink
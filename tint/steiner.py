@@ -1,200 +1,163 @@
 import numpy as np
 
 from numba import jit
-from numba import int32
+
+# Background reflectivity thresholds (dBZ) and the convective radius (m)
+# assigned below, between and above them, for each area relation.
+CONV_RADIUS_TABLE = {
+    0: ([30., 35., 40., 45.], [1000., 2000., 3000., 4000., 5000.]),
+    1: ([25., 30., 35., 40.], [1000., 2000., 3000., 4000., 5000.]),
+    2: ([20., 25., 30., 35.], [1000., 2000., 3000., 4000., 5000.]),
+    3: ([40., 45., 50., 55.], [0., 1000., 2000., 6000., 8000.]),
+}
+
+# Peakedness (dB) below 0 dBZ and above 42.43 dBZ background reflectivity
+# for each peak relation. Peakedness falls off as ze_bkg ** 2 / 180 between.
+PEAKEDNESS_TABLE = {0: (10., 0.), 1: (14., 4.)}
+
+
+def convective_radius(ze_bkg, area_relation):
+    """
+    Given mean background reflectivity values, we determine via a step
+    function what the corresponding convective radii would be.
+    Higher background reflectivitives are expected to have larger
+    convective influence on surrounding areas, so a larger convective
+    radius would be prescribed.
+    """
+    thresholds, radii = CONV_RADIUS_TABLE[area_relation]
+    return np.array(radii)[np.searchsorted(thresholds, ze_bkg, side='right')]
+
+
+def peakedness(ze_bkg, peak_relation):
+    """
+    Given background reflectivity values, we determine what the necessary
+    peakedness (or difference) has to be between a grid point's
+    reflectivity and the background reflectivity in order for that grid
+    point to be labeled convective.
+    """
+    low, high = PEAKEDNESS_TABLE[peak_relation]
+    with np.errstate(invalid='ignore'):
+        peak = np.where(ze_bkg < 42.43, low - ze_bkg ** 2 / 180., high)
+        return np.where(ze_bkg < 0., low, peak)
+
+
+def get_stencil_bounds(n, radius, d):
+    """ Returns the first and one past the last grid index of the stencil
+    of points within radius of each of n grid points spaced d apart. The
+    first row and column of the grid are never included. """
+    index = np.arange(n)
+    lower = np.maximum(1, (index - radius / d).astype(np.int32))
+    upper = np.minimum(n, (index + radius / d).astype(np.int32))
+    return lower, upper
+
+
+def get_background(refl, x, y, dx, dy, bkg_rad):
+    """ Returns the mean background reflectivity of each grid point,
+    calculated in linear units over the non-nan points within bkg_rad
+    and converted to decibel units. Points are accumulated one stencil
+    offset at a time, in the same order as a direct loop over each
+    point's stencil, so that sums are identical. """
+    ny, nx = refl.shape
+    imin, imax = get_stencil_bounds(nx, bkg_rad, dx)
+    jmin, jmax = get_stencil_bounds(ny, bkg_rad, dy)
+    i = np.arange(nx)
+    j = np.arange(ny)
+
+    ze_lin = 10. ** (refl / 10.)
+    sum_ze = np.zeros(refl.shape)
+    n = np.zeros(refl.shape, dtype=int)
+    for dl in range(np.min(imin - i), np.max(imax - i)):
+        l = np.clip(i + dl, 0, nx - 1)
+        col_ok = (imin <= i + dl) & (i + dl < imax)
+        x_sq = (x[l] - x[i]) ** 2
+        for dm in range(np.min(jmin - j), np.max(jmax - j)):
+            m = np.clip(j + dm, 0, ny - 1)
+            row_ok = (jmin <= j + dm) & (j + dm < jmax)
+            rad = np.sqrt(x_sq[np.newaxis, :]
+                          + ((y[m] - y[j]) ** 2)[:, np.newaxis])
+            shifted = ze_lin[np.ix_(m, l)]
+            ok = (row_ok[:, np.newaxis] & col_ok[np.newaxis, :]
+                  & ~np.isnan(shifted) & (rad <= bkg_rad))
+            sum_ze += np.where(ok, shifted, 0.)
+            n += ok
+
+    ze_bkg = np.full(refl.shape, np.inf)
+    ze_bkg[n > 0] = 10.0 * np.log10(sum_ze[n > 0] / n[n > 0])
+    return ze_bkg
 
 
 @jit(nopython=True)
+def paint_convective(sclass, refl, x, y, cores_i, cores_j, lmin, lmax,
+                     mmin, mmax, conv_rad):
+    """ Classifies each core point, in order, as convective along with the
+    non-nan points of its stencil within its convective radius. Cores that
+    have already been classified as convective by an earlier core do not
+    classify the points around them. """
+    for k in range(len(cores_i)):
+        i = cores_i[k]
+        j = cores_j[k]
+        if sclass[j, i] != 0:
+            continue
+        sclass[j, i] = 2
+        for l in range(lmin[k], lmax[k]):
+            for m in range(mmin[k], mmax[k]):
+                if not np.isnan(refl[m, l]):
+                    rad = np.sqrt((x[l] - x[i]) ** 2 + (y[m] - y[j]) ** 2)
+                    if rad <= conv_rad[k]:
+                        sclass[m, l] = 2
+
+
 def steiner_conv_strat(refl, x, y, dx, dy, intense=42, peak_relation=0,
                         area_relation=1, bkg_rad=11000, use_intense=True):
     """
     We perform the Steiner et al. (1995) algorithm for echo classification
     using only the reflectivity field in order to classify each grid point
     as either convective, stratiform or undefined. Grid points are
-    classified as follows,	
+    classified as follows,
     0 = Undefined
     1 = Stratiform
     2 = Convective
     """
-    def convective_radius(ze_bkg, area_relation):
-        """
-        Given a mean background reflectivity value, we determine via a step
-        function what the corresponding convective radius would be.
-        Higher background reflectivitives are expected to have larger
-        convective influence on surrounding areas, so a larger convective
-        radius would be prescribed.
-        """
-        if area_relation == 0:
-            if ze_bkg < 30:
-                conv_rad = 1000.
-            elif (ze_bkg >= 30) & (ze_bkg < 35.):
-                conv_rad = 2000.
-            elif (ze_bkg >= 35.) & (ze_bkg < 40.):
-                conv_rad = 3000.
-            elif (ze_bkg >= 40.) & (ze_bkg < 45.):
-                conv_rad = 4000.
-            else:
-                conv_rad = 5000.
-
-        if area_relation == 1:
-            if ze_bkg < 25:
-                conv_rad = 1000.
-            elif (ze_bkg >= 25) & (ze_bkg < 30.):
-                conv_rad = 2000.
-            elif (ze_bkg >= 30.) & (ze_bkg < 35.):
-                conv_rad = 3000.
-            elif (ze_bkg >= 35.) & (ze_bkg < 40.):
-                conv_rad = 4000.
-            else:
-                conv_rad = 5000.
-
-        if area_relation == 2:
-            if ze_bkg < 20:
-                conv_rad = 1000.
-            elif (ze_bkg >= 20) & (ze_bkg < 25.):
-                conv_rad = 2000.
-            elif (ze_bkg >= 25.) & (ze_bkg < 30.):
-                conv_rad = 3000.
-            elif (ze_bkg >= 30.) & (ze_bkg < 35.):
-                conv_rad = 4000.
-            else:
-                conv_rad = 5000.
-
-        if area_relation == 3:
-            if ze_bkg < 40:
-                conv_rad = 0.
-            elif (ze_bkg >= 40) & (ze_bkg < 45.):
-                conv_rad = 1000.
-            elif (ze_bkg >= 45.) & (ze_bkg < 50.):
-                conv_rad = 2000.
-            elif (ze_bkg >= 50.) & (ze_bkg < 55.):
-                conv_rad = 6000.
-            else:
-                conv_rad = 8000.
-
-        return conv_rad
-
-    def peakedness(ze_bkg, peak_relation):
-        """
-        Given a background reflectivity value, we determine what the necessary
-        peakedness (or difference) has to be between a grid point's
-        reflectivity and the background reflectivity in order for that grid
-        point to be labeled convective.
-        """
-        if peak_relation == 0:
-            if ze_bkg < 0.:
-                peak = 10.
-            elif (ze_bkg >= 0.) and (ze_bkg < 42.43):
-                peak = 10. - ze_bkg ** 2 / 180.
-            else:
-                peak = 0.
-
-        elif peak_relation == 1:
-            if ze_bkg < 0.:
-                peak = 14.
-            elif (ze_bkg >= 0.) and (ze_bkg < 42.43):
-                peak = 14. - ze_bkg ** 2 / 180.
-            else:
-                peak = 4.
-
-        return peak
-
-    sclass = np.zeros(refl.shape, dtype=int32)
+    refl = np.asarray(refl, dtype=np.float64)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
     ny, nx = refl.shape
-
-    for i in range(0, nx):
-        # Get stencil of x grid points within the background radius
-        imin = np.max(np.array([1, (i - bkg_rad / dx)], dtype=int32))
-        imax = np.min(np.array([nx, (i + bkg_rad / dx)], dtype=int32))
-
-        for j in range(0, ny):
-            # First make sure that the current grid point has not already been
-            # classified. This can happen when grid points within the
-            # convective radius of a previous grid point have also been
-            # classified.
-            if ~np.isnan(refl[j, i]) & (sclass[j, i] == 0):
-                # Get stencil of y grid points within the background radius
-                jmin = np.max(np.array([1, (j - bkg_rad / dy)], dtype=int32))
-                jmax = np.min(np.array([ny, (j + bkg_rad / dy)], dtype=int32))
-
-                n = 0
-                sum_ze = 0
-
-                # Calculate the mean background reflectivity for the current
-                # grid point, which will be used to determine the convective
-                # radius and the required peakedness.
-
-                for l in range(imin, imax):
-                    for m in range(jmin, jmax):
-                        if not np.isnan(refl[m, l]):
-                            rad = np.sqrt(
-                                (x[l] - x[i]) ** 2 + (y[m] - y[j]) ** 2)
-
-                        # The mean background reflectivity will first be
-                        # computed in linear units, i.e. mm^6/m^3, then
-                        # converted to decibel units.
-                            if rad <= bkg_rad:
-                                n += 1
-                                sum_ze += 10. ** (refl[m, l] / 10.)
-
-                if n == 0:
-                    ze_bkg = np.inf
-                else:
-                    ze_bkg = 10.0 * np.log10(sum_ze / n)
-
-                # Now get the corresponding convective radius knowing the mean
-                # background reflectivity.
-                conv_rad = convective_radius(ze_bkg, area_relation)
-
-                # Now we want to investigate the points surrounding the current
-                # grid point that are within the convective radius, and whether
-                # they too are convective, stratiform or undefined.
-
-                # Get stencil of x and y grid points within the convective
-                # radius.
-                lmin = np.max(
-                    np.array([1, int(i - conv_rad / dx)], dtype=int32))
-                lmax = np.min(
-                    np.array([nx, int(i + conv_rad / dx)], dtype=int32))
-                mmin = np.max(
-                    np.array([1, int(j - conv_rad / dy)], dtype=int32))
-                mmax = np.min(
-                    np.array([ny, int(j + conv_rad / dy)], dtype=int32))
-
-                if use_intense and (refl[j, i] >= intense):
-                    sclass[j, i] = 2
-
-                    for l in range(lmin, lmax):
-                        for m in range(mmin, mmax):
-                            if not np.isnan(refl[m, l]):
-                                rad = np.sqrt(
-                                    (x[l] - x[i]) ** 2
-                                    + (y[m] - y[j]) ** 2)
-
-                                if rad <= conv_rad:
-                                    sclass[m, l] = 2
-
-                else:
-                    peak = peakedness(ze_bkg, peak_relation)
-
-                    if refl[j, i] - ze_bkg >= peak:
-                        sclass[j, i] = 2
-
-                        for l in range(imin, imax):
-                            for m in range(jmin, jmax):
-                                if not np.isnan(refl[m, l]):
-                                    rad = np.sqrt(
-                                        (x[l] - x[i]) ** 2
-                                        + (y[m] - y[j]) ** 2)
-
-                                    if rad <= conv_rad:
-                                        sclass[m, l] = 2
-
-                    else:
-                        # If by now the current grid point has not been
-                        # classified as convective by either the intensity
-                        # criteria or the peakedness criteria, then it must be
-                        # stratiform.
-                        sclass[j, i] = 1
-
+    valid = ~np.isnan(refl)
+
+    # Calculate the mean background reflectivity for every grid point,
+    # which determines the convective radius and the required peakedness.
+    ze_bkg = get_background(refl, x, y, dx, dy, bkg_rad)
+    conv_rad = convective_radius(ze_bkg, area_relation)
+    peak = peakedness(ze_bkg, peak_relation)
+
+    # Core points are convective by either the intensity criteria or the
+    # peakedness criteria. Intense cores use stencils of the convective
+    # radius, and peaked cores the stencils of the background radius.
+    intense_core = valid & (refl >= intense) & use_intense
+    with np.errstate(invalid='ignore'):
+        peak_core = valid & ~intense_core & (refl - ze_bkg >= peak)
+
+    # Cores are visited in the same order as grid points were originally
+    # looped over, i.e. by x index, then by y index.
+    cores_i, cores_j = np.nonzero((intense_core | peak_core).T)
+    rad = conv_rad[cores_j, cores_i]
+    intense_k = intense_core[cores_j, cores_i]
+
+    imin, imax = get_stencil_bounds(nx, bkg_rad, dx)
+    jmin, jmax = get_stencil_bounds(ny, bkg_rad, dy)
+    lmin = np.where(intense_k, np.maximum(1, (cores_i - rad / dx)
+                                          .astype(np.int32)), imin[cores_i])
+    lmax = np.where(intense_k, np.minimum(nx, (cores_i + rad / dx)
+                                           .astype(np.int32)), imax[cores_i])
+    mmin = np.where(intense_k, np.maximum(1, (cores_j - rad / dy)
+                                          .astype(np.int32)), jmin[cores_j])
+    mmax = np.where(intense_k, np.minimum(ny, (cores_j + rad / dy)
+                                           .astype(np.int32)), jmax[cores_j])
+
+    sclass = np.zeros(refl.shape, dtype=np.int32)
+    paint_convective(sclass, refl, x, y, cores_i, cores_j, lmin, lmax, mmin,
+                     mmax, rad)
+
+    # Any remaining grid points must be stratiform.
+    sclass[valid & (sclass == 0)] = 1
     return sclass
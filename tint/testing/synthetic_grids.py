@@ -0,0 +1,53 @@
+""" Synthetic grids for unit tests that do not need the sample grid file. """
+
+import datetime
+
+import numpy as np
+import pyart
+
+# Echoes as (x, y, u, v, peak, width), with positions and widths in meters
+# and motion in meters per scan.
+ECHOES = [(-20000., -15000., 2500., 1500., 52., 5000.),
+          (15000., 10000., -2000., 1000., 48., 4000.),
+          (10000., -20000., -1000., 2500., 45., 3500.),
+          (-25000., 25000., 1500., -2000., 50., 4500.)]
+
+
+def make_grid(scan, echoes=ECHOES, n=40, nz=6, start=None, interval=600):
+    """ Returns a pyart grid of reflectivity and rain rate for the given
+    scan number, containing Gaussian echoes that move steadily from scan to
+    scan. Grid spacing is 2500 m horizontally and 500 m vertically, and
+    scans are interval seconds apart from start. """
+    if start is None:
+        start = datetime.datetime(2020, 1, 1)
+    x = np.arange(n) * 2500. - n * 1250.
+    z = np.arange(nz) * 500.
+    X, Y = np.meshgrid(x, x)
+    refl = np.zeros((nz, n, n))
+    for x0, y0, u, v, peak, width in echoes:
+        echo = peak * np.exp(-((X - x0 - u*scan)**2 + (Y - y0 - v*scan)**2)
+                             / (2 * width**2))
+        for k in range(nz):
+            refl[k] = np.maximum(refl[k], echo * (1 - k / (nz + 4)))
+    refl[refl < 5] = 0
+
+    time = datetime.timedelta(seconds=interval*scan) + start
+    time = {'data': np.array([0.]), 'calendar': 'gregorian',
+            'units': time.strftime('seconds since %Y-%m-%dT%H:%M:%SZ')}
+    fields = {
+        'reflectivity': {'data': np.ma.masked_array(refl),
+                         '_FillValue': -9999.},
+        'radar_estimated_rain_rate': {
+            'data': np.ma.masked_array(np.maximum(refl - 20, 0) / 2),
+            '_FillValue': -9999.
+        }
+    }
+    origin_lat = {'data': np.array([-12.25])}
+    origin_lon = {'data': np.array([131.04])}
+    origin_alt = {'data': np.array([0.])}
+    return pyart.core.Grid(
+        time, fields, {}, origin_lat, origin_lon, origin_alt,
+        {'data': x}, {'data': x}, {'data': z},
+        radar_latitude=origin_lat, radar_longitude=origin_lon,
+        radar_altitude=origin_alt
+    )
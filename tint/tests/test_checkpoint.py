@@ -0,0 +1,46 @@
+""" Unit tests for checkpoint module. """
+
+import os
+import tempfile
+
+import numpy as np
+
+from tint.checkpoint import write_checkpoint, read_checkpoint
+from tint.helpers import ColumnBuffer
+
+
+def test_checkpoint_round_trip():
+    buffer = ColumnBuffer(index=['scan', 'uid'])
+    buffer.append({'scan': 0, 'uid': ['0', '1'], 'area': [1., 2.]})
+    path = os.path.join(tempfile.mkdtemp(), 'tracks.ckpt')
+    write_checkpoint({'buffer': buffer, 'frame': np.eye(3, dtype=int)}, path)
+    write_checkpoint({'buffer': buffer, 'frame': np.eye(4, dtype=int)}, path)
+
+    state = read_checkpoint(path)
+    assert os.listdir(os.path.dirname(path)) == ['tracks.ckpt']
+    assert state['frame'].shape == (4, 4)
+    assert state['buffer'].to_frame().loc[(0, '1'), 'area'] == 2.
+
+
+def test_checkpoint_buffer_segments():
+    buffer = ColumnBuffer(index=['scan', 'uid'])
+    path = os.path.join(tempfile.mkdtemp(), 'tracks.ckpt')
+    for scan in range(3):
+        buffer.append({'scan': scan, 'uid': ['0', '1'], 'area': [1., 2.]})
+        write_checkpoint({}, path, buffers={'tracks': buffer})
+    assert [segment[1:] for segment in buffer.segments] == [
+        (0, 2), (2, 2), (4, 2)
+    ]
+
+    buffer.truncate(3)
+    buffer.append({'scan': 3, 'uid': ['0'], 'area': [3.]})
+    write_checkpoint({}, path, buffers={'tracks': buffer})
+    assert [segment[1:] for segment in buffer.segments] == [
+        (0, 2), (2, 1), (3, 1)
+    ]
+    assert len(os.listdir(os.path.dirname(path))) == 4
+
+    state = read_checkpoint(path)
+    tracks = state['buffers']['tracks'].to_frame()
+    assert list(tracks.index) == [(0, '0'), (0, '1'), (1, '0'), (3, '0')]
+    assert tracks.loc[(3, '0'), 'area'] == 3.
@@ -0,0 +1,75 @@
+""" Unit tests for chunking module. """
+
+from datetime import datetime, timedelta
+import functools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from tint import Cell_tracks
+from tint.chunking import get_chunks, stitch_tracks, get_chunked_tracks
+from tint.testing.synthetic_grids import make_grid
+
+
+def test_get_chunks_overlap():
+    chunks = get_chunks(10, 4, 2)
+    assert [(c['own_lo'], c['own_hi']) for c in chunks] == [(0, 4), (4, 8),
+                                                            (8, 10)]
+    assert [(c['lo'], c['hi']) for c in chunks] == [(0, 7), (2, 10), (6, 10)]
+
+
+def test_get_chunks_time_gap():
+    times = [datetime(2006, 1, 1) + timedelta(minutes=10*i)
+             for i in range(8)]
+    times[5:] = [t + timedelta(hours=2) for t in times[5:]]
+    chunks = get_chunks(8, 100, 2, times)
+    assert [(c['lo'], c['hi'], c['own_lo'], c['own_hi'])
+            for c in chunks] == [(0, 5, 0, 4), (4, 8, 4, 8)]
+
+
+def make_chunk_tracks(scans, objects):
+    """ Returns a tracks dataframe with one row per scan for each of
+    objects, a list of (uid, x, y, parents) tuples. """
+    rows = []
+    for scan in scans:
+        for uid, x, y, parents in objects:
+            rows.append({'scan': scan, 'time': datetime(2006, 1, 1),
+                         'level': 0, 'uid': uid, 'grid_x': x, 'grid_y': y,
+                         'com_x': x, 'com_y': y, 'mergers': set(),
+                         'parent': set(parents)})
+    return pd.DataFrame(rows).set_index(['scan', 'time', 'level', 'uid'])
+
+
+def test_stitch_tracks():
+    chunks = get_chunks(6, 3, 2)
+    assert [(c['lo'], c['hi']) for c in chunks] == [(0, 6), (1, 6)]
+    first = make_chunk_tracks(range(6), [('a', 0., 0., []),
+                                         ('b', 5000., 0., [])])
+    # The second chunk sees the same objects with floating point noise and
+    # its own uids, and a new object splitting from the second.
+    second = make_chunk_tracks(range(5), [('b2', 5000. + 1e-9, 0., []),
+                                          ('a2', 0., 1e-9, [])])
+    second = pd.concat([second, make_chunk_tracks(
+        range(3, 5), [('c2', 5200., 0., ['b2'])]
+    )])
+    tracks = stitch_tracks(chunks, [first, second], 0, 250.)
+
+    uids = tracks.index.get_level_values('uid')
+    scans = tracks.index.get_level_values('scan')
+    assert set(uids[tracks['grid_x'] < 100]) == {'0'}
+    assert set(uids[np.abs(tracks['grid_x'] - 5000) < 1]) == {'1'}
+    assert set(uids[tracks['grid_x'] == 5200]) == {'2'}
+    assert set(scans[uids == '0']) == set(range(6))
+    assert tracks.xs('2', level='uid')['parent'].iloc[0] == {'1'}
+
+
+def test_get_chunked_tracks_empty():
+    reader = functools.partial(make_grid, echoes=[])
+    tracks, record = get_chunked_tracks(Cell_tracks(), list(range(6)), 3, 1,
+                                        workers=1, reader=reader)
+    assert len(tracks) == 0
+    assert np.all(record.grid_size == [500., 2500., 2500.])
+    with pytest.raises(ValueError):
+        get_chunked_tracks(Cell_tracks(), [], 3, 1, workers=1,
+                           reader=reader)
@@ -0,0 +1,67 @@
+""" Unit tests for grid_utils module that build their inputs
+synthetically. """
+
+import numpy as np
+
+from tint import grid_utils
+from tint.testing.synthetic_grids import make_grid
+from tint.tracks import Cell_tracks
+
+
+def test_get_connected_components():
+    frames = np.zeros((2, 4, 6), dtype=int)
+    frames[0, 0, 0:2] = 1
+    frames[0, 2, 0:2] = 2
+    frames[0, 0:3, 4] = 3
+    frames[1, 0:3, 0] = 1
+    frames[1, 3, 3:6] = 2
+    frames_con, frames = grid_utils.get_connected_components(frames)
+    # Objects 1 and 2 join through object 1 above; object 3 and the upper
+    # object 2 are not present at both levels.
+    assert np.all(frames_con[1, 0:3, 0] == 1)
+    assert np.all(frames_con[0, [0, 2], 0:2] == 1)
+    assert frames_con.max() == 1
+    assert frames[1].max() == 5
+
+
+def test_clear_small_echoes_system():
+    images_con = np.zeros((2, 5, 5), dtype=int)
+    images_con[:, 0, 1:4] = 1
+    images_con[0, 2:5, 2] = 2
+    images_con[1, 2, 2] = 2
+    images_con[:, 4, 4] = 3
+    cleared = grid_utils.clear_small_echoes_system(images_con, [2, 1])
+    assert np.all(cleared[:, 0, 1:4] == 1)
+    assert np.all(cleared[0, 2:5, 2] == 2)
+    assert cleared[:, 4, 4].max() == 0
+    assert cleared.max() == 2
+
+
+def test_scan_products():
+    products = grid_utils.ScanProducts([(1, None)])
+    raw3D = np.zeros((3, 8, 8))
+    raw3D[2, 4, 4] = 40.
+    smooth = products.get_smooth_max_proj(raw3D, 1)
+    assert products.get_smooth_max_proj(raw3D, 1) is smooth
+    assert np.unravel_index(smooth.argmax(), smooth.shape) == (4, 4)
+    assert products.max_proj[4, 4] == 40.
+    assert products.sclasses == [None]
+
+
+def test_grid_geometry():
+    grid = make_grid(0)
+    grid_size = grid_utils.get_grid_size(grid)
+    params = Cell_tracks().params
+    geometry = grid_utils.get_grid_geometry(grid, grid_size, params)
+    assert grid_utils.get_grid_geometry(grid, grid_size, params,
+                                        geometry) is geometry
+    lon, lat = geometry.get_grid_lonlat()
+    assert lon.shape == (len(grid.y['data']), len(grid.x['data']))
+    point_lon, point_lat = geometry.get_geographic(
+        grid.x['data'][[0, 2]], grid.y['data'][[1, 1]]
+    )
+    assert np.allclose(point_lon, lon[1, [0, 2]])
+    assert np.allclose(point_lat, lat[1, [0, 2]])
+    products = grid_utils.get_scan_products(grid, grid_size, params,
+                                            geometry)
+    assert products.level_indices == geometry.level_indices
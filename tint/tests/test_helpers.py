@@ -0,0 +1,61 @@
+""" Unit tests for helpers module. """
+
+import datetime
+
+import numpy as np
+
+from tint.helpers import ColumnBuffer, Record
+from tint.testing.synthetic_grids import make_grid
+
+
+def test_column_buffer():
+    buffer = ColumnBuffer(index=['scan', 'uid'])
+    for scan in range(40):
+        buffer.append({'scan': scan, 'uid': ['1', '0'],
+                       'area': [1, 2.5], 'mergers': [set(), {'2'}]})
+    assert len(buffer) == 80
+    assert buffer.columns['area'].dtype == np.float64
+
+    buffer.truncate(np.searchsorted(buffer.get_column('scan'), 30))
+    tracks = buffer.to_frame()
+    assert len(tracks) == 60
+    assert tracks.index[0] == (0, '0')
+    assert tracks.loc[(29, '0'), 'mergers'] == {'2'}
+    assert tracks.loc[(29, '1'), 'area'] == 1
+
+
+def test_column_buffer_new_columns():
+    buffer = ColumnBuffer(index=['scan'])
+    buffer.append({'scan': [0, 1]})
+    buffer.append({'scan': [2], 'area': [3], 'uid': ['5']})
+    tracks = buffer.to_frame()
+    assert np.all(np.isnan(tracks['area'][[0, 1]]))
+    assert tracks.loc[2, 'area'] == 3
+    assert list(tracks['uid']) == [None, None, '5']
+
+    try:
+        buffer.append({'scan': [3], 'area': [4]})
+    except ValueError:
+        pass
+    else:
+        assert False
+    assert len(buffer) == 3
+
+
+def test_record_motion():
+    record = Record(make_grid(0))
+    record.scan = 0
+    motion_field = {'row_starts': np.array([0, 4]),
+                    'col_starts': np.array([0]), 'size': (8, 8),
+                    'shifts': np.array([[[1., 2.]], [[np.nan, np.nan]]])}
+    for seconds in [0, -600]:
+        record.interval = datetime.timedelta(seconds=seconds)
+        record.record_motion(motion_field)
+    assert len(record.motion_buffer) == 0
+
+    record.interval = datetime.timedelta(days=1, seconds=600)
+    record.record_motion(motion_field)
+    motion = record.motion
+    assert motion.loc[(0, 3.5, 3.5), 'u'] == 2 * 2500. / 87000
+    assert motion.loc[(0, 3.5, 3.5), 'v'] == 2500. / 87000
+    assert np.isnan(motion.loc[(0, 7.5, 3.5), 'u'])
@@ -0,0 +1,78 @@
+""" Unit tests for matching module that build their inputs synthetically. """
+
+from tint.matching import match_pairs, match_pairs_sparse
+from tint.matching import save_obj_match, save_obj_edges, LARGE_NUM
+from tint.matching import get_search_boxes, find_all_objects
+from tint.matching import shift_labels, get_overlaps
+
+import numpy as np
+from scipy import ndimage
+
+
+def test_match_pairs_sparse():
+    rng = np.random.default_rng(0)
+    params = {'MAX_DISPARITY': 20}
+    obj_match = np.full((30, 35), LARGE_NUM, dtype='f')
+    edges = {'rows': [], 'cols': [], 'costs': [], 'shape': (30, 35)}
+    for row in range(30):
+        cols = rng.choice(35, rng.integers(0, 4), replace=False)
+        obj_found = np.append(0, cols + 1)
+        disparity = rng.random(len(cols)) * 30
+        obj_match = save_obj_match(row + 1, obj_found, disparity.copy(),
+                                   obj_match, params)
+        edges = save_obj_edges(row + 1, obj_found, disparity.copy(), edges,
+                               params)
+    pairs, obj_merge = match_pairs(obj_match, params)
+    pairs_sparse, obj_merge_sparse = match_pairs_sparse(edges, params)
+    assert np.all(pairs == pairs_sparse)
+    assert np.all(obj_merge == obj_merge_sparse)
+
+
+def test_find_all_objects():
+    rng = np.random.default_rng(0)
+    image2 = ndimage.label(rng.random((40, 50)) > 0.7)[0]
+    obj_centers = rng.random((25, 2)) * 50 - 5
+    shifts = rng.integers(-3, 4, (25, 2))
+    params = {'SEARCH_MARGIN': 4000}
+    grid_size = np.array([500., 1000., 1000.])
+    boxes = get_search_boxes(obj_centers, shifts, params, grid_size,
+                             image2.shape)
+    objs_found = find_all_objects(boxes, image2)
+    for k in range(25):
+        if not boxes['valid'][k]:
+            assert objs_found[k] == -1
+            continue
+        region = image2[boxes['x1'][k]:boxes['x2'][k],
+                        boxes['y1'][k]:boxes['y2'][k]]
+        expected = np.unique(region)
+        assert np.all(objs_found[k] == expected[expected > 0])
+
+
+def test_shift_labels():
+    image = np.arange(12).reshape(3, 4)
+    shifted = shift_labels(image, [1, -2])
+    assert np.all(shifted[0] == 0)
+    assert np.all(shifted[1:, :2] == image[:2, 2:])
+    assert np.all(shifted[:, 2:] == 0)
+
+
+def test_get_overlaps():
+    image1 = np.array([[1, 1, 0], [2, 2, 2]])
+    image2 = np.array([[0, 1, 1], [1, 3, 0]])
+    overlaps = get_overlaps(image1, image2)
+    assert np.all(overlaps == [[1, 0, 0], [1, 0, 1]])
+
+
+def test_find_all_objects_missing_labels():
+    image2 = np.zeros((30, 30), dtype=int)
+    image2[2:5, 2:25] = 3
+    image2[20:22, 20:22] = 5
+    boxes = {'x1': np.array([0, 15, 25]), 'x2': np.array([8, 25, 30]),
+             'y1': np.array([20, 15, 0]), 'y2': np.array([28, 25, 10]),
+             'valid': np.array([True, True, False])}
+    objs_found = find_all_objects(boxes, image2)
+    assert np.all(objs_found[0] == [3])
+    assert np.all(objs_found[1] == [5])
+    assert objs_found[2] == -1
+    objs_found = find_all_objects(boxes, np.zeros((30, 30), dtype=int))
+    assert len(objs_found[0]) == 0 and len(objs_found[1]) == 0
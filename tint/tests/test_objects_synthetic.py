@@ -0,0 +1,157 @@
+""" Unit tests for objects module that build their inputs synthetically. """
+
+from types import SimpleNamespace
+
+import numpy as np
+from skimage.measure import regionprops
+from numpy.testing import assert_allclose
+
+from tint import objects, grid_utils
+from tint.helpers import Counter
+
+
+def test_sparse_rain():
+    frames = np.zeros((2, 4, 4), dtype=int)
+    frames[:, 0, :2] = 1
+    frames[1, 2:, 3] = 2
+    footprints = objects.get_footprints(frames, 2)
+    assert np.all(footprints[0] == [0, 1])
+    assert np.all(footprints[1] == [11, 15])
+
+    tot_rain = (footprints[0], np.array([1., 2.]))
+    tot_rain = objects.add_sparse(tot_rain, np.array([1, 5]),
+                                  np.array([3., 4.]))
+    assert np.all(tot_rain[0] == [0, 1, 5])
+    assert np.all(tot_rain[1] == [1., 5., 4.])
+    assert objects.get_sparse_max(tot_rain, (4, 4)) == (5., [0, 1])
+
+    dense = objects.sparse_to_dense([tot_rain], (4, 4))
+    assert dense.shape == (1, 4, 4)
+    assert dense[0, 1, 1] == 4.
+
+
+def test_get_obj_extents():
+    rng = np.random.default_rng(0)
+    labeled = rng.integers(0, 6, (12, 15))
+    labeled[labeled == 4] = 0
+    extents = objects.get_obj_extents(labeled)
+    assert extents['obj_area'][3] == 0
+    assert np.isnan(extents['obj_radius'][3])
+    for obj in [1, 2, 3, 5]:
+        extent = objects.get_obj_extent(labeled, obj)
+        assert extents['obj_area'][obj-1] == extent['obj_area']
+        assert extents['obj_radius'][obj-1] == extent['obj_radius']
+        assert np.all(extents['obj_center'][obj-1] == extent['obj_center'])
+
+
+def test_get_label_stats():
+    rng = np.random.default_rng(1)
+    labeled = rng.integers(0, 5, (10, 12))
+    labeled[labeled == 3] = 0
+    col_max = rng.normal(size=labeled.shape)
+    col_count = rng.integers(0, 4, labeled.shape)
+    col_top = np.where(col_count > 0, rng.integers(0, 6, labeled.shape), -1)
+    border = np.zeros(labeled.shape, dtype=int)
+    border[0] = 1
+    stats = objects.get_label_stats(labeled, 5, col_max, col_count, col_top,
+                                    border)
+    assert stats['area'][2] == 0 and stats['area'][4] == 0
+    assert np.isnan(stats['field_max'][2])
+    assert np.all(np.isnan(stats['center'][4]))
+    for obj in [1, 2, 4]:
+        mask = labeled == obj
+        assert stats['area'][obj-1] == np.sum(mask)
+        assert np.all(stats['center'][obj-1]
+                      == np.median(np.argwhere(mask), axis=0))
+        assert stats['field_max'][obj-1] == np.max(col_max[mask])
+        assert stats['count'][obj-1] == np.sum(col_count[mask])
+        assert stats['top'][obj-1] == np.max(col_top[mask])
+        assert stats['border'][obj-1] == np.sum(mask[0])
+
+
+def test_get_ellipse_props():
+    rng = np.random.default_rng(2)
+    labeled = rng.integers(0, 4, (15, 20))
+    labeled[labeled == 2] = 0
+    intensity = rng.uniform(10, 50, labeled.shape)
+    ellipse = objects.get_ellipse_props(labeled, intensity, 3)
+    assert np.all(np.isnan(ellipse['centroid'][1]))
+    for props in regionprops(labeled, intensity):
+        for attr in ['centroid', 'weighted_centroid', 'major_axis_length',
+                     'minor_axis_length', 'eccentricity', 'orientation']:
+            assert_allclose(ellipse[attr][props.label-1],
+                            getattr(props, attr))
+
+
+def test_identify_updrafts():
+    raw3D = np.zeros((4, 12, 12))
+    raw3D[1, 3, 3] = raw3D[2, 4, 4] = raw3D[3, 4, 5] = 40.
+    raw3D[1, 8, 8] = raw3D[2, 8, 8] = 40.
+    raw3D[2, 10, 2] = 40.
+    products = grid_utils.ScanProducts([(1, None)])
+    products.sclasses[0] = np.full((12, 12), 2)
+    updraft_params = {'FIELD_THRESH': ['convective'], 'UPDRAFT_THRESH': 25,
+                      'UPDRAFT_WORKERS': 2}
+    local_max = objects.get_local_maxima(raw3D, 1, updraft_params)
+    assert [len(l_max) for l_max in local_max] == [2, 3, 1]
+    record = SimpleNamespace(grid_size=np.array([500., 500., 500.]))
+    updrafts = objects.identify_updrafts(raw3D, None, None, record,
+                                         updraft_params, products)
+    assert len(updrafts) == 2
+    assert np.all(np.array(updrafts[0]) == [[1, 3, 3], [2, 4, 4], [3, 4, 5]])
+    assert np.all(np.array(updrafts[1]) == [[1, 8, 8], [2, 8, 8]])
+
+
+def test_get_split_pairs():
+    frame0 = np.zeros((4, 6), dtype=int)
+    frame0[:2, :4] = 1
+    frame0[3, 4:] = 2
+    frame1 = np.zeros((4, 6), dtype=int)
+    frame1[0, :2] = 1
+    frame1[1, 2:4] = 2
+    frame1[3, 5] = 3
+    old_objects = {'id1': np.array([1, 2]), 'uid': np.array(['5', '6'])}
+    split_pairs = objects.get_split_pairs(frame0, frame1, old_objects,
+                                          {'5': 0, '7': 1})
+    assert split_pairs == {1: {'5'}, 2: {'5'}}
+
+
+def make_update_inputs(old_uids):
+    """ Returns arguments of update_current_objects for a scan with three
+    objects, the first continuing the first old object if old_uids has
+    one, and a counter that has assigned uids up to 9. """
+    frame1 = np.zeros((6, 6), dtype=int)
+    frame1[0, 0] = 1
+    frame1[2, 2] = 2
+    frame1[4, 4] = 3
+    nold = len(old_uids)
+    old_objects = {'id1': np.arange(nold) + 1,
+                   'uid': np.array(old_uids),
+                   'id2': np.array([1] + [0] * (nold - 1))[:nold],
+                   'obs_num': np.zeros(nold, dtype='i'),
+                   'mergers': [set() for u in old_uids],
+                   'parents': [set() for u in old_uids],
+                   'tot_rain': [None for u in old_uids]}
+    update_counter = Counter()
+    update_counter.uid = 9
+    raw = np.ones((6, 6))
+    return (raw, raw, None, None, frame1, frame1, frame1, frame1[np.newaxis],
+            frame1[np.newaxis], None, np.zeros(3, dtype=int), old_objects,
+            update_counter, np.zeros((nold, 3), dtype=bool), 600, False,
+            False)
+
+
+def test_update_current_objects_new_uids():
+    current_objects = objects.update_current_objects(
+        *make_update_inputs(['9'])
+    )[0]
+    assert list(current_objects['uid']) == ['9', '10', '11']
+    assert current_objects['uid'].ndim == 1
+
+
+def test_update_current_objects_all_new():
+    current_objects = objects.update_current_objects(
+        *make_update_inputs([])
+    )[0]
+    assert list(current_objects['uid']) == ['10', '11', '12']
+    assert current_objects['uid'].ndim == 1
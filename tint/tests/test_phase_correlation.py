@@ -0,0 +1,88 @@
+""" Unit tests for phase_correlation module. """
+
+import numpy as np
+
+from tint.phase_correlation import fft_crosscov, fft_shift, SpectrumCache
+from tint.phase_correlation import get_ambient_flow, get_ambient_flows
+from tint.phase_correlation import get_motion_field, get_field_flow
+from tint.phase_correlation import get_global_shift
+
+
+def test_fft_crosscov():
+    rng = np.random.default_rng(0)
+    im1 = rng.random((20, 25))
+    im2 = rng.random((20, 25))
+    expected = np.fft.ifft2(
+        np.fft.fft2(im2)*np.conj(np.fft.fft2(im1))
+        / abs(np.fft.fft2(im2)*np.conj(np.fft.fft2(im1)))
+    )
+    crosscov = fft_crosscov(im1, im2)
+    assert np.allclose(crosscov, fft_shift(np.real(expected)))
+
+
+def test_spectrum_cache():
+    im1 = np.zeros((16, 16))
+    im1[4:8, 4:8] = 40
+    im2 = np.roll(im1, (2, 3), axis=(0, 1))
+    cache = SpectrumCache()
+    fft_crosscov(im1, im2, cache)
+    spectrum = cache.spectrum
+    assert cache.image is im2
+    fft_crosscov(im2, im1, cache)
+    assert cache.image is im1
+    assert cache.rfft2(im1) is cache.spectrum
+    assert spectrum is not cache.spectrum
+
+
+def test_get_ambient_flows():
+    rng = np.random.default_rng(1)
+    raw1 = np.zeros((40, 40))
+    raw1[5:30, 5:30] = rng.random((25, 25))
+    raw2 = np.roll(raw1, (2, -1), axis=(0, 1))
+    grid_size = np.array([500., 1000., 1000.])
+    extents = [{'obj_center': np.array(center), 'obj_radius': radius}
+               for center, radius in [((10, 10), 2), ((20, 10), 2),
+                                      ((15, 20), 4), ((36, 36), 1)]]
+    for flow_workers in [1, 3]:
+        params = {'FLOW_MARGIN': 5000, 'FFT_WORKERS': 1,
+                  'FLOW_WORKERS': flow_workers}
+        shifts = get_ambient_flows(extents, raw1, raw2, params, grid_size)
+        for extent, shift in zip(extents, shifts):
+            expected = get_ambient_flow(extent, raw1, raw2, params,
+                                        grid_size)
+            if expected is None:
+                assert shift is None
+            else:
+                assert np.all(shift == expected)
+
+
+def test_get_motion_field():
+    raw1 = np.zeros((30, 50))
+    raw1[4:8, 4:8] = 40
+    raw2 = np.roll(raw1, (1, 2), axis=(0, 1))
+    params = {'FLOW_MARGIN': 5000, 'FFT_WORKERS': 1}
+    grid_size = np.array([500., 1000., 1000.])
+    motion_field = get_motion_field(raw1, raw2, params, grid_size)
+    assert list(motion_field['row_starts']) == [0, 5, 10, 15, 20]
+    assert list(motion_field['col_starts'][-2:]) == [35, 40]
+    assert motion_field['shifts'].shape == (5, 9, 2)
+    assert list(motion_field['shifts'][0, 0]) == [1, 2]
+    assert np.all(np.isnan(motion_field['shifts'][-1, -1]))
+
+    extent = {'obj_center': np.array([2, 2])}
+    assert list(get_field_flow(motion_field, extent)) == [1, 2]
+    extent = {'obj_center': np.array([25, 45])}
+    assert get_field_flow(motion_field, extent) is None
+
+
+def test_get_global_shift_pyramid():
+    rows, cols = np.mgrid[0:200, 0:240]
+    im1 = 50 * np.exp(-((rows - 80)**2 + (cols - 100)**2) / 200.)
+    im1 += 30 * np.exp(-((rows - 150)**2 + (cols - 60)**2) / 100.)
+    im2 = np.roll(im1, (7, -5), axis=(0, 1))
+    params = {'FFT_WORKERS': 1, 'GS_PYRAMID': 0, 'GS_WINDOW': 64}
+    assert list(get_global_shift(im1, im2, params)) == [7, -5]
+    params['GS_PYRAMID'] = 2
+    assert list(get_global_shift(im1, im2, params)) == [7, -5]
+    assert list(get_global_shift(im1, im2, params, estimate=[4, -2])) == [7,
+                                                                         -5]
@@ -0,0 +1,68 @@
+""" Unit tests for pipeline module. """
+
+import numpy as np
+import pyart
+
+from tint import Cell_tracks
+from tint.grid_utils import get_grid_size
+from tint.pipeline import prefetch, extract_grids, extract_grids_parallel
+
+
+def test_prefetch_order():
+    items = list(prefetch(iter(range(20)), 3))
+    assert items == list(range(20))
+
+
+def test_prefetch_error():
+    def failing():
+        yield 1
+        raise ValueError('bad grid')
+
+    items = []
+    try:
+        for item in prefetch(failing(), 2):
+            items.append(item)
+    except ValueError:
+        pass
+    else:
+        assert False
+    assert items == [1]
+
+
+def read_test_grid(t):
+    """ Returns a small grid with two echoes moving one pixel per scan,
+    for scan number t. """
+    x = np.arange(20) * 1000.
+    z = np.arange(4) * 500.
+    refl = np.zeros((4, 20, 20))
+    refl[:, 2:6, 2+t:8+t] = 45.
+    refl[:, 12:17, 12-t:18-t] = 50.
+    time = {'data': np.array([0.]), 'calendar': 'gregorian',
+            'units': 'seconds since 2020-01-01T00:{:02d}:00Z'.format(10*t)}
+    fields = {'reflectivity': {'data': np.ma.masked_array(refl),
+                               '_FillValue': -9999.},
+              'radar_estimated_rain_rate': {
+                  'data': np.ma.masked_array(refl / 10),
+                  '_FillValue': -9999.},
+              'velocity': {'data': np.ma.masked_array(refl)}}
+    origin = {'data': np.array([0.])}
+    return pyart.core.Grid(time, fields, {}, origin, origin, origin,
+                           {'data': x}, {'data': x}, {'data': z})
+
+
+def test_extract_grids_parallel():
+    params = Cell_tracks().params
+    grid_size = get_grid_size(read_test_grid(0))
+    serial = list(extract_grids(range(5), 'reflectivity', grid_size,
+                                params, True, read_test_grid))
+    parallel = list(extract_grids_parallel(range(5), 'reflectivity',
+                                           grid_size, params, True, 2,
+                                           read_test_grid))
+    assert len(parallel) == 5
+    for (grid1, data1), (grid2, data2) in zip(serial, parallel):
+        assert grid1.time['units'] == grid2.time['units']
+        assert 'velocity' not in grid2.fields
+        assert np.max(data2[2]) > 0
+        for array1, array2 in zip(data1[:4], data2[:4]):
+            assert np.array_equal(array1, array2)
+        assert data1[4].level_indices == data2[4].level_indices
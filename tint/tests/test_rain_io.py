@@ -0,0 +1,48 @@
+""" Unit tests for rain_io module. """
+
+import os
+import tempfile
+
+import numpy as np
+import netCDF4
+import pytest
+
+from tint.rain_io import NetCDFRainSink, ZarrRainSink, BackgroundRainSink
+
+
+def test_netcdf_rain_sink():
+    x = np.arange(4) * 2500.
+    y = np.arange(3) * 2500.
+    path = os.path.join(tempfile.mkdtemp(), 'acc_rain.nc')
+    sink = BackgroundRainSink(NetCDFRainSink(path, x, y))
+    sink.write('3', (np.array([0, 5]), np.array([1.5, 2.])))
+    sink.write('7', (np.array([11]), np.array([4.], dtype='f4')))
+    sink.close()
+
+    dataset = netCDF4.Dataset(path)
+    assert list(dataset['uid'][:]) == ['3', '7']
+    acc_rain = dataset['acc_rain'][:]
+    assert acc_rain.shape == (2, 3, 4)
+    assert acc_rain[0, 1, 1] == 2.
+    assert acc_rain[1, 2, 3] == 4.
+    assert acc_rain.sum() == 7.5
+    dataset.close()
+
+
+def test_zarr_rain_sink():
+    zarr = pytest.importorskip('zarr')
+    x = np.arange(4) * 2500.
+    y = np.arange(3) * 2500.
+    path = os.path.join(tempfile.mkdtemp(), 'acc_rain.zarr')
+    sink = BackgroundRainSink(ZarrRainSink(path, x, y))
+    sink.write('3', (np.array([0, 5]), np.array([1.5, 2.])))
+    sink.write('7', (np.array([11]), np.array([4.], dtype='f4')))
+    sink.close()
+
+    group = zarr.open_group(path, mode='r')
+    assert list(group['uid'][:]) == ['3', '7']
+    acc_rain = group['acc_rain'][:]
+    assert acc_rain.shape == (2, 3, 4)
+    assert acc_rain[0, 1, 1] == 2.
+    assert acc_rain[1, 2, 3] == 4.
+    assert acc_rain.sum() == 7.5
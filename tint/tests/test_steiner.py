@@ -0,0 +1,33 @@
+""" Unit tests for steiner module. """
+
+import numpy as np
+
+from tint.steiner import convective_radius, peakedness, steiner_conv_strat
+
+
+def test_convective_radius():
+    ze_bkg = np.array([24.9, 25., 39.9, 40., np.inf])
+    assert list(convective_radius(ze_bkg, 1)) == [1000., 2000., 4000.,
+                                                  5000., 5000.]
+    assert convective_radius(np.array([39.]), 3)[0] == 0.
+
+
+def test_peakedness():
+    ze_bkg = np.array([-5., 30., 50., np.inf])
+    assert np.allclose(peakedness(ze_bkg, 0), [10., 5., 0., 0.])
+    assert np.allclose(peakedness(ze_bkg, 1), [14., 9., 4., 4.])
+
+
+def test_steiner_conv_strat():
+    x = np.arange(20) * 1000.
+    refl = np.full((20, 20), 20.)
+    refl[0, :] = np.nan
+    refl[10, 10] = 50.
+    sclass = steiner_conv_strat(refl, x, x, 1000., 1000.)
+    assert sclass[0, 5] == 0
+    assert sclass[10, 10] == 2
+    # The core's background of about 26 dBZ gives a radius of 2000 m, and
+    # its stencil stops one grid point short of that radius on the far side.
+    assert sclass[8, 10] == 2 and sclass[12, 10] == 1
+    assert sclass[11, 11] == 2 and sclass[9, 8] == 1
+    assert (sclass == 2).sum() == 11
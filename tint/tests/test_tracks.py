@@ -0,0 +1,133 @@
+""" Unit tests for tracks module. """
+
+import os
+import tempfile
+
+import pandas as pd
+import pytest
+
+from tint import tracks
+from tint.rain_io import BackgroundRainSink
+from tint.testing.synthetic_grids import make_grid
+
+
+def get_full_tracks(monkeypatch, nscans):
+    """ Returns a tracks object after get_tracks for nscans synthetic grids,
+    with post_tracks and get_system_tracks disabled. """
+    monkeypatch.setattr(tracks, 'post_tracks', lambda tobj: tobj)
+    monkeypatch.setattr(tracks, 'get_system_tracks', lambda tobj: tobj)
+    tobj = tracks.Cell_tracks()
+    tobj.get_tracks(iter([make_grid(scan) for scan in range(nscans)]),
+                    save_rain=False)
+    return tobj
+
+
+def test_step_flush(monkeypatch):
+    full = get_full_tracks(monkeypatch, 6).tracks
+    tobj = tracks.Cell_tracks()
+    rows = [tobj.step(make_grid(scan), keep_history=False)
+            for scan in range(6)]
+    assert len(rows[0]) == 0
+    rows.append(tobj.flush(keep_history=False))
+    pd.testing.assert_frame_equal(pd.concat(rows), full)
+
+
+def test_step_after_flush(monkeypatch):
+    full = get_full_tracks(monkeypatch, 6).tracks
+    tobj = tracks.Cell_tracks()
+    for scan in range(3):
+        tobj.step(make_grid(scan))
+    provisional = tobj.flush()
+    assert set(provisional.index.get_level_values('scan')) == {2}
+    for scan in range(3, 6):
+        tobj.step(make_grid(scan))
+    tobj.flush()
+    pd.testing.assert_frame_equal(tobj.track_buffer.to_frame(), full)
+
+
+class ClosingSink(object):
+    """ Rain sink that records whether it was closed. """
+
+    def __init__(self):
+        self.closed = False
+
+    def write(self, uid, acc_rain):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def test_get_tracks_closes_rain_sink(monkeypatch):
+    def failing_grids():
+        for scan in range(3):
+            yield make_grid(scan)
+        raise IOError('unreadable grid')
+
+    sink = BackgroundRainSink(ClosingSink())
+    monkeypatch.setattr(tracks, 'open_rain_sink', lambda path, grid: sink)
+    tobj = tracks.Cell_tracks()
+    with pytest.raises(IOError):
+        tobj.get_tracks(failing_grids(), rain_sink='acc_rain.nc')
+    assert sink.sink.closed
+    assert not sink._thread.is_alive()
+
+
+def test_get_tracks_rain_sink_requires_rain():
+    tobj = tracks.Cell_tracks()
+    with pytest.raises(ValueError):
+        tobj.get_tracks(iter([make_grid(0)]), rain=False, save_rain=True)
+
+
+def test_resume_from_checkpoint(monkeypatch):
+    full = get_full_tracks(monkeypatch, 8)
+    path = os.path.join(tempfile.mkdtemp(), 'tracks.ckpt')
+
+    def interrupted_grids():
+        for scan in range(7):
+            yield make_grid(scan)
+        raise IOError('job killed')
+
+    tobj = tracks.Cell_tracks()
+    with pytest.raises(IOError):
+        tobj.get_tracks(interrupted_grids(), checkpoint_path=path,
+                        checkpoint_interval=2)
+    segments = tobj.track_buffer.segments
+    assert len(segments) == 3
+    assert [start for file_name, start, nrows in segments] == [
+        0, segments[0][2], segments[0][2] + segments[1][2]
+    ]
+    referenced = set(segment[0] for buffer in [tobj.track_buffer,
+                                               tobj.record.shift_buffer]
+                     for segment in buffer.segments)
+    rows_files = set(file_name
+                     for file_name in os.listdir(os.path.dirname(path))
+                     if file_name.endswith('.rows'))
+    assert rows_files == referenced
+
+    resumed = tracks.Cell_tracks()
+    resumed.load_checkpoint(path)
+    grids = iter([make_grid(scan) for scan in range(resumed.last_index, 8)])
+    resumed.get_tracks(grids)
+    pd.testing.assert_frame_equal(resumed.tracks, full.tracks)
+    pd.testing.assert_frame_equal(resumed.record.shifts, full.record.shifts)
+
+
+def test_checkpoint_after_flush(monkeypatch):
+    full = get_full_tracks(monkeypatch, 6)
+    path = os.path.join(tempfile.mkdtemp(), 'tracks.ckpt')
+    tobj = tracks.Cell_tracks()
+    for scan in range(3):
+        tobj.step(make_grid(scan))
+    tobj.flush()
+    tobj.save_checkpoint(path)
+    tobj.step(make_grid(3))
+    tobj.save_checkpoint(path)
+
+    resumed = tracks.Cell_tracks()
+    resumed.load_checkpoint(path)
+    for scan in range(resumed.last_index, 6):
+        resumed.step(make_grid(scan))
+    resumed.flush()
+    pd.testing.assert_frame_equal(resumed.track_buffer.to_frame(),
+                                  full.tracks)
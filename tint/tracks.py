@@ -8,18 +8,24 @@ Cell_tracks class.
 
 import copy
 import datetime
+import itertools
 
 import numpy as np
 import pandas as pd
-import xarray as xr
 
 from .grid_utils import get_grid_size, get_radar_info, extract_grid_data
-from .helpers import Record, Counter
-from .phase_correlation import get_global_shift
+from .grid_utils import get_grid_geometry
+from .helpers import Record, Counter, ColumnBuffer
+from .phase_correlation import get_global_shift, get_motion_field
+from .phase_correlation import SpectrumCache
 from .matching import get_pairs
 from .objects import init_current_objects, update_current_objects
 from .objects import get_object_prop, write_tracks 
 from .objects import post_tracks, get_system_tracks
+from .rain_io import open_rain_sink
+from .pipeline import get_scan_iterator
+from .chunking import get_chunked_tracks
+from .checkpoint import write_checkpoint, read_checkpoint
 
 # Tracking Parameter Defaults
 FIELD_THRESH = [32]
@@ -37,6 +43,22 @@ LEVELS = np.array([[500, 20000]])
 TRACK_INTERVAL = 0
 UPDRAFT_THRESH = 25
 UPDRAFT_START = 500
+FFT_WORKERS = 1
+FLOW_MODE = 'object'
+GS_PYRAMID = 0
+GS_WINDOW = 64
+GS_WARM_START = False
+MATCH_SOLVER = 'dense'
+MATCH_ENGINE = 'disparity'
+UPDRAFT_WORKERS = 1
+FLOW_WORKERS = 1
+
+# Tracking restarts when the interval between scans exceeds this many seconds
+MAX_INTERVAL = 1700
+
+# Default accumulated rainfall output; formatted with the dt argument
+ACC_RAIN_PATH = ('/g/data/w40/esh563/CPOL_analysis/accumulated_rainfalls/'
+                 + 'acc_rain_da_{}.nc')
 
 """
 Tracking Parameter Guide
@@ -88,6 +110,45 @@ UPDRAFT_THRESH: float, DbZ
     to define "updrafts". 
 UPDRAFT_START: float, metres
     Height at which to begin tracking updrafts.
+FFT_WORKERS: integer
+    Number of threads used by each FFT in phase correlation. See
+    get_global_shift in tint.phase_correlation.
+FLOW_MODE: 'object' or 'tiled'
+    How local shifts are obtained. 'object' phase correlates the region 
+    within FLOW_MARGIN of each object. 'tiled' phase correlates a fixed grid
+    of overlapping tiles two FLOW_MARGIN wide once per scan, and averages 
+    the tiles containing each object's center. The tiled motion field is 
+    kept in the motion attribute of the tracks object.
+GS_PYRAMID: integer
+    Number of halvings of resolution at which the global shift is first
+    estimated, before refinement at full resolution. Use 0 to phase 
+    correlate the full frames. See get_pyramid_shift in 
+    tint.phase_correlation.
+GS_WINDOW: pixels
+    Size of the window in which the global shift is refined when 
+    GS_PYRAMID is positive.
+GS_WARM_START: bool
+    If True and GS_PYRAMID is positive, the global shift of the previous
+    scan is refined in place of a downsampled estimate.
+MATCH_SOLVER: 'dense' or 'sparse'
+    How objects are assigned to their matches. 'dense' solves the full
+    disparity matrix. 'sparse' keeps only disparities within search boxes
+    and solves each connected group of objects separately, which is much
+    faster for many objects. See match_pairs_sparse in tint.matching.
+MATCH_ENGINE: 'disparity' or 'overlap'
+    How candidate matches are scored. 'disparity' predicts each object's
+    position from phase correlation and scores the objects near it.
+    'overlap' scores objects by their overlap once the first frame is moved
+    by the global shift. This is much cheaper, but only suits objects that
+    move less than their own size between scans. Shift correction is not
+    recorded for 'overlap'. See get_pairs_overlap in tint.matching.
+UPDRAFT_WORKERS: integer
+    Number of threads used to find local maxima at each vertical level
+    when identifying updrafts. See get_local_maxima in tint.objects.
+FLOW_WORKERS: integer
+    Number of threads over which object flow regions of different shapes
+    are phase correlated when FLOW_MODE is 'object'. See get_ambient_flows
+    in tint.phase_correlation.
 """
 
 
@@ -106,8 +167,18 @@ class Cell_tracks(object):
     grid_size : array
         Array containing z, y, and x mesh size in meters respectively.
     last_grid : Grid
-        Contains the most recent grid object tracked. This is used for dynamic
-        updates.
+        Contains the most recent grid object tracked. This scan is pending;
+        its tracks are written once the following scan is known, or
+        provisionally by flush and at the end of get_tracks.
+    last_data : tuple
+        Output of extract_grid_data for last_grid.
+    grid_count : int
+        Number of grids passed to the tracks object so far, including
+        skipped grids.
+    last_index : int
+        Position of last_grid in the sequence of all grids passed to the
+        tracks object. Tracking resumed from a checkpoint continues from
+        this grid.
     counter : Counter
         See Counter class in helpers.py.
     record : Record
@@ -115,14 +186,42 @@ class Cell_tracks(object):
     current_objects : dict
         Contains information about objects in the current scan.
     tracks : DataFrame
+        Built from track_buffer at the end of get_tracks.
+    motion : DataFrame
+        Motion field of each scan tracked with the 'tiled' FLOW_MODE, built
+        from record.motion at the end of get_tracks.
+    track_buffer : ColumnBuffer
+        Accumulates the rows of tracks as each scan is written. Call
+        track_buffer.to_frame() for the tracks written so far.
 
+    __new_rain : bool
+        True if objects in the pending scan are to be initialized rather than
+        matched to those of the previous scan.
+    __prev_frame : array
+        Labelled objects of the scan before last_grid at the tracking level.
+    __obj_merge : array
+        Merge matrix obtained when matching the scan before last_grid.
+    __provisional : bool
+        True if the rows of track_buffer end with provisional rows for
+        last_grid, written as though it were the final scan.
+    __spectra : SpectrumCache
+        Holds the spectrum of the last frame used in global shift
+        calculation, which is the first frame of the next calculation.
+    __global_shift : array
+        Global shift of the previous scan, used when GS_WARM_START is True.
+        None after a time discontinuity.
+    __geometry : GridGeometry
+        Geometry of the last grid, reused while grids share it. See
+        get_grid_geometry in grid_utils.
     __saved_record : Record
         Deep copy of Record at the penultimate scan in the sequence. This and
-        following 2 attributes used for link-up in dynamic updates.
+        following attributes used for link-up in dynamic updates.
     __saved_counter : Counter
         Deep copy of Counter.
     __saved_objects : dict
         Deep copy of current_objects.
+    __saved_state : tuple
+        Saved __new_rain, __prev_frame and __obj_merge.
 
     """
 
@@ -141,193 +240,424 @@ class Cell_tracks(object):
                        'TRACK_INTERVAL': TRACK_INTERVAL,
                        'BOUNDARY_GRID_CELLS': BOUNDARY_GRID_CELLS,
                        'UPDRAFT_THRESH': UPDRAFT_THRESH,
-                       'UPDRAFT_START': UPDRAFT_START}
+                       'UPDRAFT_START': UPDRAFT_START,
+                       'FFT_WORKERS': FFT_WORKERS,
+                       'FLOW_MODE': FLOW_MODE,
+                       'GS_PYRAMID': GS_PYRAMID,
+                       'GS_WINDOW': GS_WINDOW,
+                       'GS_WARM_START': GS_WARM_START,
+                       'MATCH_SOLVER': MATCH_SOLVER,
+                       'MATCH_ENGINE': MATCH_ENGINE,
+                       'UPDRAFT_WORKERS': UPDRAFT_WORKERS,
+                       'FLOW_WORKERS': FLOW_WORKERS}
                        
         self.field = field
         self.grid_size = None
         self.radar_info = None
         self.last_grid = None
+        self.last_data = None
+        self.grid_count = 0
+        self.last_index = None
         self.counter = None
         self.record = None
         self.current_objects = None
         self.tracks = pd.DataFrame()
+        self.motion = pd.DataFrame()
+        self.track_buffer = ColumnBuffer(index=['scan', 'time', 'level', 'uid'])
+
+        self.__new_rain = True
+        self.__prev_frame = None
+        self.__obj_merge = None
+        self.__provisional = False
+        self.__spectra = SpectrumCache()
+        self.__global_shift = None
+        self.__geometry = None
 
         self.__saved_record = None
         self.__saved_counter = None
         self.__saved_objects = None
+        self.__saved_state = None
 
     def __save(self):
-        """ Saves deep copies of record, counter, and current_objects. """
+        """ Saves deep copies of record, counter, and current_objects, and the
+        state of the scan loop. """
         self.__saved_record = copy.deepcopy(self.record)
         self.__saved_counter = copy.deepcopy(self.counter)
         self.__saved_objects = copy.deepcopy(self.current_objects)
+        self.__saved_state = (self.__new_rain, self.__prev_frame,
+                              self.__obj_merge)
 
     def __load(self):
         """ Loads saved copies of record, counter, and current_objects. If new
-        tracks are appended to existing tracks via the get_tracks method, the
-        most recent scan prior to the addition must be overwritten to link up
-        with the new scans. Because of this, record, counter and
-        current_objects must be reverted to their state in the penultimate
-        iteration of the loop in get_tracks. See get_tracks for details. """
+        tracks are appended to existing tracks via the get_tracks or step
+        methods, the most recent scan prior to the addition must be
+        overwritten to link up with the new scans. Because of this, record,
+        counter and current_objects must be reverted to their state before
+        that scan was tracked as the final scan. See __finish. """
         self.record = self.__saved_record
         self.counter = self.__saved_counter
         self.current_objects = self.__saved_objects
+        self.__new_rain, self.__prev_frame, self.__obj_merge = (
+            self.__saved_state
+        )
+
+    def __start(self, grid_obj):
+        """ Initializes the tracks object using the first grid. """
+        self.grid_size = get_grid_size(grid_obj)
+        self.radar_info = get_radar_info(grid_obj)
+        self.counter = Counter()
+        self.record = Record(grid_obj)
+
+    def __discard_provisional(self):
+        """ Removes provisional rows for the pending scan from
+        track_buffer. """
+        if self.__provisional:
+            scans = self.track_buffer.get_column('scan')
+            self.track_buffer.truncate(
+                np.searchsorted(scans, self.record.scan + 1)
+            )
+            self.__provisional = False
+
+    def __push(self, grid_obj, data, rain, rain_sink):
+        """ Adds a grid and its extract_grid_data output to the sequence,
+        tracking the pending scan if there is one. Grids that are
+        artificially zero are skipped. """
+        index = self.grid_count
+        self.grid_count += 1
+        if self.last_grid is not None:
+            if np.max(self.last_data[0]) > 30 and np.max(data[0]) == 0:
+                print('Skipping erroneous grid.                        ')
+                return
+            self.__track_scan(grid_obj, data, rain, rain_sink)
+        self.last_grid = grid_obj
+        self.last_data = data
+        self.last_index = index
+
+    def __finish(self, rain, rain_sink):
+        """ Writes provisional tracks for the pending scan as the final scan,
+        then reverts to the state before doing so, so that the sequence can
+        be continued. """
+        if self.last_grid is None:
+            return
+        self.__save()
+        self.__track_scan(None, None, rain, rain_sink)
+        self.__load()
+        self.__provisional = True
+
+    def __track_scan(self, grid_obj2, data2, rain, rain_sink):
+        """ Tracks the pending scan, given the grid and extract_grid_data
+        output of the following scan. If grid_obj2 is None, the pending scan
+        is tracked as the final scan. Accumulated rainfall of objects that
+        die is written to rain_sink if it is not None. """
+        grid_obj1 = self.last_grid
+        raw1, raw_rain1, frames1, cores1, products1 = self.last_data
+        frame1 = frames1[self.params['TRACK_INTERVAL']]
+        if self.__new_rain:
+            frame0 = np.nan
+        else:
+            frame0 = self.__prev_frame
+        self.__prev_frame = frame1
+
+        if grid_obj2 is not None:
+            raw2, raw_rain2, frames2, cores2, products2 = data2
+            frame2 = frames2[self.params['TRACK_INTERVAL']]
+
+            self.record.update_scan_and_time(grid_obj1, grid_obj2)
 
-    def get_tracks(self, grids, rain=True, save_rain=True, dt=''):
+            # Check for gaps in record. If gap exists, tell tint to start
+            # define new objects in current grid.
+            if self.record.interval != None:
+                # Allow a couple of missing scans
+                if self.record.interval.seconds > MAX_INTERVAL:
+                    message = '\nTime discontinuity at {}.'.format(
+                        self.record.time
+                    )
+                    print(message, flush=True)
+                    self.__new_rain = True
+                    self.current_objects = None
+                    self.__global_shift = None
+        else:
+            # setup to write final scan
+            self.record.update_scan_and_time(grid_obj1)
+            raw2 = None
+            raw_rain2 = raw_rain1
+            frame2 = np.zeros_like(frame1)
+            frames2 = np.zeros_like(frames1)
+
+        if np.max(frame1) == 0:
+            self.__new_rain = True
+            print('No objects found in scan '
+                  + str(self.record.scan) + '.', end='    \r',
+                  flush=True)
+            self.current_objects = None
+            return
+
+        estimate = None
+        if self.params['GS_WARM_START']:
+            estimate = self.__global_shift
+        global_shift = get_global_shift(raw1, raw2, self.params,
+                                        self.__spectra, estimate)
+        if global_shift is not None:
+            self.__global_shift = global_shift
+        motion_field = None
+        if self.params['FLOW_MODE'] == 'tiled' and raw2 is not None:
+            motion_field = get_motion_field(raw1, raw2, self.params,
+                                            self.grid_size)
+            self.record.record_motion(motion_field)
+        pairs, obj_merge_new, u_shift, v_shift = get_pairs(
+            frame1, frame2, raw1, raw2, global_shift, self.current_objects,
+            self.record, self.params, motion_field
+        )
+
+        if self.__new_rain:
+            # first nonempty scan after a period of empty scans
+            self.current_objects, self.counter = init_current_objects(
+                raw1, raw2, raw_rain1, raw_rain2, frame1, frame2,
+                frames1, frames2, pairs, self.counter,
+                self.record.interval.total_seconds(), rain
+            )
+            self.__new_rain = False
+        else:
+            self.current_objects, self.counter = update_current_objects(
+                raw1,raw2,raw_rain1,raw_rain2,frame0,frame1,frame2,
+                frames1, frames2, rain_sink,
+                pairs,self.current_objects,self.counter,self.__obj_merge,
+                self.record.interval.total_seconds(),rain,
+                rain_sink is not None
+            )
+        self.__obj_merge = obj_merge_new
+        self.__geometry = get_grid_geometry(
+            grid_obj1, self.grid_size, self.params, self.__geometry
+        )
+        obj_props = get_object_prop(
+            frames1, cores1, grid_obj1, u_shift, v_shift, products1,
+            self.field, self.record, self.params, self.current_objects,
+            self.__geometry
+        )
+        self.record.add_uids(self.current_objects)
+        write_tracks(self.track_buffer, self.record,
+                     self.current_objects, obj_props)
+
+    def save_checkpoint(self, path):
+        """ Writes the tracking state to path, so that tracking can later be
+        resumed with load_checkpoint. The grid object and extracted data of
+        the pending scan are not saved; that grid is read again on
+        resumption. Only rows of tracks and shifts added since the last
+        checkpoint to path are written; see tint.checkpoint. """
+        record = copy.copy(self.record)
+        record.shift_buffer = None
+        record.motion_buffer = None
+        write_checkpoint({
+            'field': self.field,
+            'params': self.params,
+            'grid_size': self.grid_size,
+            'radar_info': self.radar_info,
+            'grid_count': self.grid_count,
+            'last_index': self.last_index,
+            'counter': self.counter,
+            'record': record,
+            'current_objects': self.current_objects,
+            'new_rain': self.__new_rain,
+            'prev_frame': self.__prev_frame,
+            'obj_merge': self.__obj_merge,
+            'provisional': self.__provisional,
+            'global_shift': self.__global_shift,
+        }, path, buffers={
+            'tracks': self.track_buffer,
+            'shifts': self.record.shift_buffer,
+            'motion': self.record.motion_buffer,
+        })
+
+    def load_checkpoint(self, path):
+        """ Restores the tracking state written by save_checkpoint. Tracking
+        then continues with get_tracks or step, which must be given the
+        grids from position last_index onwards in the original sequence of
+        grids. """
+        state = read_checkpoint(path)
+        self.field = state['field']
+        self.params = state['params']
+        self.grid_size = state['grid_size']
+        self.radar_info = state['radar_info']
+        self.counter = state['counter']
+        self.record = state['record']
+        self.record.shift_buffer = state['buffers']['shifts']
+        self.record.motion_buffer = state['buffers']['motion']
+        self.current_objects = state['current_objects']
+        self.track_buffer = state['buffers']['tracks']
+        self.__new_rain = state['new_rain']
+        self.__prev_frame = state['prev_frame']
+        self.__obj_merge = state['obj_merge']
+        self.__provisional = state['provisional']
+        self.__global_shift = state['global_shift']
+        self.__discard_provisional()
+        self.last_grid = None
+        self.last_data = None
+        self.last_index = state['last_index']
+        self.grid_count = state['last_index']
+        self.tracks = pd.DataFrame()
+        self.motion = pd.DataFrame()
+
+    def get_tracks(self, grids, rain=True, save_rain=False, dt='',
+                   prefetch=0, workers=None, rain_sink=None,
+                   checkpoint_path=None, checkpoint_interval=12,
+                   reader=None):
         """ Obtains tracks given a list of pyart grid objects. This is the
         primary method of the tracks class. This method makes use of all of the
-        functions and helper classes defined above. """
+        functions and helper classes defined above.
+
+        If prefetch is a positive integer, upcoming grids are read and passed
+        through extract_grid_data in a background thread, up to prefetch scans
+        ahead of the scan currently being matched. If workers is an integer
+        greater than 1, extract_grid_data runs in a pool of that many
+        processes and results are passed to the matching loop in scan
+        order.
+
+        If reader is given, grids is an iterator of file paths, each read
+        with reader, e.g. pyart.io.read_grid. With workers, files are then
+        read in the worker processes, and only the fields used in tracking
+        are sent back, rather than each whole grid being sent to a worker.
+        The first file is also read here to initialize tracking.
+
+        If save_rain is True or rain_sink is given, the accumulated rainfall
+        of each object is written out as soon as the object dies, which
+        requires rain to be True. rain_sink may be a path, in which case
+        paths ending in .zarr are written as a Zarr store and all others as
+        NetCDF, or an open sink object with write and close methods, which is
+        left open. The default path is ACC_RAIN_PATH formatted with dt. Sinks
+        opened here are closed even if tracking fails.
+
+        If checkpoint_path is given, the tracking state is written there
+        every checkpoint_interval grids; see save_checkpoint. When resuming
+        with save_rain, use a new rain_sink path, as rainfall of objects
+        that died before the checkpoint is in the earlier output. """
         start_time = datetime.datetime.now()
-        acc_rain_list = []
-        acc_rain_uid_list = []
+        save_rain = save_rain or rain_sink is not None
+        if save_rain and not rain:
+            raise ValueError('save_rain requires rain to be True.')
 
-        if self.record is None:
-            # tracks object being initialized
-            grid_obj2 = next(grids)
-            self.grid_size = get_grid_size(grid_obj2)
-            self.radar_info = get_radar_info(grid_obj2)
-            self.counter = Counter()
-            self.record = Record(grid_obj2)
+        if self.record is None or self.last_grid is None:
+            # tracks object being initialized or resumed from a checkpoint
+            item = next(grids)
+            grid_obj = item if reader is None else reader(item)
+            if self.record is None:
+                self.__start(grid_obj)
+            grids = itertools.chain([item], grids)
         else:
-            # tracks object being updated
-            grid_obj2 = self.last_grid
-            self.tracks.drop(self.record.scan + 1)  # last scan is overwritten
+            # tracks object being updated; last scan is overwritten
+            grid_obj = self.last_grid
+            self.__discard_provisional()
 
-        if self.current_objects is None:
-            newRain = True
-        else:
-            newRain = False
+        close_sink = False
+        if save_rain and (rain_sink is None or isinstance(rain_sink, str)):
+            if rain_sink is None:
+                rain_sink = ACC_RAIN_PATH.format(dt)
+            rain_sink = open_rain_sink(rain_sink, grid_obj)
+            close_sink = True
 
-        raw2, raw_rain2, frames2, cores2, sclasses2 = extract_grid_data(
-            grid_obj2, self.field, self.grid_size, self.params, rain
-        )
-        frame2 = frames2[self.params['TRACK_INTERVAL']]
-        
-        while grid_obj2 is not None:
-            grid_obj1 = grid_obj2
-            if not newRain:
-                frame0 = copy.deepcopy(frame1)
-            else:
-                frame0 = np.nan
-            raw1 = raw2
-            raw_rain1 = raw_rain2
-            frame1 = frame2
-            frames1 = frames2
-            cores1 = cores2
-            sclasses1 = sclasses2
-
-            try:
-                # Check if next grid zero artificially
-                grid_obj2 = next(grids)
-                raw, raw_rain, frames, cores, sclasses = extract_grid_data(
-                    grid_obj2, self.field, self.grid_size, self.params, rain
-                )
-                # Skip grids that are artificially zero
-                while (np.max(raw1)>30 and np.max(raw)==0):
-                    grid_obj2 = next(grids)
-                    raw, raw_rain, frames, cores, sclasses = extract_grid_data(
-                        grid_obj2, self.field, self.grid_size, self.params, rain
-                    )
-                    print('Skipping erroneous grid.                        ')                
-            except StopIteration:
-                grid_obj2 = None
-                
-            if grid_obj2 is not None:
-                              
-                [raw2, raw_rain2, frames2, cores2, sclasses2] = [raw, raw_rain, frames, cores, sclasses]
-                frame2 = frames2[self.params['TRACK_INTERVAL']]
-                
-                self.record.update_scan_and_time(grid_obj1, grid_obj2)
-                
-                # Check for gaps in record. If gap exists, tell tint to start
-                # define new objects in current grid. 
-                if self.record.interval != None:
-                    # Allow a couple of missing scans
-                    if self.record.interval.seconds > 1700:
-                        message = '\nTime discontinuity at {}.'.format(
-                            self.record.time
-                        )
-                        print(message, flush=True)
-                        newRain = True
-                        self.current_objects = None
-                
-            else:
-                # setup to write final scan
-                self.__save()
-                self.last_grid = grid_obj1
-                self.record.update_scan_and_time(grid_obj1)
-                raw2 = None
-                frame2 = np.zeros_like(frame1)
-                frames2 = np.zeros_like(frames1)
-
-            if np.max(frame1) == 0:
-                newRain = True
-                print('No objects found in scan ' 
-                      + str(self.record.scan) + '.', end='    \r',
-                      flush=True)
-                self.current_objects = None
-                continue
-                              
-            global_shift = get_global_shift(raw1, raw2, self.params)
-            pairs, obj_merge_new, u_shift, v_shift = get_pairs(
-                frame1, frame2, raw1, raw2, global_shift, self.current_objects, 
-                self.record, self.params
+        try:
+            self.__geometry = get_grid_geometry(
+                grid_obj, self.grid_size, self.params, self.__geometry
             )
-                                                                                 
-            if newRain:
-                # first nonempty scan after a period of empty scans
-                self.current_objects, self.counter = init_current_objects(
-                    raw1, raw2, raw_rain1, raw_rain2, frame1, frame2,
-                    frames1, frames2, pairs, self.counter, 
-                    self.record.interval.total_seconds(), rain
-                )
-                newRain = False
-            else:
-                self.current_objects, self.counter, acc_rain_list, acc_rain_uid_list = update_current_objects(
-                    raw1,raw2,raw_rain1,raw_rain2,frame0,frame1,frame2,
-                    frames1, frames2, 
-                    acc_rain_list, acc_rain_uid_list,
-                    pairs,self.current_objects,self.counter,obj_merge,
-                    self.record.interval.total_seconds(),rain,save_rain
-                )
-            obj_merge = obj_merge_new
-            obj_props = get_object_prop(
-                frames1, cores1, grid_obj1, u_shift, v_shift, sclasses1, 
-                self.field, self.record, self.params, self.current_objects
+            scans = get_scan_iterator(
+                grids, self.field, self.grid_size, self.params, rain,
+                prefetch, workers, reader, self.__geometry
             )
-            self.record.add_uids(self.current_objects)
-            self.tracks = write_tracks(self.tracks, self.record,
-                                       self.current_objects, obj_props)
-            del raw1, frames1, cores1, 
-            del global_shift, pairs, obj_props
-            # scan loop end
-        
-        if save_rain:    
-            acc_rain = np.stack(acc_rain_list, axis=0)
-            acc_rain_uid = np.array(acc_rain_uid_list)
-            if len(acc_rain_uid_list)>1:
-                acc_rain_uid = np.squeeze(acc_rain_uid)
-            
-            x = grid_obj1.x['data'].data
-            y = grid_obj1.y['data'].data
-            acc_rain_da = xr.DataArray(acc_rain, coords=[acc_rain_uid, y, x], dims=['uid','y','x'])
-            acc_rain_da.attrs = {
-                'long_name': 'Accumulated Rainfall', 
-                'units': 'mm', 
-                'standard_name': 'Accumulated Rainfall', 
-                'description': ('Derived from rainfall rate algorithm based on '
-                                + 'Thompson et al. 2016, integrated in time.')
-            }
-            acc_rain_da.to_netcdf('/g/data/w40/esh563/CPOL_analysis/'
-                                  + 'accumulated_rainfalls/'
-                                  + 'acc_rain_da_{}.nc'.format(dt))  
-        
-        del grid_obj1
-
-        self = post_tracks(self)
-        self = get_system_tracks(self)
-          
-        self.__load()
+            for grid_obj, data in scans:
+                self.__push(grid_obj, data, rain, rain_sink)
+                if (checkpoint_path is not None
+                        and self.grid_count % checkpoint_interval == 0):
+                    self.save_checkpoint(checkpoint_path)
+            self.__finish(rain, rain_sink)
+        finally:
+            if close_sink:
+                rain_sink.close()
+
+        self.tracks = self.track_buffer.to_frame()
+        self.motion = self.record.motion
+        if len(self.tracks) > 0:
+            self = post_tracks(self)
+            self = get_system_tracks(self)
+
+        time_elapsed = datetime.datetime.now() - start_time
+        print('\n')
+        print('Time elapsed:', np.round(time_elapsed.seconds/60, 1), 'minutes')
+        return
+
+    def step(self, grid_obj, rain=True, rain_sink=None, keep_history=True):
+        """ Tracks a single new grid, for use with real-time feeds. A scan is
+        only tracked once the following scan is known, so this returns a
+        dataframe of the rows written for the previous grid; the first call
+        returns an empty dataframe. Call flush for provisional rows for
+        grid_obj itself. post_tracks and get_system_tracks are not applied,
+        as they depend on the full sequence.
+
+        If rain_sink is given, the accumulated rainfall of objects that die
+        is written to it; see tint.rain_io. If keep_history is False, rows
+        and shifts are discarded once returned, so that memory use does not
+        grow with the number of scans. """
+        if rain_sink is not None and not rain:
+            raise ValueError('rain_sink requires rain to be True.')
+        if self.record is None:
+            self.__start(grid_obj)
+        self.__discard_provisional()
+        self.__geometry = get_grid_geometry(
+            grid_obj, self.grid_size, self.params, self.__geometry
+        )
+        data = extract_grid_data(
+            grid_obj, self.field, self.grid_size, self.params, rain,
+            self.__geometry
+        )
+        start = len(self.track_buffer)
+        self.__push(grid_obj, data, rain, rain_sink)
+        return self.__take_rows(start, keep_history)
+
+    def flush(self, rain=True, keep_history=True):
+        """ Returns a dataframe of provisional rows for the most recent grid
+        passed to step, tracked as though it were the final scan. Tracking
+        can continue with step, which replaces these rows. """
+        self.__discard_provisional()
+        start = len(self.track_buffer)
+        self.__finish(rain, None)
+        if not keep_history:
+            self.__provisional = False
+        return self.__take_rows(start, keep_history)
+
+    def __take_rows(self, start, keep_history):
+        """ Returns rows of track_buffer from start onwards, discarding all
+        rows and shifts if keep_history is False. """
+        rows = self.track_buffer.to_frame(start=start)
+        if not keep_history:
+            self.track_buffer.truncate(0)
+            self.record.shift_buffer.truncate(0)
+            self.record.motion_buffer.truncate(0)
+        return rows
+
+    def get_tracks_chunked(self, files, chunk_size=144, overlap=4,
+                           times=None, workers=None, reader=None, rain=True):
+        """ Obtains tracks for a list of grid files by tracking time chunks
+        of chunk_size scans in parallel, using a pool of workers processes,
+        and stitching the chunk tracks together. Grids are read from files
+        using reader, which defaults to pyart.io.read_grid.
+
+        Each chunk is also tracked over overlap scans either side of the
+        scans it contributes, and uids are matched between neighbouring
+        chunks over those scans. If times, a list of datetimes for each file,
+        is given, chunks also begin at time discontinuities, where tracking
+        restarts anyway. Tracks near chunk boundaries may differ from those
+        of get_tracks when tracking in the overlap has not converged, and
+        tot_rain only accumulates from the start of the chunk. """
+        start_time = datetime.datetime.now()
+        template = Cell_tracks(self.field)
+        template.params = copy.deepcopy(self.params)
+
+        self.tracks, self.record = get_chunked_tracks(
+            template, files, chunk_size, overlap, times, MAX_INTERVAL,
+            workers, reader, rain
+        )
+        if len(self.tracks) > 0:
+            self.grid_size = self.record.grid_size
+            self = get_system_tracks(self)
+
         time_elapsed = datetime.datetime.now() - start_time
         print('\n')
         print('Time elapsed:', np.round(time_elapsed.seconds/60, 1), 'minutes')